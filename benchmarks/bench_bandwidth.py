@@ -0,0 +1,68 @@
+"""
+Bytes on the wire per response: encodings and ?compact=1.
+
+    $ python benchmarks/bench_bandwidth.py [--users 2000] [--cars 500] [--favs 10] [--repeat 5]
+
+Seeds a throw-away SQLite database, then requests the largest read
+responses through the test client with every Accept-Encoding
+compression.py can answer (identity, gzip, and br / zstd when brotli /
+zstandard are installed), in full and in compact mode. For each one it
+prints the encoding actually used (bodies under COMPRESS_MIN_SIZE stay
+uncompressed), the body size, the ratio to the full uncompressed body and
+the best time of --repeat requests, compression included. Streams are read
+to the end.
+"""
+import argparse
+import os
+import time
+from common import use_database, seed
+
+os.environ.setdefault('CACHE_ENABLED', '0')
+os.environ.setdefault('AUTH_REQUIRED', '0')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+PATHS = ['/users?limit=1000', '/cars?limit=500', '/users/1', '/cars/1', '/users?stream=1']
+
+
+def fetch(client, path, encoding):
+    start = time.perf_counter()
+    response = client.get(path, headers={'Accept-Encoding': encoding})
+    size = len(response.get_data())
+    elapsed = time.perf_counter() - start
+    assert response.status_code == 200, (path, response.status_code)
+    # bodies under COMPRESS_MIN_SIZE are sent as they are
+    return size, elapsed, response.headers.get('Content-Encoding', 'identity')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--cars', type=int, default=500)
+    parser.add_argument('--favs', type=int, default=10, help='favourites per user')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    use_database()
+    from app import create_app
+    from models import db
+    app = create_app({'ADMIN_ENABLED': False})
+
+    encodings = ['identity', *app.extensions['compression']]
+    with app.app_context():
+        seed(db, args.users, args.cars, args.favs)
+        client = app.test_client()
+        print(f"{'path':<22}{'mode':<9}{'encoding':<10}{'bytes':>12}{'ratio':>8}{'ms':>9}")
+        for path in PATHS:
+            baseline = None
+            for mode in ('full', 'compact'):
+                url = path if mode == 'full' else path + ('&' if '?' in path else '?') + 'compact=1'
+                for encoding in encodings:
+                    runs = [fetch(client, url, encoding) for _ in range(args.repeat)]
+                    size, _, used = runs[0]
+                    best = min(elapsed for _, elapsed, _ in runs)
+                    baseline = baseline or size
+                    print(f'{path:<22}{mode:<9}{used:<10}{size:>12}{size / baseline:>8.3f}{best * 1000:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
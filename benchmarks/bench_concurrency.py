@@ -0,0 +1,145 @@
+"""
+Load test: gunicorn sync workers (wsgi.py) vs uvicorn workers (asgi.py)
+
+    $ python benchmarks/bench_concurrency.py [--workers 2] [--clients 64] [--seconds 10]
+    $ DATABASE_URL=postgresql://... python benchmarks/bench_concurrency.py --no-seed
+    $ DATABASE_URL=postgresql://... python benchmarks/bench_concurrency.py --writes
+
+Starts each server with the same number of workers on the same database,
+then keeps `--clients` concurrent connections busy on the read endpoints
+for `--seconds` and prints throughput and latency percentiles. Without
+DATABASE_URL a throw-away SQLite database is seeded first. The gap between
+the two grows with the time spent waiting on the database, so the
+PostgreSQL numbers are the ones that matter.
+
+With --writes the clients send PUT /users/<id> and PUT /cars/<id> instead,
+and the throughput is printed per endpoint. Every write bumps a slot of the
+table_versions counters (versions.py), the car updates also go through the
+outbox lock (outbox.py), one at a time: the gap between the two lines is
+what the change feed costs the writers.
+
+Needs gunicorn, uvicorn, asgiref and the async driver (asyncpg/aiosqlite).
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import urllib.request
+from common import ROOT, use_database, seed, percentile
+
+PATHS = ['/cars?limit=50', '/users?limit=50', '/users/{id}', '/cars/{id}', '/favourites?limit=100']
+WRITES = {
+    '/users/{id}': lambda rng: {'age': rng.randint(18, 90)},
+    '/cars/{id}': lambda rng: {'year': rng.randint(1990, 2024)},
+}
+
+
+def seed_database(users, cars, favs):
+    from app import create_app
+    from models import db
+    app = create_app()
+    with app.app_context():
+        seed(db, users, cars, favs)
+
+
+def wait_until_up(base, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base + '/cars?limit=1', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{base} did not start')
+
+
+def request(base, route, rng, max_id, writes):
+    url = base + route.format(id=rng.randint(1, max_id))
+    if not writes:
+        return urllib.request.Request(url)
+    return urllib.request.Request(url, method='PUT', data=json.dumps(WRITES[route](rng)).encode(),
+                                  headers={'Content-Type': 'application/json'})
+
+
+def load(base, clients, seconds, max_id, writes=False):
+    """Latencies sorted, per route when `writes`, and the number of errors."""
+    routes = list(WRITES) if writes else PATHS
+    latencies = {route: [] for route in routes}
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        rng = random.Random()
+        mine = {route: [] for route in routes}
+        while time.monotonic() < deadline:
+            route = rng.choice(routes)
+            start = time.perf_counter()
+            try:
+                urllib.request.urlopen(request(base, route, rng, max_id, writes), timeout=30).read()
+            except OSError:
+                with lock:
+                    errors[0] += 1
+                continue
+            mine[route].append(time.perf_counter() - start)
+        with lock:
+            for route, values in mine.items():
+                latencies[route].extend(values)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for values in latencies.values():
+        values.sort()
+    if not writes:
+        latencies = {'': sorted(value for values in latencies.values() for value in values)}
+    return latencies, errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--seconds', type=int, default=10)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--cars', type=int, default=500)
+    parser.add_argument('--favs', type=int, default=10, help='favourites per user')
+    parser.add_argument('--no-seed', action='store_true', help='use DATABASE_URL as it is')
+    parser.add_argument('--writes', action='store_true', help='PUT /users/<id> and /cars/<id> instead of reads')
+    args = parser.parse_args()
+
+    use_database(os.environ.get('DATABASE_URL'))
+    env = dict(os.environ, CACHE_ENABLED='0', AUTH_REQUIRED='0', RATE_LIMIT_ENABLED='0', WEB_CONCURRENCY=str(args.workers))
+    if not args.no_seed:
+        seed_database(args.users, args.cars, args.favs)
+
+    servers = [
+        ('wsgi', 8401, ['gunicorn', 'wsgi', '--chdir', 'src', '-w', str(args.workers), '-b', '127.0.0.1:8401']),
+        ('asgi', 8402, ['uvicorn', 'asgi:application', '--app-dir', 'src', '--workers', str(args.workers),
+                        '--port', '8402', '--log-level', 'warning']),
+    ]
+    print(f'{args.workers} workers, {args.clients} clients, {args.seconds}s per server')
+    print(f"{'server':<20}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, port, command in servers:
+        process = subprocess.Popen(command, cwd=ROOT, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base = f'http://127.0.0.1:{port}'
+            wait_until_up(base)
+            results, errors = load(base, args.clients, args.seconds, min(args.users, args.cars), args.writes)
+        finally:
+            process.terminate()
+            process.wait()
+        for route, latencies in results.items():
+            label = f'{name} PUT {route.split("/")[1]}' if route else name
+            print(f'{label:<20}{len(latencies):>10}{len(latencies) / args.seconds:>10.1f}'
+                  f'{percentile(latencies, 0.5) * 1000:>10.1f}{percentile(latencies, 0.99) * 1000:>10.1f}{errors:>8}')
+
+
+if __name__ == '__main__':
+    main()
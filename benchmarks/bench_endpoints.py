@@ -0,0 +1,283 @@
+"""
+Benchmark of every route in src/app.py, reported as JSON.
+
+    $ python benchmarks/bench_endpoints.py [--users 2000] [--cars 500] [--favs 10] [--profiles 0.5]
+                                           [--requests 200] [--gunicorn] [--output report.json]
+    $ python benchmarks/bench_endpoints.py --database-url postgresql://localhost/bench
+
+Seeds the database (a throw-away SQLite file unless --database-url is given,
+every table is dropped and recreated), then sends `--requests` requests to
+each route, first through the Flask test client and, with --gunicorn, to a
+real `gunicorn wsgi` process. Rows that writes consume (users to delete,
+cars to favourite...) are inserted beforehand and not timed.
+
+For every route the report has p50/p99 latency in ms, throughput, SQL
+statements per request, and the status codes seen. Peak RSS is reported
+for the benchmark process and for the gunicorn process. The response
+cache is off so every request does the real work. Routes of app.url_map
+without a case below are listed under "uncovered".
+"""
+import argparse
+import itertools
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import Counter, namedtuple
+from common import ROOT, use_database, seed, percentile, peak_rss_kb
+
+os.environ.setdefault('CACHE_ENABLED', '0')
+os.environ.setdefault('AUTH_REQUIRED', '0')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+# rule as in app.url_map, path(i, ids), body(i, ids) or None, prepare(n) -> ids
+Case = namedtuple('Case', 'method rule path body prepare')
+
+unique = itertools.count()
+
+
+def _insert(model, rows):
+    from sqlalchemy import insert
+    from models import db
+    ids = db.session.execute(insert(model).returning(model.id, sort_by_parameter_order=True), rows).scalars().all()
+    db.session.commit()
+    return ids
+
+
+def new_users(n):
+    from models import User
+    return _insert(User, [{'email': f'bench{next(unique)}@example.com', 'password': 'x', 'age': 30}
+                          for _ in range(n)])
+
+
+def new_cars(n):
+    from models import Car
+    return _insert(Car, [{'model': 'bench', 'year': 2024, 'name': f'bench{next(unique)}'} for _ in range(n)])
+
+
+def new_profiles(n):
+    from models import Profile
+    users = new_users(n)
+    _insert(Profile, [{'user_id': user_id, 'title': 'bench', 'bio': 'bench'} for user_id in users])
+    return users
+
+
+def new_favourites(n):
+    from models import Favourite
+    return _insert(Favourite, [{'user_id': 1, 'car_id': car_id} for car_id in new_cars(n)])
+
+
+def existing(column):
+    def prepare(n):
+        from sqlalchemy import select
+        from models import db
+        return db.session.execute(select(column).order_by(column).limit(n)).scalars().all()
+    return prepare
+
+
+def cases():
+    from models import User, Profile, Car, Favourite
+
+    def at(ids, i):
+        return ids[i % len(ids)]
+
+    def user_body(i, ids):
+        return {'email': f'bench{next(unique)}@example.com', 'password': 'x', 'age': 30}
+
+    def car_body(i, ids):
+        return {'model': 'bench', 'year': 2024, 'name': f'bench{next(unique)}'}
+
+    return [
+        Case('GET', '/', lambda i, ids: '/', None, None),
+        Case('GET', '/openapi.json', lambda i, ids: '/openapi.json', None, None),
+        Case('GET', '/metrics', lambda i, ids: '/metrics', None, None),
+        Case('GET', '/db/pool', lambda i, ids: '/db/pool', None, None),
+
+        Case('GET', '/users', lambda i, ids: '/users?limit=100', None, None),
+        Case('GET', '/users/<int:user_id>', lambda i, ids: f'/users/{at(ids, i)}', None, existing(User.id)),
+        Case('POST', '/users', lambda i, ids: '/users', user_body, None),
+        Case('POST', '/users/bulk', lambda i, ids: '/users/bulk',
+             lambda i, ids: [user_body(i, ids) for _ in range(100)], None),
+        Case('PUT', '/users/<int:user_id>', lambda i, ids: f'/users/{at(ids, i)}',
+             lambda i, ids: {'age': 40}, existing(User.id)),
+        Case('DELETE', '/users/<int:user_id>', lambda i, ids: f'/users/{ids[i]}', None, new_users),
+
+        Case('GET', '/users/profile', lambda i, ids: '/users/profile?limit=100', None, None),
+        Case('GET', '/users/<int:user_id>/profile', lambda i, ids: f'/users/{at(ids, i)}/profile',
+             None, existing(Profile.user_id)),
+        Case('POST', '/users/<int:user_id>/profile', lambda i, ids: f'/users/{ids[i]}/profile',
+             lambda i, ids: {'title': 'bench', 'bio': 'bench'}, new_users),
+        Case('PUT', '/users/<int:user_id>/profile', lambda i, ids: f'/users/{at(ids, i)}/profile',
+             lambda i, ids: {'bio': 'updated'}, existing(Profile.user_id)),
+        Case('DELETE', '/users/<int:user_id>/profile', lambda i, ids: f'/users/{ids[i]}/profile',
+             None, new_profiles),
+
+        Case('GET', '/cars', lambda i, ids: '/cars?limit=100', None, None),
+        Case('GET', '/cars/top', lambda i, ids: '/cars/top?n=10', None, None),
+        Case('GET', '/cars/<int:car_id>', lambda i, ids: f'/cars/{at(ids, i)}', None, existing(Car.id)),
+        Case('POST', '/cars', lambda i, ids: '/cars', car_body, None),
+        Case('POST', '/cars/bulk', lambda i, ids: '/cars/bulk',
+             lambda i, ids: [car_body(i, ids) for _ in range(100)], None),
+        Case('PUT', '/cars/<int:car_id>', lambda i, ids: f'/cars/{at(ids, i)}',
+             lambda i, ids: {'year': 2001}, existing(Car.id)),
+        Case('DELETE', '/cars/<int:car_id>', lambda i, ids: f'/cars/{ids[i]}', None, new_cars),
+
+        Case('GET', '/favourites', lambda i, ids: '/favourites?limit=100', None, None),
+        Case('GET', '/favourites/<int:favourite_id>', lambda i, ids: f'/favourites/{at(ids, i)}',
+             None, existing(Favourite.id)),
+        Case('POST', '/favourites/<int:user_id>/<int:car_id>', lambda i, ids: f'/favourites/1/{ids[i]}',
+             None, new_cars),
+        Case('POST', '/favourites/bulk', lambda i, ids: '/favourites/bulk',
+             lambda i, ids: [{'user_id': 1, 'car_id': car_id} for car_id in ids[i * 100:(i + 1) * 100]],
+             lambda n: new_cars(n * 100)),
+        Case('PUT', '/favourites/<int:fav_id>', lambda i, ids: f'/favourites/{at(ids, i)}',
+             lambda i, ids: {}, existing(Favourite.id)),
+        Case('DELETE', '/favourites/<int:favourite_id>', lambda i, ids: f'/favourites/{ids[i]}',
+             None, new_favourites),
+
+        Case('GET', '/changes', lambda i, ids: '/changes?since=0&limit=500', None, None),
+        Case('GET', '/search', lambda i, ids: f'/search?q=user{i % 100}', None, None),
+        Case('GET', '/search', lambda i, ids: f'/search?q=car{i % 100}+model&type=cars', None, None),
+    ]
+
+
+def summary(latencies, queries, statuses, elapsed):
+    latencies = sorted(latencies)
+    known = [q for q in queries if q is not None]
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'queries_per_request': round(sum(known) / len(known), 2) if known else None,
+        'status': dict(Counter(str(status) for status in statuses)),
+    }
+
+
+def run_test_client(app, db, case, n, ids):
+    from utils import count_queries
+    client = app.test_client()
+    latencies, queries, statuses = [], [], []
+    started = time.perf_counter()
+    for i in range(n):
+        body = case.body(i, ids) if case.body else None
+        with count_queries(db.engine) as counter:
+            start = time.perf_counter()
+            response = client.open(case.path(i, ids), method=case.method, json=body)
+            response.get_data()
+            latencies.append(time.perf_counter() - start)
+        queries.append(counter.count)
+        statuses.append(response.status_code)
+    return summary(latencies, queries, statuses, time.perf_counter() - started)
+
+
+SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+def run_http(base, case, n, ids):
+    latencies, queries, statuses = [], [], []
+    started = time.perf_counter()
+    for i in range(n):
+        body = case.body(i, ids) if case.body else None
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(base + case.path(i, ids), data=data, method=case.method,
+                                         headers={'Content-Type': 'application/json'})
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                response.read()
+                status, headers = response.status, response.headers
+        except urllib.error.HTTPError as error:
+            error.read()
+            status, headers = error.code, error.headers
+        latencies.append(time.perf_counter() - start)
+        # counted by instrumentation.py in the server
+        match = SERVER_TIMING_QUERIES.search(headers.get('Server-Timing', ''))
+        queries.append(int(match.group(1)) if match else None)
+        statuses.append(status)
+    return summary(latencies, queries, statuses, time.perf_counter() - started)
+
+
+def wait_until_up(base, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base + '/db/pool', timeout=1).read()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.2)
+    raise RuntimeError(f'{base} did not start')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--cars', type=int, default=500)
+    parser.add_argument('--favs', type=int, default=10, help='favourites per user')
+    parser.add_argument('--profiles', type=float, default=0.5, help='fraction of users with a profile')
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--database-url', help='e.g. a local PostgreSQL, SQLite by default')
+    parser.add_argument('--gunicorn', action='store_true', help='also run against gunicorn')
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn workers')
+    parser.add_argument('--port', type=int, default=8403)
+    parser.add_argument('--output', help='write the JSON here instead of stdout')
+    args = parser.parse_args()
+
+    url = use_database(args.database_url)
+    from app import create_app
+    from models import db
+    app = create_app()
+
+    report = {
+        'config': {**{k: v for k, v in vars(args).items() if k not in ('output', 'database_url')},
+                   'database': url.split('://', 1)[0], 'python': sys.version.split()[0]},
+        'routes': {},
+    }
+    n = args.requests
+    with app.app_context():
+        seed(db, args.users, args.cars, args.favs, args.profiles)
+        all_cases = cases()
+        covered = {(case.method, case.rule) for case in all_cases}
+        report['uncovered'] = sorted(
+            f'{method} {rule.rule}' for rule in app.url_map.iter_rules()
+            for method in rule.methods - {'HEAD', 'OPTIONS'}
+            if (method, rule.rule) not in covered and rule.endpoint != 'static'
+            and not rule.rule.startswith('/admin'))
+
+        for case in all_cases:
+            ids = case.prepare(n) if case.prepare else None
+            report['routes'][f'{case.method} {case.rule}'] = {
+                'test_client': run_test_client(app, db, case, n, ids)}
+        report['peak_rss_kb'] = {'test_client': peak_rss_kb()}
+
+        if args.gunicorn:
+            # prepared up front, nothing else writes while the server is measured
+            prepared = [case.prepare(n) if case.prepare else None for case in all_cases]
+            env = dict(os.environ, WEB_CONCURRENCY=str(args.workers))
+            process = subprocess.Popen(
+                ['gunicorn', 'wsgi', '--chdir', 'src', '-w', str(args.workers), '-b', f'127.0.0.1:{args.port}'],
+                cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                base = f'http://127.0.0.1:{args.port}'
+                wait_until_up(base)
+                for case, ids in zip(all_cases, prepared):
+                    report['routes'][f'{case.method} {case.rule}']['gunicorn'] = run_http(base, case, n, ids)
+            finally:
+                process.terminate()
+                process.wait()
+            report['peak_rss_kb']['gunicorn'] = peak_rss_kb(children=True)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+Calibrate the password KDF and measure logins per second per core.
+
+    $ python benchmarks/bench_passwords.py [--target-ms 50] [--kdf scrypt|argon2] [--seconds 5]
+
+First finds the cost parameters whose single hash takes about --target-ms on
+this machine and prints them as the environment variables credentials.py
+reads. Then, with those parameters, runs verify_password() from 1 thread and
+from one thread per core through the bounded pool and reports logins/s in
+total and per core. Run it on the production hardware.
+"""
+import argparse
+import os
+import threading
+import time
+import common  # noqa: F401, puts src/ on sys.path
+
+
+def timed_hash(kdf, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        kdf.hash('correct horse battery staple')
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def calibrate(name, target):
+    """Cheapest parameters reaching `target` seconds, as env variables."""
+    import credentials
+    if name == 'scrypt':
+        # memory and time both grow with n = 2**ln, r and p stay at the RFC 7914 defaults
+        ln = 10
+        while timed_hash(credentials.Scrypt(ln=ln)) < target and ln < 20:
+            ln += 1
+        return {'PASSWORD_KDF': 'scrypt', 'PASSWORD_SCRYPT_LN': ln, 'PASSWORD_SCRYPT_R': 8,
+                'PASSWORD_SCRYPT_P': 1}
+    # OWASP minimum of 19 MiB, then more passes until the target is reached
+    memory, passes = 19456, 1
+    while timed_hash(credentials.Argon2(time_cost=passes, memory_cost=memory)) < target and passes < 10:
+        passes += 1
+    return {'PASSWORD_KDF': 'argon2', 'PASSWORD_ARGON2_TIME': passes, 'PASSWORD_ARGON2_MEMORY': memory,
+            'PASSWORD_ARGON2_PARALLELISM': 1}
+
+
+def logins_per_second(verify, stored, threads, seconds):
+    done = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        count = 0
+        while time.monotonic() < deadline:
+            verify(stored, 'correct horse battery staple')
+            count += 1
+        with lock:
+            done[0] += count
+
+    workers = [threading.Thread(target=client) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return done[0] / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target-ms', type=float, default=50, help='time per hash to calibrate to')
+    parser.add_argument('--kdf', choices=('scrypt', 'argon2'))
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    import credentials
+    name = args.kdf or credentials.settings()['PASSWORD_KDF']
+    env = calibrate(name, args.target_ms / 1000)
+    print('# calibrated for', f'{args.target_ms:g} ms per hash')
+    for key, value in env.items():
+        print(f'{key}={value}')
+
+    # the app's KDF and pool, with the calibrated parameters
+    passwords = credentials.from_config({**credentials.settings(), **env})
+    stored = passwords.hash('correct horse battery staple')
+    print(f'hash: {timed_hash(passwords.kdf) * 1000:.1f} ms')
+
+    cores = os.cpu_count() or 1
+    print(f"{'threads':>8}{'logins/s':>12}{'per core':>12}")
+    for threads in sorted({1, cores}):
+        rate = logins_per_second(passwords.verify_and_update, stored, threads, args.seconds)
+        print(f'{threads:>8}{rate:>12.1f}{rate / min(threads, cores):>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Read-replica routing with two SQLite files: a primary and a stale copy.
+
+    $ python benchmarks/bench_replicas.py [--users 2000] [--cars 500] [--favs 10] [--requests 500]
+
+Seeds the primary, copies the file as the replica, which from then on
+plays a replica that stopped replicating, and sets DATABASE_REPLICA_URLS
+to it. Then it checks through the test client that
+- a car written to the primary afterwards is not found by a plain reader,
+  the GET went to the replica,
+- the client that wrote it finds it right away (read-your-writes: pinned
+  to the primary for REPLICA_MAX_LAG, by address and by cookie),
+- a client carrying only the writer's cookie reads from the primary too.
+Last, it times GET /cars?limit=100 and GET /cars/<id> for a replica reader
+and for a pinned one. Both files are local, so the times are the routing
+overhead, not a replica's.
+"""
+import argparse
+import os
+import shutil
+import time
+from common import use_database, seed, percentile
+
+os.environ.setdefault('CACHE_ENABLED', '0')
+os.environ.setdefault('AUTH_REQUIRED', '0')
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+# the writer stays pinned for the whole run
+os.environ.setdefault('REPLICA_MAX_LAG', '3600')
+
+READER = {'REMOTE_ADDR': '10.0.0.1'}
+WRITER = {'REMOTE_ADDR': '10.0.0.2'}
+
+
+def timed(client, path, environ, n):
+    times = []
+    for _ in range(n):
+        start = time.perf_counter()
+        response = client.get(path, environ_base=environ)
+        times.append(time.perf_counter() - start)
+        assert response.status_code == 200, (path, response.status_code)
+    times.sort()
+    return percentile(times, 0.5), percentile(times, 0.99)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--cars', type=int, default=500)
+    parser.add_argument('--favs', type=int, default=10, help='favourites per user')
+    parser.add_argument('--requests', type=int, default=500)
+    args = parser.parse_args()
+
+    primary = use_database()
+    replica = primary.replace('bench.db', 'replica.db')
+    os.environ['DATABASE_REPLICA_URLS'] = replica
+    from app import create_app
+    from models import db
+    app = create_app({'ADMIN_ENABLED': False})
+
+    with app.app_context():
+        seed(db, args.users, args.cars, args.favs)
+        db.session.remove()
+    shutil.copyfile(primary[len('sqlite:///'):], replica[len('sqlite:///'):])
+
+    reader = app.test_client()
+    writer = app.test_client()
+    response = writer.post('/cars', json={'model': 'new', 'year': 2026, 'name': 'primary only'},
+                           environ_base=WRITER)
+    assert response.status_code == 201, response.status_code
+    car = f"/cars/{response.get_json()['id']}"
+
+    # a new client from the reader's address, only carrying the writer's cookie
+    carrier = app.test_client()
+    carrier.set_cookie('db_primary_until', writer.get_cookie('db_primary_until').value)
+    checks = [
+        ('reader goes to the replica', reader.get(car, environ_base=READER).status_code == 404),
+        ('writer reads its write', writer.get(car, environ_base=WRITER).status_code == 200),
+        ('the cookie alone pins', carrier.get(car, environ_base=READER).status_code == 200),
+    ]
+    for label, ok in checks:
+        print(f"{label:<28}{'ok' if ok else 'FAILED'}")
+
+    print(f"{'path':<18}{'client':<10}{'p50 ms':>9}{'p99 ms':>9}")
+    for path in ('/cars?limit=100', '/cars/1'):
+        for label, client, environ in (('replica', reader, READER), ('pinned', writer, WRITER)):
+            p50, p99 = timed(client, path, environ, args.requests)
+            print(f'{path:<18}{label:<10}{p50 * 1000:>9.2f}{p99 * 1000:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
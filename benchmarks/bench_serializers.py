@@ -0,0 +1,81 @@
+"""
+Micro-benchmark: ORM serialize() vs the column serializers in src/serializers.py
+
+    $ python benchmarks/bench_serializers.py [--users 2000] [--cars 500] [--favs 10]
+
+Seeds a throw-away SQLite database, then for every model times
+  - orm:     select(Model) with the eager loaders + serialize() + stdlib json
+  - rows:    serializers.<MODEL> on Core rows + stdlib json
+  - rows+fast: same rows encoded by FastJSONProvider (orjson if installed)
+and checks that the three outputs are byte-identical.
+"""
+import argparse
+import time
+from common import use_database, seed
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--cars', type=int, default=500)
+    parser.add_argument('--favs', type=int, default=10, help='favourites per user')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    use_database()
+
+    from sqlalchemy import select
+    from flask.json.provider import DefaultJSONProvider
+    from app import create_app
+    from models import db, User, Profile, Car, Favourite
+    import loaders
+    import serializers
+    app = create_app()
+
+    cases = [
+        ('User', User, loaders.USER_DETAIL, serializers.USER),
+        ('Profile', Profile, (), serializers.PROFILE),
+        ('Car', Car, loaders.CAR, serializers.CAR),
+        ('Favourite', Favourite, loaders.FAVOURITE, serializers.FAVOURITE),
+    ]
+
+    with app.app_context():
+        seed(db, args.users, args.cars, args.favs)
+        stdlib = DefaultJSONProvider(app)
+        fast = app.json
+        print(f"json engine: {'orjson' if fast.fast else 'stdlib'}")
+        print(f"{'model':<10}{'rows':>8}{'orm ms':>10}{'rows ms':>10}{'fast ms':>10}{'speedup':>9}  identical")
+
+        for name, model, options, serializer in cases:
+            def orm():
+                db.session.expunge_all()
+                objs = db.session.execute(select(model).options(*options).order_by(model.id)).scalars().all()
+                return stdlib.response([obj.serialize() for obj in objs]).get_data()
+
+            def rows(provider):
+                def run():
+                    db.session.expunge_all()
+                    result = db.session.execute(serializer.base.order_by(serializer.base.selected_columns[0])).all()
+                    return provider.response([item for _, item in serializer.items(result)]).get_data()
+                return run
+
+            orm_time, orm_out = timed(orm, args.repeat)
+            rows_time, rows_out = timed(rows(stdlib), args.repeat)
+            fast_time, fast_out = timed(rows(fast), args.repeat)
+            count = db.session.query(model).count()
+            identical = orm_out == rows_out == fast_out
+            print(f"{name:<10}{count:>8}{orm_time * 1000:>10.1f}{rows_time * 1000:>10.1f}"
+                  f"{fast_time * 1000:>10.1f}{orm_time / fast_time:>8.1f}x  {identical}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Cold start: import time and time to first request.
+
+    $ python benchmarks/bench_startup.py [--runs 5] [--gunicorn] [--workers 2] [--importtime 15]
+
+Every run is a fresh interpreter that imports app.py, calls create_app()
+and sends its first request (GET /cars?limit=1, which opens the first
+database connection) through the test client. The medians are printed for
+each set of optional parts: none of them, the defaults, and all of them
+(admin, migrations).
+
+--gunicorn also times `gunicorn wsgi` from spawn to the first answered
+request, with and without preloading (gunicorn.conf.py). --importtime N
+lists the N modules that cost the most to import, from `python -X importtime`.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from common import ROOT, use_database, seed
+
+VARIANTS = [
+    ('minimal', {'ADMIN_ENABLED': '0', 'MIGRATIONS_ENABLED': '0'}),
+    ('default', {}),
+    ('full', {'ADMIN_ENABLED': '1', 'MIGRATIONS_ENABLED': '1'}),
+]
+
+# runs in the child, prints seconds for each step as JSON
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+sys.path.insert(0, 'src')
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+response = application.test_client().get('/cars?limit=1')
+assert response.status_code == 200, response.status_code
+answered = time.perf_counter()
+print(json.dumps({'import': imported - start, 'create_app': created - imported,
+                  'first_request': answered - created, 'total': answered - start}))
+"""
+
+
+def probe(env):
+    output = subprocess.run([sys.executable, '-c', PROBE], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def wait_until_up(base, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base + '/cars?limit=1', timeout=1).read()
+            return
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.01)
+    raise RuntimeError(f'{base} did not start')
+
+
+def gunicorn_start(env, workers, port):
+    start = time.perf_counter()
+    process = subprocess.Popen(['gunicorn', 'wsgi', '--chdir', 'src', '-w', str(workers), '-b', f'127.0.0.1:{port}'],
+                               cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(f'http://127.0.0.1:{port}')
+        return time.perf_counter() - start
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def import_times(env, top):
+    """(cumulative µs, module) of the slowest imports under app."""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', "import sys; sys.path.insert(0, 'src'); import app"],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per variant')
+    parser.add_argument('--database-url', help='e.g. a local PostgreSQL, SQLite by default')
+    parser.add_argument('--gunicorn', action='store_true', help='also time gunicorn startup')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--port', type=int, default=8404)
+    parser.add_argument('--importtime', type=int, default=0, metavar='N', help='list the N slowest imports')
+    args = parser.parse_args()
+
+    use_database(args.database_url)
+    env = dict(os.environ, CACHE_ENABLED='0', AUTH_REQUIRED='0', RATE_LIMIT_ENABLED='0', WEB_CONCURRENCY=str(args.workers))
+    from app import create_app
+    from models import db
+    with create_app({'ADMIN_ENABLED': False}).app_context():
+        seed(db, 100, 100, 2)
+
+    print(f'median of {args.runs} runs, ms')
+    print(f"{'variant':<10}{'import':>10}{'create_app':>12}{'1st request':>13}{'total':>10}")
+    for name, overrides in VARIANTS:
+        runs = [probe(dict(env, **overrides)) for _ in range(args.runs)]
+        medians = {key: statistics.median(run[key] for run in runs) * 1000 for key in runs[0]}
+        print(f"{name:<10}{medians['import']:>10.1f}{medians['create_app']:>12.1f}"
+              f"{medians['first_request']:>13.1f}{medians['total']:>10.1f}")
+
+    if args.gunicorn:
+        print(f'\ngunicorn, {args.workers} workers, spawn to first response, ms')
+        for preload in ('1', '0'):
+            times = [gunicorn_start(dict(env, GUNICORN_PRELOAD=preload), args.workers, args.port)
+                     for _ in range(args.runs)]
+            print(f"{'preload' if preload == '1' else 'no preload':<12}{statistics.median(times) * 1000:>10.1f}")
+
+    if args.importtime:
+        print('\nslowest imports (default variant), cumulative ms')
+        for cumulative, module in import_times(env, args.importtime):
+            print(f'{cumulative / 1000:>10.1f}  {module}')
+
+
+if __name__ == '__main__':
+    main()
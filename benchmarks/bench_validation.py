@@ -0,0 +1,95 @@
+"""
+Cost of validating one JSON body: compiled schemas against hand-written checks.
+
+    $ python benchmarks/bench_validation.py [--number 200000]
+
+For the POST /users and POST /cars bodies, valid and invalid, prints the
+nanoseconds per call of
+- `presence`: the `'email' not in data or ...` checks the views used to
+  make, which let wrong types through,
+- `typed`: the same plus the isinstance/length checks bulk.py used to make
+  item by item,
+- `schema`: schemas.USER / schemas.CAR, compiled by schemas.py.
+No database and no request, only the validation itself.
+"""
+import argparse
+import timeit
+import common  # noqa: F401, puts src/ on sys.path
+import schemas
+
+BODIES = {
+    'user': {'email': 'someone@example.com', 'password': 'correct horse', 'age': 30},
+    'user (bad age)': {'email': 'someone@example.com', 'password': 'correct horse', 'age': '30'},
+    'car': {'model': 'Corolla', 'year': 2019, 'name': 'Toyota'},
+    'car (extra key)': {'model': 'Corolla', 'year': 2019, 'name': 'Toyota', 'user_id': 1},
+}
+
+
+def presence_user(data):
+    if not data or 'email' not in data or 'password' not in data or 'age' not in data:
+        return None
+    return data
+
+
+def presence_car(data):
+    if not data or any(field not in data for field in ['model', 'year', 'name']):
+        return None
+    return data
+
+
+def _string(item, name, length):
+    value = item.get(name)
+    if not isinstance(value, str) or not value or len(value) > length:
+        raise ValueError(name)
+    return value
+
+
+def _integer(item, name):
+    value = item.get(name)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(name)
+    return value
+
+
+def typed_user(data):
+    if not isinstance(data, dict):
+        raise ValueError
+    return {'email': _string(data, 'email', 120), 'password': _string(data, 'password', 128),
+            'age': _integer(data, 'age')}
+
+
+def typed_car(data):
+    if not isinstance(data, dict):
+        raise ValueError
+    return {'model': _string(data, 'model', 20), 'year': _integer(data, 'year'), 'name': _string(data, 'name', 20)}
+
+
+VALIDATORS = {
+    'user': {'presence': presence_user, 'typed': typed_user, 'schema': schemas.USER.validate},
+    'car': {'presence': presence_car, 'typed': typed_car, 'schema': schemas.CAR.validate},
+}
+
+
+def per_call(validate, body, number):
+    def run():
+        try:
+            validate(body)
+        except (ValueError, schemas.Invalid):
+            pass
+    return min(timeit.repeat(run, number=number, repeat=3)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=200000, help='calls per measurement')
+    args = parser.parse_args()
+
+    print(f"{'body':<18}{'presence ns':>13}{'typed ns':>11}{'schema ns':>12}")
+    for label, body in BODIES.items():
+        validators = VALIDATORS[label.split()[0]]
+        times = [per_call(validators[name], body, args.number) * 1e9 for name in ('presence', 'typed', 'schema')]
+        print(f'{label:<18}' + ''.join(f'{t:>{w}.0f}' for t, w in zip(times, (13, 11, 12))))
+
+
+if __name__ == '__main__':
+    main()
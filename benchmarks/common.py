@@ -0,0 +1,66 @@
+"""
+Helpers shared by the benchmark scripts: seeding and statistics.
+
+The scripts run from a checkout (`python benchmarks/<script>.py`), this
+module puts src/ on sys.path for them.
+"""
+import os
+import random
+import resource
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+
+def use_database(url=None):
+    """Point DATABASE_URL at `url` or at a new SQLite file, before app is imported."""
+    if url is None:
+        url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}"
+    os.environ['DATABASE_URL'] = url
+    return url
+
+
+def seed(db, users, cars, favs_per_user, profiles=0.5):
+    """Recreate every table with deterministic rows.
+
+    `profiles` is the fraction of users that get a profile.
+    """
+    from sqlalchemy import insert
+    from models import User, Profile, Car, Favourite
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(1)
+    db.session.execute(insert(User), [
+        {'email': f'user{i}@example.com', 'password': 'x', 'age': 18 + i % 60} for i in range(users)])
+    db.session.execute(insert(Car), [
+        {'model': f'model{i % 40}', 'year': 1990 + i % 35, 'name': f'car{i}'} for i in range(cars)])
+    step = round(1 / profiles) if profiles else 0
+    if step:
+        db.session.execute(insert(Profile), [
+            {'user_id': i + 1, 'title': 'driver', 'bio': 'bio'} for i in range(0, users, step)])
+    if favs_per_user and cars:
+        db.session.execute(insert(Favourite), [
+            {'user_id': u + 1, 'car_id': c + 1}
+            for u in range(users)
+            for c in rng.sample(range(cars), min(favs_per_user, cars))])
+    db.session.commit()
+    # rows inserted behind the API's back, count their favourites and
+    # render GET /users/<id> for them
+    from counters import reconcile_favourite_counts
+    from dashboards import rebuild
+    reconcile_favourite_counts()
+    rebuild()
+
+
+def percentile(values, p):
+    """`values` sorted, p in [0, 1]."""
+    return values[min(len(values) - 1, int(len(values) * p))] if values else float('nan')
+
+
+def peak_rss_kb(children=False):
+    """Peak resident set size of this process (or of its waited-for children)."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # bytes on macOS, kilobytes everywhere else
+    return usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
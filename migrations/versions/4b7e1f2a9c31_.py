@@ -0,0 +1,31 @@
+"""index filter columns used by the collection endpoints
+
+Revision ID: 4b7e1f2a9c31
+Revises: 3072bf7e8b89
+Create Date: 2026-10-17 09:12:40.118204
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '4b7e1f2a9c31'
+down_revision = '3072bf7e8b89'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_users_age'), ['age'], unique=False)
+
+    with op.batch_alter_table('cars', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_cars_year'), ['year'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('cars', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_cars_year'))
+
+    with op.batch_alter_table('users', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_users_age'))
@@ -0,0 +1,42 @@
+"""updated_at on every table, for conditional GETs
+
+Revision ID: 7c2d9e4f1b58
+Revises: 4b7e1f2a9c31
+Create Date: 2026-10-17 16:31:05.402913
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c2d9e4f1b58'
+down_revision = '4b7e1f2a9c31'
+branch_labels = None
+depends_on = None
+
+TABLES = ('users', 'profiles', 'cars', 'favourites')
+
+
+def upgrade():
+    # added nullable and backfilled first: SQLite refuses ADD COLUMN with a
+    # non-constant default, and existing rows need a value before NOT NULL
+    for table in TABLES:
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+
+        op.execute(sa.text(f'UPDATE {table} SET updated_at = CURRENT_TIMESTAMP'))
+
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.alter_column('updated_at',
+                   existing_type=sa.DateTime(),
+                   nullable=False,
+                   server_default=sa.func.now())
+            batch_op.create_index(batch_op.f(f'ix_{table}_updated_at'), ['updated_at'], unique=False)
+
+
+def downgrade():
+    for table in reversed(TABLES):
+        with op.batch_alter_table(table, schema=None) as batch_op:
+            batch_op.drop_index(batch_op.f(f'ix_{table}_updated_at'))
+            batch_op.drop_column('updated_at')
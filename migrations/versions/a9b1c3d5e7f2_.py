@@ -0,0 +1,37 @@
+"""search indexes on users and cars
+
+Revision ID: a9b1c3d5e7f2
+Revises: f4a6c8d0e2b9
+Create Date: 2026-10-17 19:05:12.530418
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a9b1c3d5e7f2'
+down_revision = 'f4a6c8d0e2b9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # only PostgreSQL searches in the database, others use search.LocalSearch
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute(sa.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    op.execute(sa.text('CREATE INDEX ix_users_email_trgm ON users USING gin (email gin_trgm_ops)'))
+    op.execute(sa.text('CREATE INDEX ix_users_email_lower_prefix ON users (lower(email) text_pattern_ops)'))
+    # same expression as search.CARS_TSVECTOR
+    op.execute(sa.text(
+        "CREATE INDEX ix_cars_search ON cars USING gin (to_tsvector('simple', name || ' ' || model))"
+    ))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute(sa.text('DROP INDEX IF EXISTS ix_cars_search'))
+    op.execute(sa.text('DROP INDEX IF EXISTS ix_users_email_lower_prefix'))
+    op.execute(sa.text('DROP INDEX IF EXISTS ix_users_email_trgm'))
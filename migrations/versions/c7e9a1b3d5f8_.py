@@ -0,0 +1,32 @@
+"""user dashboards
+
+Revision ID: c7e9a1b3d5f8
+Revises: b3d5f7a9c1e4
+Create Date: 2026-10-17 21:12:05.418330
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7e9a1b3d5f8'
+down_revision = 'b3d5f7a9c1e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # filled by `flask rebuild-dashboards`, GET /users/<id> serializes on the fly until then
+    op.create_table('user_dashboards',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('body', sa.Text(), nullable=False),
+    sa.Column('compact', sa.Text(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id')
+    )
+
+
+def downgrade():
+    op.drop_table('user_dashboards')
@@ -0,0 +1,32 @@
+"""table versions
+
+Revision ID: d1f3a5c7e9b2
+Revises: c7e9a1b3d5f8
+Create Date: 2026-10-17 23:41:27.093518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd1f3a5c7e9b2'
+down_revision = 'c7e9a1b3d5f8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_versions = op.create_table('table_versions',
+    sa.Column('name', sa.String(length=40), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # the tables versions.py counts the writes of
+    op.bulk_insert(table_versions, [
+        {'name': name, 'version': 0} for name in ('users', 'profiles', 'cars', 'favourites')
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
@@ -0,0 +1,27 @@
+"""cars top index in the order of GET /cars/top
+
+Revision ID: e5b7d9f1a3c6
+Revises: d1f3a5c7e9b2
+Create Date: 2026-10-18 00:22:51.604137
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b7d9f1a3c6'
+down_revision = 'd1f3a5c7e9b2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # ORDER BY favourite_count DESC, id: mixed directions need a matching index
+    op.drop_index('ix_cars_favourite_count_id', table_name='cars')
+    op.create_index('ix_cars_favourite_count_id', 'cars', [sa.text('favourite_count DESC'), 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_cars_favourite_count_id', table_name='cars')
+    op.create_index('ix_cars_favourite_count_id', 'cars', ['favourite_count', 'id'], unique=False)
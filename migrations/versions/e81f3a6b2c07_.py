@@ -0,0 +1,35 @@
+"""unique (user_id, car_id) and FK indexes on favourites
+
+Revision ID: e81f3a6b2c07
+Revises: 7c2d9e4f1b58
+Create Date: 2026-10-17 17:02:18.553410
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81f3a6b2c07'
+down_revision = '7c2d9e4f1b58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # keep the oldest of every duplicated pair, the unique index can't be
+    # built while they exist
+    op.execute(sa.text(
+        'DELETE FROM favourites WHERE id NOT IN '
+        '(SELECT min_id FROM (SELECT MIN(id) AS min_id FROM favourites GROUP BY user_id, car_id) AS keep)'
+    ))
+
+    with op.batch_alter_table('favourites', schema=None) as batch_op:
+        batch_op.create_index('ix_favourites_user_id_car_id', ['user_id', 'car_id'], unique=True)
+        batch_op.create_index(batch_op.f('ix_favourites_car_id'), ['car_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('favourites', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_favourites_car_id'))
+        batch_op.drop_index('ix_favourites_user_id_car_id')
@@ -0,0 +1,35 @@
+"""favourite_count on cars
+
+Revision ID: f4a6c8d0e2b9
+Revises: e81f3a6b2c07
+Create Date: 2026-10-17 18:20:44.117052
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f4a6c8d0e2b9'
+down_revision = 'e81f3a6b2c07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('cars', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('favourite_count', sa.Integer(), server_default='0', nullable=False))
+
+    op.execute(sa.text(
+        'UPDATE cars SET favourite_count = '
+        '(SELECT COUNT(*) FROM favourites WHERE favourites.car_id = cars.id)'
+    ))
+
+    with op.batch_alter_table('cars', schema=None) as batch_op:
+        batch_op.create_index('ix_cars_favourite_count_id', ['favourite_count', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('cars', schema=None) as batch_op:
+        batch_op.drop_index('ix_cars_favourite_count_id')
+        batch_op.drop_column('favourite_count')
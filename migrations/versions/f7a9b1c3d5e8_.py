@@ -0,0 +1,47 @@
+"""table versions slots
+
+Revision ID: f7a9b1c3d5e8
+Revises: e5b7d9f1a3c6
+Create Date: 2026-10-18 01:12:40.318264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f7a9b1c3d5e8'
+down_revision = 'e5b7d9f1a3c6'
+branch_labels = None
+depends_on = None
+
+TABLES = ('users', 'profiles', 'cars', 'favourites')
+SLOTS = 16
+
+
+def upgrade():
+    with op.batch_alter_table('table_versions', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('slot', sa.Integer(), nullable=False, server_default='0'))
+        batch_op.drop_constraint('table_versions_pkey', type_='primary')
+        batch_op.create_primary_key('table_versions_pkey', ['name', 'slot'])
+        batch_op.alter_column('slot', server_default=None)
+
+    # the current counters stay in slot 0, the sums keep growing from there
+    table_versions = sa.table('table_versions',
+        sa.column('name', sa.String), sa.column('slot', sa.Integer), sa.column('version', sa.BigInteger))
+    op.bulk_insert(table_versions, [
+        {'name': name, 'slot': slot, 'version': 0} for name in TABLES for slot in range(1, SLOTS)
+    ])
+
+
+def downgrade():
+    # fold the slots back into one row per table
+    op.execute(
+        'UPDATE table_versions SET version = (SELECT sum(t.version) FROM table_versions t'
+        ' WHERE t.name = table_versions.name) WHERE slot = 0'
+    )
+    op.execute('DELETE FROM table_versions WHERE slot <> 0')
+    with op.batch_alter_table('table_versions', schema=None) as batch_op:
+        batch_op.drop_constraint('table_versions_pkey', type_='primary')
+        batch_op.create_primary_key('table_versions_pkey', ['name'])
+        batch_op.drop_column('slot')
@@ -1,131 +1,312 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
+
+The app is built by create_app(), nothing happens at import time:
+
+    $ flask --app app run                      # FLASK_APP=src/app.py finds create_app()
+    $ gunicorn wsgi --chdir src                # reads src/gunicorn.conf.py
+
+The routes live on the `api` blueprint. The heavy optional parts are only
+loaded when they are used:
+- Flask-Admin (/admin/), unless ADMIN_ENABLED=0,
+- Flask-Migrate (alembic), only for the `flask` command line, where
+  `flask db ...` needs it, or with MIGRATIONS_ENABLED=1.
+With DATABASE_REPLICA_URLS the read-only GET routes query replicas, see
+replicas.py.
+GET / and GET /openapi.json are built once by documents.init_app().
+Run benchmarks/bench_startup.py to see what each one costs.
 """
 import os
-from sqlalchemy import select
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+import click
+from collections import Counter
+from sqlalchemy import select, literal, delete
+from sqlalchemy.exc import IntegrityError
+from flask import Flask, Blueprint, request, jsonify, g
 from flask_cors import CORS
-from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Profile, Car, Favourite
+from utils import APIException
+from models import db, User, Profile, Car, Favourite, insert_ignore, utcnow
+from loaders import load_one, USER_DETAIL, CAR, FAVOURITE
+from listing import respond, shape, json_response, USERS, PROFILES, CARS, FAVOURITES
+from serializers import FastJSONProvider
+from auth import authenticated, operator, issue_token, revoke, is_admin, require_user, require_admin
+from counters import adjust_favourite_counts, top_cars, reconcile_favourite_counts, TOP_DEFAULT, TOP_MAX
+from credentials import hash_password, verify_password
+from search import search_request
+from schemas import validated
+import schemas
+from replicas import read_replica
+import replicas
+import outbox
+import dashboards
+from bulk import bulk, UserBulk, CarBulk, FavouriteBulk
+import serializers
+import database
+import instrumentation
+import documents
+import compression
+import ratelimit
+import auth
+import credentials
+import cache
+from conditional import conditional
+import conditional as validators
+from cache import cached, invalidate, tag, user_tags, profile_tags, car_tags, favourite_tags
 #from models import Person
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
+api = Blueprint('api', __name__, cli_group=None)
+
+
+def _flag(name, default):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value not in ('0', 'false')
 
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace("postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+def settings():
+    """Configuration read from the environment.
+
+    The parts with settings of their own (auth, passwords, the response
+    cache, compression, rate limits, metrics) document their variables and
+    defaults in their settings(); create_app(config) overrides any key, and
+    their init_app() reads them from app.config.
+    """
+    db_url = os.getenv("DATABASE_URL")
+    if db_url is not None:
+        db_url = db_url.replace("postgres://", "postgresql://")
+    else:
+        db_url = "sqlite:////tmp/test.db"
+    return {
+        'SQLALCHEMY_DATABASE_URI': db_url,
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SQLALCHEMY_BINDS': replicas.binds(),
+        'ADMIN_ENABLED': _flag('ADMIN_ENABLED', True),
+        # None: only when the app is loaded by the `flask` command line
+        'MIGRATIONS_ENABLED': _flag('MIGRATIONS_ENABLED', None),
+        **auth.settings(),
+        **credentials.settings(),
+        **cache.settings(),
+        **compression.settings(),
+        **ratelimit.settings(),
+        **instrumentation.settings(),
+    }
+
+
+def create_app(config=None):
+    """Build the app, `config` overrides settings()."""
+    app = Flask(__name__)
+    app.json = FastJSONProvider(app)
+    app.url_map.strict_slashes = False
+    app.config.update(settings())
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS',
+                          database.engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    # request.remote_addr is the client's behind TRUSTED_PROXY_HOPS proxies
+    app.wsgi_app = ratelimit.proxy_fix(app.wsgi_app, app.config['TRUSTED_PROXY_HOPS'])
+    auth.init_app(app)
+    credentials.init_app(app)
+    cache.init_app(app)
+
+    db.init_app(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            database.instrument(engine)
+        instrumentation.init_app(app, *db.engines.values())
+    CORS(app)
+    compression.init_app(app)
+    ratelimit.init_app(app)
+    replicas.init_app(app)
+    app.register_blueprint(api)
+
+    migrations = app.config['MIGRATIONS_ENABLED']
+    if migrations is None:
+        migrations = click.get_current_context(silent=True) is not None
+    if migrations:
+        from flask_migrate import Migrate
+        Migrate(app, db)
+    if app.config['ADMIN_ENABLED']:
+        from admin import setup_admin
+        setup_admin(app)
+    documents.init_app(app)
+    return app
+
 
 # Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
+@api.app_errorhandler(APIException)
 def handle_invalid_usage(error):
     return jsonify(error.to_dict()), error.status_code
 
+# connection pool of this worker, see database.py
+@api.route('/db/pool', methods=['GET'])
+@operator
+def get_pool_status():
+    return jsonify(database.pool_status(db.engine)), 200
+
 # generate sitemap with all your endpoints
-@app.route('/')
+@api.route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return documents.serve('sitemap')
+
+# OpenAPI description of every route
+@api.route('/openapi.json', methods=['GET'])
+def get_openapi():
+    return documents.serve('openapi')
 
 
 # GET ALL USERS ----->
-@app.route('/users', methods=['GET'])   
+@api.route('/users', methods=['GET'])
+@authenticated
+@read_replica
+@conditional(validators.users)
+@cached
 def get_users():
-    stmt = select(User)
-    users = db.session.execute(stmt).scalars().all()
-    return jsonify([user.serialize() for user in users]), 200
+    return respond(USERS), 200
 
 
 # GET SINGLE USER ----->
-@app.route('/users/<int:user_id>', methods=['GET'])
+@api.route('/users/<int:user_id>', methods=['GET'])
+@authenticated
+@read_replica
+@conditional(validators.user)
+@cached
 def get_user(user_id):
-    stmt = select(User).where(User.id == user_id)
-    user = db.session.execute(stmt).scalar_one_or_none()
+    # pre-rendered, kept up to date by the writes (dashboards.py)
+    response = dashboards.response(user_id)
+    if response is not None:
+        tag(f'user:{user_id}')
+        return response, 200
+    user = serializers.USER.one(User.id == user_id)
     if user is None:
         return jsonify({'error':'User not found'}), 404
-    return jsonify(user.serialize()),200
+    tag(*user_tags(user))
+    return json_response(shape(user)),200
 
 
 # POST USER ------->
-@app.route('/users', methods=['POST'])
-def create_user():
-    data = request.get_json()
-    if not data or 'email' not in data or 'password' not in data or 'age' not in data:
-        return jsonify({'error':'Missing data'}), 400
-
+@api.route('/users', methods=['POST'])
+@validated(schemas.USER)
+def create_user(data):
     # Crear usuario
     new_user = User(
         email=data['email'],
-        password=data['password'],
+        password=hash_password(data['password']),
         age=data['age']
     )
 
     db.session.add(new_user)
+    db.session.flush()
+    dashboards.refresh([new_user.id])
     db.session.commit()
+    invalidate('users')
 
+    new_user = load_one(User, USER_DETAIL, User.id == new_user.id)
     return jsonify(new_user.serialize()), 200
 
+# LOGIN ------->
+@api.route('/login', methods=['POST'])
+@validated(schemas.LOGIN)
+def login(data):
+    user = db.session.execute(select(User).where(User.email == data['email'])).scalar_one_or_none()
+    if user is None:
+        return jsonify({'error':'Invalid email or password'}), 401
+    valid, new_hash = verify_password(user.password, data['password'])
+    if not valid:
+        return jsonify({'error':'Invalid email or password'}), 401
+    if new_hash is not None:
+        # hashed with older parameters, upgraded now that we have the password
+        user.password = new_hash
+        db.session.commit()
+    return jsonify({'id': user.id, 'email': user.email,
+                    'token': issue_token(user.id, admin=is_admin(user.email))}), 200
+
+# LOGOUT ------->
+@api.route('/logout', methods=['POST'])
+@authenticated
+def logout():
+    if 'token' in g:
+        revoke(g.token)
+    return jsonify({'message':'logged out'}), 200
+
+# POST MANY USERS ------->
+@api.route('/users/bulk', methods=['POST'])
+@authenticated
+def create_users_bulk():
+    require_admin()
+    return bulk(UserBulk)
+
 # DELETE USER 
-@app.route('/users/<int:user_id>', methods=['DELETE'])
+@api.route('/users/<int:user_id>', methods=['DELETE'])
+@authenticated
 def delete_user(user_id):
+    require_user(user_id)
     stmt = select(User).where(User.id == user_id)
     user = db.session.execute(stmt).scalar_one_or_none()
     if user is None:
         return jsonify({'error':'User not found'}), 404
+    favourites = _delete_favourites(Favourite.user_id == user_id)
+    dashboards.forget(user_id)
     if user.profile:
         db.session.delete(user.profile)
     db.session.delete(user)
+    if not _flushed():
+        return jsonify({'error': 'The user changed meanwhile, try again'}), 409
+    outbox.record('favourite', 'deleted', favourites)
     db.session.commit()
+    invalidate(f'user:{user_id}', 'users', 'profiles', *_favourite_tags(favourites))
     return jsonify({'message':'user deleted'}),200
 
 # PUT USER
-@app.route('/users/<int:user_id>', methods=['PUT'])
-def update_user(user_id):
-    data = request.get_json()
+@api.route('/users/<int:user_id>', methods=['PUT'])
+@authenticated
+@validated(schemas.USER_UPDATE)
+def update_user(user_id, data):
+    require_user(user_id)
     stmt = select(User).where(User.id == user_id)
     user = db.session.execute(stmt).scalar_one_or_none()
     if user is None:
         return jsonify({'error':'User not found'}), 404
     user.email = data.get('email',user.email)
     user.age = data.get('age',user.age)
-    user.password = data.get('password',user.password)
+    if 'password' in data:
+        user.password = hash_password(data['password'])
+    dashboards.refresh([user_id])
     db.session.commit()
+    invalidate(f'user:{user_id}', 'users')
+    user = load_one(User, USER_DETAIL, User.id == user_id)
     return jsonify(user.serialize()),200
 
 
 # GET ALL PROFILES
-@app.route('/users/profile', methods=['GET'])   
+@api.route('/users/profile', methods=['GET'])
+@authenticated
+@read_replica
+@conditional(validators.profiles)
+@cached
 def get_users_profile():
-    stmt = select(Profile)
-    users = db.session.execute(stmt).scalars().all()
-    return jsonify([user.serialize() for user in users]), 200
+    return respond(PROFILES), 200
 
 
 
 # GET SINGLE USER PROFILE ----->
-@app.route('/users/<int:user_id>/profile', methods=['GET'])
+@api.route('/users/<int:user_id>/profile', methods=['GET'])
+@authenticated
+@read_replica
+@conditional(validators.profile)
+@cached
 def get_single_user_profile(user_id):
-    stmt = select(Profile).where(Profile.user_id == user_id)
-    user = db.session.execute(stmt).scalar_one_or_none()
+    user = serializers.PROFILE.one(Profile.user_id == user_id)
     if user is None:
         return jsonify({'error':'User not found'}), 404
-    return jsonify(user.serialize()),200
+    tag(*profile_tags(user))
+    return jsonify(user),200
 
 
 # PUT SINGLE USER PROFILE ------>
-@app.route('/users/<int:user_id>/profile', methods=['PUT'])
-def update_user_profile(user_id):
-    data = request.get_json()
+@api.route('/users/<int:user_id>/profile', methods=['PUT'])
+@authenticated
+@validated(schemas.PROFILE_UPDATE)
+def update_user_profile(user_id, data):
+    require_user(user_id)
     stmt = select(User).where(User.id == user_id)
     user = db.session.execute(stmt).scalar_one_or_none()
     
@@ -136,13 +317,17 @@ def update_user_profile(user_id):
     
     user.profile.title = data.get('title',user.profile.title)
     user.profile.bio = data.get('bio',user.profile.bio)
+    dashboards.refresh([user_id])
     db.session.commit()
+    invalidate(f'user:{user_id}', 'profiles')
     return jsonify(user.profile.serialize()),200
 
 
 # DELETE USER PROFILE ------>
-@app.route('/users/<int:user_id>/profile', methods=['DELETE'])
+@api.route('/users/<int:user_id>/profile', methods=['DELETE'])
+@authenticated
 def delete_user_profile(user_id):
+    require_user(user_id)
     stmt = select(User).where(User.id == user_id)
     user = db.session.execute(stmt).scalar_one_or_none()
 
@@ -153,18 +338,18 @@ def delete_user_profile(user_id):
         return jsonify({'error': 'This user do not have a profile'}), 404
 
     db.session.delete(user.profile)
+    dashboards.refresh([user_id])
     db.session.commit()
+    invalidate(f'user:{user_id}', 'profiles')
 
     return jsonify({'message': 'User profile deleted'}), 200
 
 # POST SINGLE USE PROFILE ------> 
-@app.route('/users/<int:user_id>/profile', methods=['POST'])
-def create_user_profile(user_id):
-    data = request.get_json()
-
-    if not data or 'title' not in data or 'bio' not in data:
-        return jsonify({'error':'Missing data'}), 400
-    
+@api.route('/users/<int:user_id>/profile', methods=['POST'])
+@authenticated
+@validated(schemas.PROFILE)
+def create_user_profile(user_id, data):
+    require_user(user_id)
     stmt = select(User).where(User.id == user_id)
     user = db.session.execute(stmt).scalar_one_or_none()
     if user is None:
@@ -174,156 +359,351 @@ def create_user_profile(user_id):
     else:
         new_profile = Profile(title=data['title'], bio=data['bio'])
         user.profile = new_profile
+    dashboards.refresh([user_id])
     db.session.commit()
+    invalidate(f'user:{user_id}', 'profiles')
     return jsonify(user.profile.serialize()), 200
 
 # GET ALL CARS
-@app.route('/cars', methods=['GET'])   
+@api.route('/cars', methods=['GET'])
+@authenticated
+@read_replica
+@conditional(validators.cars)
+@cached
 def get_cars():
-    stmt = select(Car)
-    cars = db.session.execute(stmt).scalars().all()
-    return jsonify([car.serialize() for car in cars]), 200
+    return respond(CARS), 200
+
+# GET MOST FAVOURITED CARS
+@api.route('/cars/top', methods=['GET'])
+@authenticated
+@read_replica
+@conditional(validators.cars)
+@cached
+def get_top_cars():
+    try:
+        n = int(request.args.get('n', TOP_DEFAULT))
+    except ValueError:
+        raise APIException("Invalid value for 'n'", status_code=400)
+    if n < 1 or n > TOP_MAX:
+        raise APIException(f"'n' must be between 1 and {TOP_MAX}", status_code=400)
+    tag('cars', 'favourites')
+    return jsonify(top_cars(n)), 200
+
+# SEARCH USERS AND CARS
+@api.route('/search', methods=['GET'])
+@authenticated
+@read_replica
+def search_users_and_cars():
+    return jsonify(search_request(request.args)), 200
 
 #GET SINGLE CAR
-@app.route('/cars/<int:car_id>', methods=['GET'])
+@api.route('/cars/<int:car_id>', methods=['GET'])
+@authenticated
+@read_replica
+@conditional(validators.car)
+@cached
 def get_single_car(car_id):
-    stmt = select(Car).where(Car.id == car_id)
-    car = db.session.execute(stmt).scalar_one_or_none()
+    car = serializers.CAR.one(Car.id == car_id)
     if car is None:
         return jsonify({'error':'car not found'}), 404
-    return jsonify(car.serialize()),200
+    tag(*car_tags(car))
+    return json_response(shape(car)),200
 
 # POST CAR
-@app.route('/cars', methods=['POST'])
-def create_car():
-    data = request.get_json()
-    required_fields = ['model', 'year', 'name']
-
-    if not data or any(field not in data for field in required_fields):
-        return jsonify({'error': 'Missing data'}), 400
-
-    user_id = data.get('user_id')  # Puede venir o no
-
-    # Si viene user_id, validarlo
-    if user_id:
-        user = db.session.get(User, user_id)
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-
+@api.route('/cars', methods=['POST'])
+@authenticated
+@validated(schemas.CAR)
+def create_car(data):
     new_car = Car(
         name=data['name'],
         year=data['year'],
         model=data['model'],
-        user_id=user_id  # Esto puede ser None
     )
 
     db.session.add(new_car)
+    db.session.flush()
+    outbox.record('car', 'created', [outbox.car_payload(new_car)])
     db.session.commit()
+    invalidate('cars')
 
+    new_car = load_one(Car, CAR, Car.id == new_car.id)
     return jsonify(new_car.serialize()), 201
 
+# POST MANY CARS
+@api.route('/cars/bulk', methods=['POST'])
+@authenticated
+def create_cars_bulk():
+    return bulk(CarBulk)
+
 
 #DELETE CAR
-@app.route('/cars/<int:car_id>', methods=['DELETE'])
+@api.route('/cars/<int:car_id>', methods=['DELETE'])
+@authenticated
 def delete_car(car_id):
     stmt = select(Car).where(Car.id == car_id)
     car = db.session.execute(stmt).scalar_one_or_none()
     if car is None:
         return jsonify({'error':'car not found'}), 404
+    payload = outbox.car_payload(car)
+    favourites = _delete_favourites(Favourite.car_id == car_id)
     db.session.delete(car)
+    if not _flushed():
+        return jsonify({'error': 'The car changed meanwhile, try again'}), 409
+    dashboards.refresh({favourite['user_id'] for favourite in favourites})
+    outbox.record('favourite', 'deleted', favourites)
+    outbox.record('car', 'deleted', [payload])
     db.session.commit()
+    invalidate(f'car:{car_id}', 'cars', *_favourite_tags(favourites))
     return jsonify({'message':'user deleted'}),200
 
 
 
 # PUT SINGLE CAR ------>
-@app.route('/cars/<int:car_id>', methods=['PUT'])
-def update_car(car_id):
-    data = request.get_json()
+@api.route('/cars/<int:car_id>', methods=['PUT'])
+@authenticated
+@validated(schemas.CAR_UPDATE)
+def update_car(car_id, data):
     stmt = select(Car).where(Car.id == car_id)
     car = db.session.execute(stmt).scalar_one_or_none()
     
     if car is None:
         return jsonify({'error':'User not found'}), 404    
 
+    renamed = data.get('name', car.name) != car.name
     car.model = data.get('model',car.model)
     car.year = data.get('year',car.year)
     car.name = data.get('name',car.name)
+    # user documents embed the car's name only
+    fans = dashboards.refresh_car(car_id) if renamed else []
+    outbox.record('car', 'updated', [outbox.car_payload(car)])
     db.session.commit()
+    invalidate(f'car:{car_id}', 'cars', *(f'user:{fan}' for fan in fans))
+    car = load_one(Car, CAR, Car.id == car_id)
     return jsonify(car.serialize()),200
 
 
 #GET ALL FAVOURITES
-@app.route('/favourites', methods=['GET'])   
+@api.route('/favourites', methods=['GET'])
+@authenticated
+@read_replica
+@conditional(validators.favourites)
+@cached
 def get_favourites():
-    stmt = select(Favourite)
-    favourites = db.session.execute(stmt).scalars().all()
-    return jsonify([favourite.serialize() for favourite in favourites]), 200
+    return respond(FAVOURITES), 200
 
 
 #GET SINGLE FAVOURITE
-@app.route('/favourites/<int:favourite_id>', methods=['GET'])
+@api.route('/favourites/<int:favourite_id>', methods=['GET'])
+@authenticated
+@read_replica
+@conditional(validators.favourite)
+@cached
 def get_single_favourite(favourite_id):
-    stmt = select(Favourite).where(Favourite.id == favourite_id)
-    favourite = db.session.execute(stmt).scalar_one_or_none()
+    favourite = serializers.FAVOURITE.one(Favourite.id == favourite_id)
     if favourite is None:
         return jsonify({'error':'Favourite not found'}), 404
-    return jsonify(favourite.serialize()),200
+    tag(*favourite_tags(favourite))
+    return jsonify(favourite),200
+
+def _delete_favourites(criterion):
+    """Delete the favourites matching `criterion`, not committed.
+
+    Their cars' counters go down like DELETE /favourites/<id> does. Returns
+    their outbox payloads, for the caller to record() last and to
+    invalidate. The rows are loaded first so the session doesn't null the
+    foreign keys of the user or car being deleted.
+    """
+    rows = db.session.execute(
+        select(Favourite.id, Favourite.user_id, Favourite.car_id).where(criterion).order_by(Favourite.id)
+    ).all()
+    if not rows:
+        return []
+    deltas = Counter()
+    for _, _, car_id in rows:
+        deltas[car_id] -= 1
+    adjust_favourite_counts(deltas)
+    db.session.execute(delete(Favourite).where(Favourite.id.in_([row.id for row in rows])))
+    return [{'id': favourite_id, 'user_id': user_id, 'car_id': car_id} for favourite_id, user_id, car_id in rows]
+
+
+def _favourite_tags(favourites):
+    """Cache tags of deleted favourites, the users and cars that embedded them."""
+    for favourite in favourites:
+        yield f"favourite:{favourite['id']}"
+        yield f"user:{favourite['user_id']}"
+        yield f"car:{favourite['car_id']}"
+    if favourites:
+        yield 'favourites'
+
+
+def _flushed():
+    """Flush the session; on a constraint violation roll back and return False.
+
+    A favourite added to the user or car being deleted, after its
+    favourites were read, ends up here.
+    """
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        return False
+    return True
+
+
+def _user_or_car_missing(user_id, car_id):
+    return not db.session.get(User, user_id) or not db.session.get(Car, car_id)
 
 #POST FAVOURITES
-@app.route('/favourites/<int:user_id>/<int:car_id>', methods=['POST'])
+@api.route('/favourites/<int:user_id>/<int:car_id>', methods=['POST'])
+@authenticated
 def add_favourite(user_id, car_id):
-    user = db.session.get(User, user_id)
-    car = db.session.get(Car, car_id)
+    require_user(user_id)
+    # One statement: inserts only if both rows exist and the pair is new.
+    # The unique index on (user_id, car_id) settles concurrent clicks.
+    both_exist = select(literal(user_id), literal(car_id), literal(utcnow())).where(
+        select(User.id).where(User.id == user_id).exists(),
+        select(Car.id).where(Car.id == car_id).exists(),
+    )
+    stmt = insert_ignore(Favourite, Favourite.user_id, Favourite.car_id) \
+        .from_select(['user_id', 'car_id', 'updated_at'], both_exist) \
+        .returning(Favourite.id)
+    try:
+        favourite_id = db.session.execute(stmt).scalar_one_or_none()
+        if favourite_id is not None:
+            adjust_favourite_counts({car_id: 1})
+            dashboards.refresh([user_id])
+            outbox.record('favourite', 'created', [{'id': favourite_id, 'user_id': user_id, 'car_id': car_id}])
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        favourite_id = None
+
+    if favourite_id is None:
+        # nothing inserted, only now find out why
+        if _user_or_car_missing(user_id, car_id):
+            return jsonify({'error': 'User or Car not found'}), 404
+        return jsonify({'error': 'This car is already in favourites'}), 400
 
-    if not user or not car:
-        return jsonify({'error': 'User or Car not found'}), 404
+    invalidate(f'user:{user_id}', f'car:{car_id}', 'favourites')
 
-    # Comprobar si ya está marcado como favorito
-    existing = db.session.execute(
-        select(Favourite).where(Favourite.user_id == user_id, Favourite.car_id == car_id)
-    ).scalar_one_or_none()
+    favourite = load_one(Favourite, FAVOURITE, Favourite.id == favourite_id)
+    return jsonify(favourite.serialize()), 201
 
-    if existing:
-        return jsonify({'error': 'This car is already in favourites'}), 400
-
-    favourite = Favourite(user_id=user_id, car_id=car_id)
-    db.session.add(favourite)
-    db.session.commit()
+#POST MANY FAVOURITES
+@api.route('/favourites/bulk', methods=['POST'])
+@authenticated
+def add_favourites_bulk():
+    return bulk(FavouriteBulk)
 
 #PUT FAVOURITES
-@app.route('/favourites/<int:fav_id>', methods=['PUT'])
-def update_favourite(fav_id):
-    data = request.get_json()
+@api.route('/favourites/<int:fav_id>', methods=['PUT'])
+@authenticated
+@validated(schemas.FAVOURITE_UPDATE)
+def update_favourite(fav_id, data):
     favourite = db.session.get(Favourite, fav_id)
 
     if favourite is None:
         return jsonify({'error': 'Favourite not found'}), 404
 
-    new_user_id = data.get('user_id')
-    new_car_id = data.get('car_id')
-
-    if new_user_id:
+    new_user_id = data.get('user_id', favourite.user_id)
+    new_car_id = data.get('car_id', favourite.car_id)
+    # both the user it belongs to and the one it moves to
+    require_user(favourite.user_id)
+    require_user(new_user_id)
+    # both the old and the new user/car embed this favourite
+    touched = [f'favourite:{fav_id}', f'user:{favourite.user_id}', f'car:{favourite.car_id}', 'favourites']
+    previous = outbox.favourite_payload(favourite)
+
+    if (new_user_id, new_car_id) != (favourite.user_id, favourite.car_id):
+        # checked before any counter moves, like add_favourite
+        if _user_or_car_missing(new_user_id, new_car_id):
+            return jsonify({'error': 'User or Car not found'}), 404
         favourite.user_id = new_user_id
-    if new_car_id:
         favourite.car_id = new_car_id
-
+        try:
+            # the unique index on (user_id, car_id) also settles a concurrent add
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            return jsonify({'error': 'This car is already in favourites'}), 409
+        if new_car_id != previous['car_id']:
+            adjust_favourite_counts({previous['car_id']: -1, new_car_id: 1})
+
+    dashboards.refresh([previous['user_id'], favourite.user_id])
+    outbox.record('favourite', 'updated', [{**outbox.favourite_payload(favourite), 'previous': previous}])
     db.session.commit()
+    invalidate(*touched, f'user:{favourite.user_id}', f'car:{favourite.car_id}')
+    favourite = load_one(Favourite, FAVOURITE, Favourite.id == fav_id)
     return jsonify(favourite.serialize()), 200
 
 # DELETE FAVOURITE
-@app.route('/favourites/<int:favourite_id>', methods=['DELETE'])
+@api.route('/favourites/<int:favourite_id>', methods=['DELETE'])
+@authenticated
 def delete_favourite(favourite_id):
     stmt = select(Favourite).where(Favourite.id == favourite_id)
     favourite = db.session.execute(stmt).scalar_one_or_none()
     if favourite is None:
         return jsonify({'error':'favourite not found'}), 404
+    require_user(favourite.user_id)
+    touched = [f'favourite:{favourite_id}', f'user:{favourite.user_id}', f'car:{favourite.car_id}', 'favourites']
+    adjust_favourite_counts({favourite.car_id: -1})
+    payload = outbox.favourite_payload(favourite)
     db.session.delete(favourite)
+    dashboards.refresh([payload['user_id']])
+    outbox.record('favourite', 'deleted', [payload])
     db.session.commit()
+    invalidate(*touched)
     return jsonify({'message':'favourite deleted'}),200
 
+# CHANGES TO CARS AND FAVOURITES, see outbox.py
+@api.route('/changes', methods=['GET'])
+@authenticated
+def get_changes():
+    return jsonify(outbox.changes_request(request.args)), 200
+
+# SERVER-SENT EVENTS OF THE CHANGES
+@api.route('/changes/stream', methods=['GET'])
+@authenticated
+def stream_changes():
+    return outbox.stream_response(request.args, request.headers.get('Last-Event-ID'))
+
+# flask prune-changes
+@api.cli.command('prune-changes')
+@click.option('--days', type=float, default=outbox.CHANGES_RETENTION_DAYS, help='keep this many days')
+def prune_changes_command(days):
+    """Delete the change events older than --days."""
+    print(f'{outbox.prune(days)} change events deleted')
+
+# flask rebuild-dashboards
+@api.cli.command('rebuild-dashboards')
+def rebuild_dashboards_command():
+    """Render every user's GET /users/<id> document again."""
+    print(f'{dashboards.rebuild()} user documents rendered')
+
+# flask check-dashboards
+@api.cli.command('check-dashboards')
+@click.option('--repair', is_flag=True, help='rewrite the documents that differ')
+def check_dashboards_command(repair):
+    """Compare the stored user documents with a fresh rendering."""
+    stale = dashboards.check(repair)
+    if stale and repair:
+        invalidate(*(f'user:{user_id}' for user_id in stale))
+    print(f"{len(stale)} user documents {'repaired' if repair else 'differ'}"
+          + (f": {', '.join(map(str, stale[:20]))}" if stale else ''))
+    if stale and not repair:
+        raise SystemExit(1)
+
+# flask reconcile-favourites
+@api.cli.command('reconcile-favourites')
+def reconcile_favourites_command():
+    """Recompute cars.favourite_count from the favourites table."""
+    fixed = reconcile_favourite_counts()
+    if fixed:
+        invalidate('cars')
+    print(f'{fixed} car counters fixed')
+
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
 
@@ -0,0 +1,253 @@
+"""
+ASGI entry point, the async counterpart of wsgi.py.
+
+    $ pipenv install                              # uvicorn, asgiref, asyncpg, aiosqlite
+    $ uvicorn asgi:application --app-dir src --workers 2
+
+The read endpoints are served natively with async SQLAlchemy, so a worker
+keeps answering other requests while one waits on the database:
+
+    GET /users                  GET /users/<id>
+    GET /users/profile          GET /users/<id>/profile
+    GET /cars                   GET /cars/<id>
+    GET /favourites             GET /favourites/<id>
+
+Each one runs in a request context of the Flask app from app.py, with its
+before/after/teardown hooks, so rate limiting (ratelimit.py), compression,
+CORS, Server-Timing and /metrics (instrumentation.py) and the error
+handlers are the very same code as in WSGI mode. In between, the native
+view goes through the route's validator (conditional.py: ETag, 304) and the
+response cache (cache.py), runs the same serializers and listings through
+AsyncSession.run_sync(), checks the bearer token like auth.authenticated
+and answers the same bodies, status codes and headers. Everything else
+(writes, NDJSON streams, /admin, the sitemap) is handed to the Flask app in
+a thread, so the sync path keeps working unchanged and both modes share
+one code base, and one cache.
+
+DATABASE_URL is switched to the async driver (postgresql+asyncpg,
+sqlite+aiosqlite) and the pool is configured from the same variables as the
+sync engine, see database.py. So are DATABASE_REPLICA_URLS: the native
+reads go to the replicas unless the client has to read its own writes
+(replicas.py).
+"""
+import io
+import re
+import sys
+from contextvars import ContextVar
+from urllib.parse import parse_qsl
+from flask import g, request, jsonify, make_response
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from app import create_app
+from models import User, Profile, Car, Favourite
+from listing import USERS, PROFILES, CARS, FAVOURITES, NDJSON, page_response, json_response, shape
+from cache import response_cache, lookup, store, tag, user_tags, profile_tags, car_tags, favourite_tags
+import conditional as validators
+import serializers
+import dashboards
+import database
+import instrumentation
+import auth
+import ratelimit
+import replicas
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError as error:  # optional dependency, only needed by the ASGI mode
+    raise RuntimeError('The ASGI mode needs asgiref: pipenv install asgiref') from error
+
+def sessionmaker(url):
+    engine = create_async_engine(database.async_url(url), **database.async_engine_options(url))
+    database.instrument(engine.sync_engine)
+    if app.config['METRICS_ENABLED']:
+        instrumentation.watch(engine.sync_engine)
+    return async_sessionmaker(engine, expire_on_commit=False)
+
+
+app = create_app()
+Session = sessionmaker(app.config['SQLALCHEMY_DATABASE_URI'])
+# bind key (as in g.read_replica) -> sessionmaker
+ReplicaSessions = {key: sessionmaker(app.config['SQLALCHEMY_BINDS'][key]['url'])
+                   for key in replicas.replica_keys(app)}
+# the sessionmaker of the current request, Session or one of ReplicaSessions
+current_session = ContextVar('current_session', default=Session)
+
+flask_app = WsgiToAsgi(app)
+# the environ of a native GET as app.wsgi_app would see it, behind proxies
+client_environ = ratelimit.proxy_fix(lambda environ, start_response: environ, app.config['TRUSTED_PROXY_HOPS'])
+
+
+async def read(fn):
+    """Run fn(session) on a sync facade of an AsyncSession.
+
+    The statements fn() runs are awaited on the event loop, nothing blocks.
+    The request context goes along, fn() may use request and g.
+    """
+    async with current_session.get()() as session:
+        return await session.run_sync(fn)
+
+
+def listing(collection):
+    async def view():
+        items, next_cursor = await read(lambda session: collection.page(session=session))
+        return page_response(collection, items, next_cursor)
+    view.streams = True
+    return view
+
+
+def detail(serializer, column, tags, message):
+    async def view(**view_args):
+        key, = view_args.values()
+        item = await read(lambda session: serializer.one(column == key, session=session))
+        if item is None:
+            return jsonify({'error': message}), 404
+        tag(*tags(item))
+        return json_response(shape(item))
+    return view
+
+
+def dashboard(fallback):
+    """GET /users/<id> from its stored document, see dashboards.py."""
+    async def view(user_id):
+        body = await read(lambda session: dashboards.current(user_id, session))
+        if body is None:
+            return await fallback(user_id=user_id)
+        tag(f'user:{user_id}')
+        return app.response_class(body + '\n', mimetype=app.json.mimetype)
+    return view
+
+
+# path pattern, view, validator of the same route in app.py
+ROUTES = [
+    (re.compile(r'/users/?'), listing(USERS), validators.users),
+    (re.compile(r'/users/profile/?'), listing(PROFILES), validators.profiles),
+    (re.compile(r'/users/(\d+)/?'),
+     dashboard(detail(serializers.USER, User.id, user_tags, 'User not found')), validators.user),
+    (re.compile(r'/users/(\d+)/profile/?'),
+     detail(serializers.PROFILE, Profile.user_id, profile_tags, 'User not found'), validators.profile),
+    (re.compile(r'/cars/?'), listing(CARS), validators.cars),
+    (re.compile(r'/cars/(\d+)/?'), detail(serializers.CAR, Car.id, car_tags, 'car not found'), validators.car),
+    (re.compile(r'/favourites/?'), listing(FAVOURITES), validators.favourites),
+    (re.compile(r'/favourites/(\d+)/?'),
+     detail(serializers.FAVOURITE, Favourite.id, favourite_tags, 'Favourite not found'), validators.favourite),
+]
+
+
+def wants_stream(scope):
+    """listing.wants_stream() before there is a request."""
+    if dict(parse_qsl(scope['query_string'].decode('latin-1'))).get('stream') in ('1', 'true'):
+        return True
+    accept = dict(scope['headers']).get(b'accept', b'').decode('latin-1')
+    return parse_accept_header(accept, MIMEAccept).best_match(['application/json', NDJSON]) == NDJSON
+
+
+def route(scope):
+    """The native view and validator, or None to go through Flask."""
+    if scope['type'] != 'http' or scope['method'] != 'GET':
+        return None
+    for pattern, view, validator in ROUTES:
+        if pattern.fullmatch(scope['path']):
+            if getattr(view, 'streams', False) and wants_stream(scope):
+                return None
+            return view, validator
+    return None
+
+
+def environ(scope):
+    """The WSGI environ of a native GET, for its Flask request context."""
+    root = scope.get('root_path', '')
+    path = scope['path'][len(root):] if scope['path'].startswith(root) else scope['path']
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root.encode().decode('latin-1'),
+        'PATH_INFO': path.encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': (scope.get('client') or ('',))[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = f'HTTP_{key}'
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return client_environ(environ, None)
+
+
+async def dispatch(view, validator):
+    """The response of a native view, as @authenticated, @read_replica,
+    @conditional and @cached make it for the Flask view."""
+    if auth.required():
+        g.token = auth.verify_token(auth.bearer_token(request.headers.get('Authorization')))
+    if ReplicaSessions and not replicas.pinned(request.headers.get('Authorization'), request.remote_addr,
+                                               request.cookies.get(replicas.COOKIE)):
+        g.read_replica = replicas.pick(list(ReplicaSessions))
+        current_session.set(ReplicaSessions[g.read_replica])
+
+    async def cached():
+        if not response_cache().enabled:
+            return make_response(await view(**request.view_args))
+        response = lookup()
+        if response is None:
+            response = store(make_response(await view(**request.view_args)))
+        return response
+
+    result = await read(lambda session: validator(session=session, **request.view_args))
+    if result is None:
+        return await cached()
+    etag, last_modified, fresh = validators.evaluate(*result)
+    if fresh:
+        response = make_response('', 304)
+    else:
+        response = await cached()
+        if response.status_code != 200:
+            return response
+    return validators.finish(response, etag, last_modified)
+
+
+async def send_response(send, response):
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response.headers.items()]
+    await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                for maker in [Session, *ReplicaSessions.values()]:
+                    await maker.kw['bind'].dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    found = route(scope)
+    if found is None:
+        return await flask_app(scope, receive, send)
+
+    # what Flask.wsgi_app() and full_dispatch_request() do around a view
+    with app.request_context(environ(scope)):
+        try:
+            try:
+                response = app.preprocess_request()
+                if response is None:
+                    response = await dispatch(*found)
+            except Exception as error:
+                response = app.handle_user_exception(error)
+            response = app.finalize_request(response)
+        except Exception as error:
+            response = app.handle_exception(error)
+    await send_response(send, response)
@@ -0,0 +1,280 @@
+"""
+Bearer token authentication.
+
+POST /login returns a signed token (JWT, HS256); the user, profile, car and
+favourite routes need it in `Authorization: Bearer <token>`. Checking a
+token never touches the database:
+
+- the signature is an HMAC-SHA256, and decoded tokens are kept in an LRU
+  (AUTH_CACHE_SIZE), so a known token costs a dict lookup plus the expiry
+  and denylist checks,
+- keys come from AUTH_KEYS, `kid:secret,kid:secret,...`. The first one
+  signs, all of them verify. To rotate, put the new key first and drop the
+  old one once AUTH_TOKEN_TTL (3600 s) has passed,
+- POST /logout revokes the token's `jti`. Revoked ids live in an in-memory
+  denylist that forgets them once the token would have expired anyway.
+  With AUTH_DENYLIST_URL (or CACHE_URL) set to redis://... revocations are
+  published there and every worker pulls new ones at most
+  AUTH_DENYLIST_SYNC (5) seconds later. Without it the denylist is per worker.
+
+Who may do what:
+
+- the writes scoped to a user (the user itself, its profile, its
+  favourites) need that user's token, require_user(); POST /users/bulk
+  needs an admin's,
+- admins are the users listed in ADMIN_EMAILS (comma separated, none by
+  default). Their tokens carry `adm: true`, set at login, and pass every
+  ownership check; they also sign in to /admin/ (admin.py) with their email
+  and password,
+- GET /metrics and GET /db/pool (@operator) take an admin's token or
+  OPS_TOKEN, a static secret for the Prometheus scraper. Without OPS_TOKEN
+  only admins get in.
+
+Without AUTH_KEYS the key is derived from FLASK_APP_KEY. AUTH_REQUIRED=0
+turns the checks off, e.g. for the benchmarks.
+
+The variables are read by settings() into app.config, create_app(config)
+can override any of them; init_app() builds the app's keys, token cache
+and denylist from there (app.extensions['auth']).
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from functools import lru_cache, wraps
+from flask import current_app, request, g
+from utils import APIException
+
+log = logging.getLogger('api.auth')
+
+
+def app_secret():
+    """FLASK_APP_KEY, or a random secret for this process only."""
+    secret = os.getenv('FLASK_APP_KEY')
+    if not secret:
+        log.warning('FLASK_APP_KEY is not set, using a random key: sessions and tokens '
+                    'will not survive a restart or work across workers')
+        secret = secrets.token_hex(32)
+    return secret
+
+
+def settings():
+    """app.config entries read from the environment, see the module docstring."""
+    return {
+        'SECRET_KEY': app_secret(),
+        'AUTH_REQUIRED': os.getenv('AUTH_REQUIRED', '1') not in ('0', 'false'),
+        'AUTH_KEYS': os.getenv('AUTH_KEYS'),
+        'AUTH_TOKEN_TTL': int(os.getenv('AUTH_TOKEN_TTL', 3600)),
+        'AUTH_CACHE_SIZE': int(os.getenv('AUTH_CACHE_SIZE', 10000)),
+        'AUTH_DENYLIST_SYNC': float(os.getenv('AUTH_DENYLIST_SYNC', 5)),
+        'AUTH_DENYLIST_URL': os.getenv('AUTH_DENYLIST_URL') or os.getenv('CACHE_URL'),
+        'ADMIN_EMAILS': os.getenv('ADMIN_EMAILS', ''),
+        'OPS_TOKEN': os.getenv('OPS_TOKEN'),
+    }
+
+
+def load_keys(raw, secret):
+    """{kid: secret} in AUTH_KEYS order, the first one signs."""
+    if not raw:
+        return {'default': hashlib.sha256(b'auth:' + secret.encode()).digest()}
+    keys = {}
+    for entry in raw.split(','):
+        kid, _, key = entry.strip().partition(':')
+        if not kid or not key:
+            raise RuntimeError('AUTH_KEYS must look like kid:secret,kid:secret')
+        keys[kid] = key.encode()
+    return keys
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class Denylist:
+    """Revoked token ids until they expire, optionally shared through redis."""
+
+    def __init__(self, url=None, sync_every=5):
+        self.lock = threading.Lock()
+        self.revoked = {}  # jti -> exp
+        self.synced = 0.0
+        self.sync_every = sync_every
+        self.client = None
+        if url and url.startswith(('redis://', 'rediss://')):
+            import redis
+            self.client = redis.Redis.from_url(url)
+
+    def revoke(self, jti, exp):
+        with self.lock:
+            self.revoked[jti] = exp
+        if self.client is not None:
+            self.client.zadd('auth:revoked', {jti: exp})
+
+    def __contains__(self, jti):
+        self.sync()
+        return jti in self.revoked
+
+    def sync(self):
+        now = time.time()
+        if now - self.synced < self.sync_every:
+            return
+        with self.lock:
+            if now - self.synced < self.sync_every:
+                return
+            self.synced = now
+            self.revoked = {jti: exp for jti, exp in self.revoked.items() if exp > now}
+            if self.client is None:
+                return
+            try:
+                self.client.zremrangebyscore('auth:revoked', '-inf', now)
+                for jti, exp in self.client.zrangebyscore('auth:revoked', now, '+inf', withscores=True):
+                    self.revoked[jti.decode()] = exp
+            except Exception:
+                # keep serving with what we have, retried on the next sync
+                log.exception('could not sync the token denylist')
+
+
+class Auth:
+    """The keys, token cache and denylist of one app, from its config."""
+
+    def __init__(self, config):
+        self.required = config['AUTH_REQUIRED']
+        self.keys = load_keys(config['AUTH_KEYS'], config['SECRET_KEY'])
+        self.signing_kid = next(iter(self.keys))
+        self.token_ttl = config['AUTH_TOKEN_TTL']
+        emails = config['ADMIN_EMAILS']
+        if isinstance(emails, str):
+            emails = emails.split(',')
+        self.admin_emails = {email.strip().lower() for email in emails if email.strip()}
+        self.ops_token = config['OPS_TOKEN']
+        self.denylist = Denylist(config['AUTH_DENYLIST_URL'], config['AUTH_DENYLIST_SYNC'])
+        self.decode = lru_cache(maxsize=config['AUTH_CACHE_SIZE'])(self._decode)
+
+    def sign(self, kid, signing_input):
+        return hmac.new(self.keys[kid], signing_input, hashlib.sha256).digest()
+
+    def _decode(self, token):
+        """Claims of a correctly signed token. Raises ValueError, never cached."""
+        try:
+            header_b64, claims_b64, signature_b64 = token.split('.')
+            header = json.loads(_unb64(header_b64))
+            kid = header.get('kid')
+            if header.get('alg') != 'HS256' or kid not in self.keys:
+                raise ValueError('unknown key')
+            expected = self.sign(kid, f'{header_b64}.{claims_b64}'.encode())
+            if not hmac.compare_digest(expected, _unb64(signature_b64)):
+                raise ValueError('bad signature')
+            claims = json.loads(_unb64(claims_b64))
+        except (TypeError, ValueError, KeyError, AttributeError) as error:  # binascii.Error is a ValueError
+            raise ValueError(str(error))
+        return claims
+
+
+def init_app(app):
+    app.extensions['auth'] = Auth(app.config)
+
+
+def _auth():
+    return current_app.extensions['auth']
+
+
+def required():
+    """False when AUTH_REQUIRED=0 turned the checks off."""
+    return _auth().required
+
+
+def is_admin(email):
+    return email.lower() in _auth().admin_emails
+
+
+def issue_token(user_id, admin=False):
+    auth = _auth()
+    now = int(time.time())
+    header = {'alg': 'HS256', 'typ': 'JWT', 'kid': auth.signing_kid}
+    claims = {'sub': user_id, 'iat': now, 'exp': now + auth.token_ttl, 'jti': secrets.token_urlsafe(12)}
+    if admin:
+        claims['adm'] = True
+    signing_input = (_b64(json.dumps(header, separators=(',', ':')).encode()) + '.' +
+                     _b64(json.dumps(claims, separators=(',', ':')).encode())).encode()
+    return signing_input.decode() + '.' + _b64(auth.sign(auth.signing_kid, signing_input))
+
+
+def verify_token(token):
+    """Return the claims of a valid token or raise APIException(401)."""
+    auth = _auth()
+    try:
+        claims = auth.decode(token)
+    except ValueError:
+        raise APIException('Invalid token', status_code=401)
+    if claims.get('exp', 0) <= time.time():
+        raise APIException('Token expired', status_code=401)
+    if claims.get('jti') in auth.denylist:
+        raise APIException('Token revoked', status_code=401)
+    return claims
+
+
+def bearer_token(header):
+    scheme, _, token = (header or '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        raise APIException('Missing bearer token', status_code=401)
+    return token.strip()
+
+
+def authenticated(view):
+    """Require a valid token, its claims end up in g.token."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if required():
+            g.token = verify_token(bearer_token(request.headers.get('Authorization')))
+        return view(*args, **kwargs)
+
+    wrapper.requires_token = True  # read by documents.openapi()
+    return wrapper
+
+
+def operator(view):
+    """Operational endpoints: an admin's token or OPS_TOKEN."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if required():
+            token = bearer_token(request.headers.get('Authorization'))
+            ops_token = _auth().ops_token
+            if not (ops_token and hmac.compare_digest(token.encode(), ops_token.encode())):
+                g.token = verify_token(token)
+                require_admin()
+        return view(*args, **kwargs)
+
+    wrapper.requires_token = True
+    return wrapper
+
+
+def owns(user_id):
+    """True when the request's token may write what belongs to `user_id`."""
+    if not required():
+        return True
+    return g.token.get('sub') == user_id or g.token.get('adm') is True
+
+
+def require_user(user_id):
+    """403 unless the request's token is `user_id`'s or an admin's."""
+    if not owns(user_id):
+        raise APIException('Forbidden', status_code=403)
+
+
+def require_admin():
+    if required() and g.token.get('adm') is not True:
+        raise APIException('Forbidden', status_code=403)
+
+
+def revoke(claims):
+    _auth().denylist.revoke(claims['jti'], claims['exp'])
@@ -0,0 +1,278 @@
+"""
+Bulk writes for onboarding imports.
+
+    POST /users/bulk        [{"email": ..., "password": ..., "age": ...}, ...]
+    POST /cars/bulk         [{"model": ..., "year": ..., "name": ...}, ...]
+    POST /favourites/bulk   [{"user_id": ..., "car_id": ...}, ...]
+
+The body is a JSON array or, with `Content-Type: application/x-ndjson`, one
+object per line. Each item is validated with the schema of the single-item
+route (schemas.py), then they are checked all together: the existence checks
+(emails already taken, unknown users/cars, favourites already there) are a
+few `IN (...)` queries per `BULK_CHUNK` items, never one query per item.
+Valid items are inserted with one INSERT ... RETURNING id per chunk, each
+chunk in its own transaction, so a failure only loses that chunk. It is
+an executemany, which SQLAlchemy sends as multi-row INSERTs. On PostgreSQL
+it returns the ids in row order (sort_by_parameter_order). On SQLite asking
+for that order makes it run one statement per row, so there the ids are
+sorted instead: SQLite hands out rowids in VALUES order. POST /cars/bulk
+with 2000 cars, SQLite: 12 statements instead of 2008, ~11 ms of database
+time instead of ~23 (Server-Timing, benchmarks/bench_endpoints.py reports
+the statement counts).
+
+The answer reports every item, in input order:
+
+    {"created": 2, "failed": 1, "results": [
+        {"index": 0, "status": "created", "id": 41},
+        {"index": 1, "status": "error", "error": "Email already registered"},
+        {"index": 2, "status": "created", "id": 42}]}
+
+with 201 when everything was created and 207 otherwise.
+
+    BULK_MAX_USERS   items per POST /users/bulk (200)
+
+User imports are small and go USER_BULK_CHUNK (50) at a time: each
+password costs a KDF run (credentials.py, ~50-100 ms of CPU), so a chunk's
+passwords are hashed right before its INSERT and committed with it. A
+request cut short by the worker timeout or a busy hashing pool keeps the
+chunks already committed, the items it didn't get to are reported as
+failed.
+"""
+import json
+import os
+from collections import Counter
+from flask import request, jsonify
+from sqlalchemy import select, insert, tuple_
+from sqlalchemy.exc import IntegrityError
+from utils import APIException
+from models import db, User, Car, Favourite
+from cache import invalidate
+from listing import NDJSON
+from credentials import hash_passwords
+from auth import owns
+import schemas
+from counters import adjust_favourite_counts
+import outbox
+import dashboards
+
+BULK_CHUNK = 500
+MAX_ITEMS = 10000
+BULK_MAX_USERS = int(os.getenv('BULK_MAX_USERS', 200))
+USER_BULK_CHUNK = 50
+
+
+class ItemError(Exception):
+    pass
+
+
+def read_items(max_items=MAX_ITEMS):
+    """Return the request items as a list, a JSON array or NDJSON lines.
+
+    Lines that are not valid JSON are kept as ItemError so they are reported
+    at their index instead of failing the whole request.
+    """
+    if request.mimetype == NDJSON:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(ItemError('Invalid JSON'))
+    else:
+        items = request.get_json(silent=True)
+        if not isinstance(items, list):
+            raise APIException('Expected a JSON array or NDJSON body', status_code=400)
+    if not items:
+        raise APIException('Missing data', status_code=400)
+    if len(items) > max_items:
+        raise APIException(f'At most {max_items} items per request', status_code=413)
+    return items
+
+
+def chunks(seq, size=BULK_CHUNK):
+    for start in range(0, len(seq), size):
+        yield seq[start:start + size]
+
+
+class BulkInsert:
+    """Validate, check and insert the items of one bulk request."""
+    max_items = MAX_ITEMS
+    chunk_size = BULK_CHUNK
+
+    def __init__(self, items):
+        self.results = [None] * len(items)
+        self.pending = []  # (index, row) still valid
+        for index, item in enumerate(items):
+            try:
+                if isinstance(item, ItemError):
+                    raise item
+                self.pending.append((index, self.row(item)))
+            except ItemError as error:
+                self.fail(index, str(error))
+            except schemas.Invalid as error:
+                self.fail(index, error.message)
+
+    def fail(self, index, error):
+        self.results[index] = {'index': index, 'status': 'error', 'error': error}
+
+    def reject(self, predicate, error):
+        """Fail every pending item for which predicate(row) is true."""
+        keep = []
+        for index, row in self.pending:
+            if predicate(row):
+                self.fail(index, error)
+            else:
+                keep.append((index, row))
+        self.pending = keep
+
+    def reject_repeated(self, key, error):
+        """Fail the repetitions of a key inside the batch, the first one stays."""
+        seen = set()
+
+        def repeated(row):
+            value = key(row)
+            if value in seen:
+                return True
+            seen.add(value)
+            return False
+        self.reject(repeated, error)
+
+    def existing(self, column, values):
+        """The subset of `values` present in `column`, one query per chunk."""
+        found = set()
+        for chunk in chunks(sorted(values)):
+            found.update(db.session.execute(select(column).where(column.in_(chunk))).scalars())
+        return found
+
+    def row(self, item):
+        return self.schema.validate(item)
+
+    def check(self):
+        """Drop pending rows that conflict with the database."""
+
+    def prepare(self, rows):
+        """Complete the rows of a chunk right before they are inserted."""
+
+    def insert(self, rows):
+        """INSERT `rows`, return their new ids in the same order."""
+        if db.session.get_bind().dialect.name == 'sqlite':
+            # batched without the order, ascending rowids give it back
+            stmt = insert(self.model).returning(self.model.id)
+            return sorted(db.session.execute(stmt, rows).scalars())
+        stmt = insert(self.model).returning(self.model.id, sort_by_parameter_order=True)
+        return db.session.execute(stmt, rows).scalars().all()
+
+    def run(self):
+        self.check()
+        created = []
+        for position, chunk in enumerate(chunks(self.pending, self.chunk_size)):
+            rows = [row for _, row in chunk]
+            try:
+                self.prepare(rows)
+            except APIException as error:
+                # e.g. the hashing pool is full: keep what was committed, report the rest
+                for index, _ in self.pending[position * self.chunk_size:]:
+                    self.fail(index, error.message)
+                break
+            try:
+                ids = self.insert(rows)
+                self.inserted(rows, ids)
+                db.session.commit()
+            except IntegrityError:
+                # a concurrent write got there between check() and here
+                db.session.rollback()
+                for index, _ in chunk:
+                    self.fail(index, 'Conflicts with an existing row')
+                continue
+            for (index, row), new_id in zip(chunk, ids):
+                self.results[index] = {'index': index, 'status': 'created', 'id': new_id}
+                created.append(row)
+        if created:
+            invalidate(*self.tags(created))
+        return created
+
+    def inserted(self, rows, ids):
+        """Runs in the transaction of each chunk, before the commit."""
+
+    def tags(self, rows):
+        return [self.collection]
+
+    def response(self):
+        created = sum(1 for result in self.results if result['status'] == 'created')
+        body = {'created': created, 'failed': len(self.results) - created, 'results': self.results}
+        return jsonify(body), 201 if created == len(self.results) else 207
+
+
+class UserBulk(BulkInsert):
+    model = User
+    collection = 'users'
+    schema = schemas.USER
+    max_items = BULK_MAX_USERS
+    chunk_size = USER_BULK_CHUNK
+
+    def check(self):
+        self.reject_repeated(lambda row: row['email'], 'Duplicate email in this request')
+        taken = self.existing(User.email, {row['email'] for _, row in self.pending})
+        self.reject(lambda row: row['email'] in taken, 'Email already registered')
+
+    def prepare(self, rows):
+        # only the rows that will be inserted are hashed, one chunk at a time
+        for row, hashed in zip(rows, hash_passwords([row['password'] for row in rows])):
+            row['password'] = hashed
+
+    def inserted(self, rows, ids):
+        dashboards.refresh(ids)
+
+
+class CarBulk(BulkInsert):
+    model = Car
+    collection = 'cars'
+    schema = schemas.CAR
+
+    def inserted(self, rows, ids):
+        outbox.record('car', 'created', [{'id': new_id, **row} for row, new_id in zip(rows, ids)])
+
+
+class FavouriteBulk(BulkInsert):
+    model = Favourite
+    collection = 'favourites'
+    schema = schemas.FAVOURITE
+
+    def check(self):
+        # only the token's own favourites, or anyone's for an admin
+        self.reject(lambda row: not owns(row['user_id']), 'Forbidden')
+        users = self.existing(User.id, {row['user_id'] for _, row in self.pending})
+        cars = self.existing(Car.id, {row['car_id'] for _, row in self.pending})
+        self.reject(lambda row: row['user_id'] not in users or row['car_id'] not in cars,
+                    'User or Car not found')
+
+        def pair(row):
+            return row['user_id'], row['car_id']
+        self.reject_repeated(pair, 'Duplicate favourite in this request')
+        there = set()
+        for chunk in chunks([pair(row) for _, row in self.pending]):
+            stmt = select(Favourite.user_id, Favourite.car_id) \
+                .where(tuple_(Favourite.user_id, Favourite.car_id).in_(chunk))
+            there.update(tuple(r) for r in db.session.execute(stmt))
+        self.reject(lambda row: pair(row) in there, 'This car is already in favourites')
+
+    def inserted(self, rows, ids):
+        adjust_favourite_counts(Counter(row['car_id'] for row in rows))
+        dashboards.refresh(row['user_id'] for row in rows)
+        outbox.record('favourite', 'created', [{'id': new_id, **row} for row, new_id in zip(rows, ids)])
+
+    def tags(self, rows):
+        tags = {self.collection}
+        for row in rows:
+            tags.add(f"user:{row['user_id']}")
+            tags.add(f"car:{row['car_id']}")
+        return tags
+
+
+def bulk(kind):
+    """Run a bulk request and return the (body, status) report."""
+    job = kind(read_items(kind.max_items))
+    job.run()
+    return job.response()
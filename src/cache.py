@@ -0,0 +1,300 @@
+"""
+Read-through response cache for the GET endpoints.
+
+Two tiers:
+- an in-process LRU with a TTL (always on unless CACHE_ENABLED=0),
+- an optional shared tier selected by CACHE_URL, `redis://...` (needs the
+  redis package) or `memory://` (a process-local stand-in with the same
+  behaviour, handy for tests and single-worker setups).
+
+Every cached response is stored with tags naming what it was built from:
+`user:1`, `car:7`, `favourite:3` for rows and `users`, `profiles`, `cars`,
+`favourites` for collections (any change in them can move rows in or out
+of a page). Writes call invalidate() with the tags they touched, so a new
+favourite evicts that user's and that car's representations, wherever they
+are embedded, and nothing else.
+
+Without a shared tier every gunicorn worker has its own LRU, so another
+worker may serve a stale copy for up to CACHE_TTL seconds after a write.
+
+    CACHE_ENABLED    0 to turn it off (1)
+    CACHE_SIZE       responses in the local LRU (2048)
+    CACHE_TTL        seconds a response is kept (10)
+    CACHE_LOCAL_TTL  seconds the local copy lives when there is a shared
+                     tier (2)
+    CACHE_URL        the shared tier (none)
+
+settings() reads them into app.config, init_app() builds the app's cache,
+app.extensions['cache'], from there.
+"""
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, g, make_response
+from replicas import REPLICA_MAX_LAG
+
+
+def settings():
+    """app.config entries read from the environment, see the module docstring."""
+    return {
+        'CACHE_ENABLED': os.getenv('CACHE_ENABLED', '1') not in ('0', 'false'),
+        'CACHE_SIZE': int(os.getenv('CACHE_SIZE', 2048)),
+        'CACHE_TTL': float(os.getenv('CACHE_TTL', 10)),
+        # with a shared tier the local copy only lives for a short while, so
+        # other workers' invalidations are picked up quickly
+        'CACHE_LOCAL_TTL': float(os.getenv('CACHE_LOCAL_TTL', 2)),
+        'CACHE_URL': os.getenv('CACHE_URL'),
+    }
+
+
+class LRUCache:
+    """Thread-safe LRU with per-entry expiry and tag invalidation."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, value, tags)
+        self.tags = {}                # tag -> set of keys
+        self.lock = threading.Lock()
+        # bumped on every invalidation, see ResponseCache.set()
+        self.generation = 0
+        self.invalidated_at = float('-inf')
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, tags, ttl=None):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (time.monotonic() + (ttl or self.ttl), value, tags)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                self._drop(next(iter(self.entries)))
+
+    def invalidate(self, tags):
+        with self.lock:
+            self.generation += 1
+            self.invalidated_at = time.monotonic()
+            for tag in tags:
+                for key in self.tags.pop(tag, ()):
+                    self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.tags.clear()
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for tag in entry[2]:
+            keys = self.tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[tag]
+
+
+class LocalBackend(LRUCache):
+    """Stand-in for a shared backend (CACHE_URL=memory://)."""
+
+
+class RedisBackend:
+    """Shared tier on redis, tags are kept as redis sets."""
+
+    def __init__(self, url, ttl):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        data = self.client.get('cache:' + key)
+        return pickle.loads(data) if data is not None else None
+
+    def set(self, key, value, tags, ttl=None):
+        ttl = int(ttl or self.ttl) or 1
+        pipe = self.client.pipeline()
+        pipe.set('cache:' + key, pickle.dumps(value), ex=ttl)
+        for tag in tags:
+            pipe.sadd('tag:' + tag, key)
+            pipe.expire('tag:' + tag, ttl)
+        pipe.execute()
+
+    def invalidate(self, tags):
+        pipe = self.client.pipeline()
+        for tag in tags:
+            pipe.smembers('tag:' + tag)
+        keys = {key.decode() for members in pipe.execute() for key in members}
+        if keys or tags:
+            self.client.delete(*['cache:' + key for key in keys], *['tag:' + tag for tag in tags])
+
+    def clear(self):
+        for pattern in ('cache:*', 'tag:*'):
+            keys = list(self.client.scan_iter(pattern))
+            if keys:
+                self.client.delete(*keys)
+
+
+def shared_backend(url, size, ttl):
+    if not url:
+        return None
+    if url.startswith('memory://'):
+        return LocalBackend(size, ttl)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisBackend(url, ttl)
+    raise ValueError(f'Unsupported CACHE_URL: {url}')
+
+
+class ResponseCache:
+    """Local LRU in front of the optional shared tier."""
+
+    def __init__(self, config):
+        self.enabled = config['CACHE_ENABLED']
+        ttl = config['CACHE_TTL']
+        self.shared = shared_backend(config['CACHE_URL'], config['CACHE_SIZE'], ttl) if self.enabled else None
+        local_ttl = min(config['CACHE_LOCAL_TTL'], ttl) if self.shared else ttl
+        self.local = LRUCache(config['CACHE_SIZE'], local_ttl)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value, value[3])
+        return value
+
+    def set(self, key, value, tags, generation):
+        # An invalidation ran while this response was being built, the data
+        # may already be stale, so it is not stored.
+        if generation != self.local.generation:
+            return
+        # a replica may not have the write behind the last invalidation yet
+        if g.get('read_replica') and time.monotonic() - self.local.invalidated_at < REPLICA_MAX_LAG:
+            return
+        self.local.set(key, value, tags)
+        if self.shared is not None:
+            self.shared.set(key, value, tags)
+
+    def invalidate(self, *tags):
+        if not self.enabled:
+            return
+        self.local.invalidate(tags)
+        if self.shared is not None:
+            self.shared.invalidate(tags)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+
+def init_app(app):
+    app.extensions['cache'] = ResponseCache(app.config)
+
+
+def response_cache():
+    """The ResponseCache of the current app."""
+    return current_app.extensions['cache']
+
+
+def invalidate(*tags):
+    """Evict every cached response built from any of `tags`."""
+    response_cache().invalidate(*tags)
+
+
+def tag(*tags):
+    """Record what the response of the current request depends on."""
+    if 'cache_tags' in g:
+        g.cache_tags.update(tags)
+
+
+def lookup():
+    """The cached response of the current GET, or None on a miss."""
+    cache = response_cache()
+    key = request.full_path + '|' + request.headers.get('Accept', '') + '|' + g.get('etag', '')
+    hit = cache.get(key)
+    if hit is None:
+        g.cache_key = key
+        # the response about to be built, stored only if no invalidation runs meanwhile
+        g.cache_generation = cache.local.generation
+        g.cache_tags = set()
+        return None
+    body, status, headers, _ = hit
+    response = make_response(body, status)
+    response.headers.update(headers)
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+
+def store(response):
+    """Keep `response`, built after lookup() missed, if it can be reused."""
+    if response.status_code == 200 and not response.is_streamed and g.cache_tags:
+        headers = [(k, v) for k, v in response.headers.items() if k != 'Content-Length']
+        tags = frozenset(g.cache_tags)
+        response_cache().set(g.cache_key, (response.get_data(), response.status_code, headers, tags), tags,
+                  g.cache_generation)
+    response.headers['X-Cache'] = 'MISS'
+    return response
+
+
+def cached(view):
+    """Serve a GET view from the cache, keyed by path, query string and Accept.
+
+    Under @conditional the key includes the ETag it computed, g.etag: the
+    body is cached per validator state, entries of older states are never
+    hit again and age out of the LRU. Only complete 200 responses are
+    stored, streamed ones never are. asgi.py calls lookup() and store()
+    itself around its native views.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not response_cache().enabled or request.method != 'GET':
+            return view(*args, **kwargs)
+        response = lookup()
+        if response is None:
+            response = store(make_response(view(*args, **kwargs)))
+        return response
+
+    return wrapper
+
+
+# What each serialize() shape is built from
+
+def user_tags(item):
+    yield f"user:{item['id']}" if 'id' in item else 'users'
+    for favourite in item.get('favourites', ()):
+        yield f"car:{favourite['id']}"
+
+
+def profile_tags(item):
+    yield f"user:{item['user_id']}" if 'user_id' in item else 'profiles'
+
+
+def car_tags(item):
+    yield f"car:{item['id']}" if 'id' in item else 'cars'
+    for user in item.get('favourite_of', ()):
+        yield f"user:{user['id']}"
+
+
+def favourite_tags(item):
+    yield f"favourite:{item['id']}" if 'id' in item else 'favourites'
+    if item.get('user'):
+        yield f"user:{item['user']['id']}"
+    if item.get('car'):
+        yield f"car:{item['car']['id']}"
@@ -0,0 +1,177 @@
+"""
+Response compression, negotiated from Accept-Encoding.
+
+    COMPRESS_ENABLED      0 to turn it off (1)
+    COMPRESS_ENCODINGS    server preference when the client accepts several
+                          equally (zstd,br,gzip). zstd needs `zstandard`, br
+                          needs `brotli`, the ones not installed are skipped
+    COMPRESS_MIN_SIZE     smaller bodies are sent as they are (1024 bytes)
+    COMPRESS_LEVEL_GZIP / _BR / _ZSTD   (6 / 4 / 3)
+    COMPRESS_STREAM_FLUSH bytes of a streamed body after which the encoder is
+                          flushed, so NDJSON rows keep arriving (65536)
+
+Only text-like bodies (JSON, NDJSON, text/*) are compressed. A complete body
+is compressed in one go. A streamed one (?stream=1) is compressed chunk by
+chunk as the rows are produced, so memory stays flat and the response stays
+chunked. A compressed response gets `Vary: Accept-Encoding` and a weak ETag:
+it's the same resource, not the same bytes, and If-None-Match compares
+weakly (conditional.py).
+
+settings() reads the variables into app.config, init_app() builds the
+app's encoders (app.extensions['compression']) from there.
+"""
+import gzip
+import os
+import zlib
+from flask import current_app, request
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'application/javascript', 'image/svg+xml')
+
+
+def settings():
+    """app.config entries read from the environment, see the module docstring."""
+    return {
+        'COMPRESS_ENABLED': os.getenv('COMPRESS_ENABLED', '1') not in ('0', 'false'),
+        'COMPRESS_ENCODINGS': os.getenv('COMPRESS_ENCODINGS', 'zstd,br,gzip'),
+        'COMPRESS_MIN_SIZE': int(os.getenv('COMPRESS_MIN_SIZE', 1024)),
+        'COMPRESS_STREAM_FLUSH': int(os.getenv('COMPRESS_STREAM_FLUSH', 65536)),
+        'COMPRESS_LEVEL_GZIP': int(os.getenv('COMPRESS_LEVEL_GZIP', 6)),
+        'COMPRESS_LEVEL_BR': int(os.getenv('COMPRESS_LEVEL_BR', 4)),
+        'COMPRESS_LEVEL_ZSTD': int(os.getenv('COMPRESS_LEVEL_ZSTD', 3)),
+    }
+
+
+class Encoder:
+    """One Content-Encoding, for whole bodies and for streams."""
+
+    name = None
+
+    def __init__(self, level, stream_flush):
+        self.level = level
+        self.stream_flush = stream_flush
+
+    def compress(self, data):
+        raise NotImplementedError
+
+    def compressor(self):
+        """(compress(chunk), flush(), finish()) of a new streaming compressor."""
+        raise NotImplementedError
+
+    def stream(self, chunks):
+        compress, flush, finish = self.compressor()
+        pending = 0
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            data = compress(chunk)
+            pending += len(chunk)
+            if pending >= self.stream_flush:
+                data += flush()
+                pending = 0
+            if data:
+                yield data
+        yield finish()
+
+
+class Gzip(Encoder):
+    name = 'gzip'
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def compressor(self):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+
+
+class Brotli(Encoder):
+    name = 'br'
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.level)
+
+    def compressor(self):
+        compressor = brotli.Compressor(quality=self.level)
+        return compressor.process, compressor.flush, compressor.finish
+
+
+class Zstd(Encoder):
+    name = 'zstd'
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def compressor(self):
+        compressor = zstandard.ZstdCompressor(level=self.level).compressobj()
+        return (compressor.compress, lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+                compressor.flush)
+
+
+def available_encoders(config):
+    """{name: Encoder} in COMPRESS_ENCODINGS order, installed ones only."""
+    installed = {'gzip': Gzip, 'br': Brotli if brotli else None, 'zstd': Zstd if zstandard else None}
+    encoders = {}
+    for name in config['COMPRESS_ENCODINGS'].split(','):
+        name = name.strip()
+        if name not in installed:
+            raise RuntimeError(f'Unsupported encoding in COMPRESS_ENCODINGS: {name}')
+        if installed[name] is not None:
+            level = config[f"COMPRESS_LEVEL_{name.upper()}"]
+            encoders[name] = installed[name](level, config['COMPRESS_STREAM_FLUSH'])
+    return encoders
+
+
+def negotiate(encoders, accept_encoding):
+    """The Encoder to use for an Accept-Encoding header value, or None."""
+    if not encoders or not accept_encoding:
+        return None
+    name = parse_accept_header(accept_encoding).best_match(list(encoders))
+    return encoders.get(name)
+
+
+def compressible(mimetype):
+    return mimetype is not None and (mimetype.startswith('text/') or mimetype in COMPRESSIBLE)
+
+
+def compress_response(response):
+    if (request.method == 'HEAD' or response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or not compressible(response.mimetype)
+            or 'no-transform' in response.headers.get('Cache-Control', '')):
+        return response
+    if not response.is_streamed and response.content_length is not None \
+            and response.content_length < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoder = negotiate(current_app.extensions['compression'], request.headers.get('Accept-Encoding'))
+    if encoder is None:
+        return response
+    if response.is_streamed:
+        response.response = encoder.stream(response.response)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(encoder.compress(response.get_data()))
+    response.content_encoding = encoder.name
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_app(app):
+    encoders = available_encoders(app.config) if app.config['COMPRESS_ENABLED'] else {}
+    app.extensions['compression'] = encoders
+    if encoders:
+        app.after_request(compress_response)
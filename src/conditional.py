@@ -0,0 +1,155 @@
+"""
+HTTP conditional requests (ETag / If-None-Match, Last-Modified / If-Modified-Since).
+
+Every GET endpoint has a validator, one query for the state of the rows the
+response is built from: the `updated_at` columns (and row counts, so
+deletes are noticed) of a single item and what it embeds, the change
+counters of the tables (versions.py) for the collections, so these don't
+scan the tables on every request. The strong ETag is a hash of that state
+plus the path, query string and Accept header. When the client already has it the view is not
+called at all: no rows are loaded or serialized, the answer is a 304.
+Otherwise @cached, below, looks the body up under that ETag, so a body
+cached before the state moved is never sent with the new ETag.
+
+Last-Modified is only sent where a timestamp alone is a sound validator
+(a profile, a favourite). Anything embedding a collection can lose rows
+without any remaining timestamp moving, so those rely on the ETag.
+"""
+import hashlib
+from datetime import timezone
+from functools import wraps
+from flask import g, request, make_response
+from sqlalchemy import select, func, true
+from models import db, User, Profile, Car, Favourite
+import dashboards
+import versions
+
+
+def evaluate(state, last_modified):
+    """(etag, last_modified, fresh) of a validator result for the current request.
+
+    `fresh` is true when the client already has this state. The ETag is
+    left in g.etag for @cached.
+    """
+    key = repr((request.full_path, request.headers.get('Accept', ''), state))
+    etag = hashlib.sha1(key.encode()).hexdigest()
+    # part of @cached's key: a stored body is only served under its own ETag
+    g.etag = etag
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+
+    if request.if_none_match:
+        # weak comparison: compression.py weakens the ETag of compressed bodies
+        fresh = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        fresh = bool(last_modified and since and last_modified <= since)
+    return etag, last_modified, fresh
+
+
+def finish(response, etag, last_modified):
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def conditional(validator):
+    """Answer 304 when the validator state matches what the client has.
+
+    `validator(**view_args)` returns (state, last_modified) or None when the
+    resource does not exist, in that case the view runs (and 404s) as usual.
+    Validators take an optional `session`, asgi.py passes its own.
+    """
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            result = validator(**kwargs)
+            if result is None:
+                return view(*args, **kwargs)
+            etag, last_modified, fresh = evaluate(*result)
+            if fresh:
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            return finish(response, etag, last_modified)
+
+        return wrapper
+
+    return decorator
+
+
+def _tables(*models):
+    """Change counters of whole tables, for the collections (versions.py)."""
+    names = tuple(model.__tablename__ for model in models)
+
+    def validator(session=None, **_):
+        counters = versions.state(names, session)
+        return (counters, None) if counters is not None else None
+    return validator
+
+
+users = _tables(User, Profile, Favourite, Car)
+profiles = _tables(Profile)
+cars = _tables(Car, Favourite, User)
+favourites = _tables(Favourite, User, Car)
+
+
+def _aggregates(*columns):
+    # one row, joined ON true so every backend accepts it next to the item's table
+    return select(*(column.label(f'c{i}') for i, column in enumerate(columns)))
+
+
+def user(user_id, session=None):
+    session = session or db.session
+    # the stored document changes exactly when the response does, and the
+    # view answers the body read along with it, see dashboards.py
+    document = dashboards.stored(user_id, session)
+    if document is not None:
+        return (document.updated_at,), None
+    favourites = _aggregates(func.count(), func.max(Favourite.updated_at), func.max(Car.updated_at)) \
+        .join(Car, Car.id == Favourite.car_id) \
+        .where(Favourite.user_id == user_id).subquery()
+    row = session.execute(
+        select(
+            User.updated_at,
+            select(Profile.updated_at).where(Profile.user_id == user_id).scalar_subquery(),
+            *favourites.c,
+        ).join(favourites, true()).where(User.id == user_id)
+    ).one_or_none()
+    return (tuple(row), None) if row is not None else None
+
+
+def car(car_id, session=None):
+    session = session or db.session
+    favourites = _aggregates(func.count(), func.max(Favourite.updated_at), func.max(User.updated_at)) \
+        .join(User, User.id == Favourite.user_id) \
+        .where(Favourite.car_id == car_id).subquery()
+    row = session.execute(
+        select(Car.updated_at, *favourites.c).join(favourites, true()).where(Car.id == car_id)
+    ).one_or_none()
+    return (tuple(row), None) if row is not None else None
+
+
+def profile(user_id, session=None):
+    session = session or db.session
+    updated_at = session.execute(
+        select(Profile.updated_at).where(Profile.user_id == user_id)
+    ).scalar_one_or_none()
+    return ((updated_at,), updated_at) if updated_at is not None else None
+
+
+def favourite(favourite_id, session=None):
+    session = session or db.session
+    row = session.execute(
+        select(Favourite.updated_at, User.updated_at, Car.updated_at)
+        .outerjoin(User, User.id == Favourite.user_id)
+        .outerjoin(Car, Car.id == Favourite.car_id)
+        .where(Favourite.id == favourite_id)
+    ).one_or_none()
+    if row is None:
+        return None
+    return tuple(row), max(value for value in row if value is not None)
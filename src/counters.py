@@ -0,0 +1,50 @@
+"""
+Denormalised favourite counters on cars.
+
+`Car.favourite_count` is kept in step by every write that adds, moves or
+removes a favourite, in the same transaction as the write itself, with an
+atomic `favourite_count = favourite_count + :delta`. GET /cars/top reads
+the start of the (favourite_count DESC, id) index, its exact ORDER BY, so
+it costs n index entries however many favourites there are.
+
+Anything that changes favourites outside the API (the admin, a manual
+fix, deleting users in SQLite where foreign keys aren't enforced) can make
+the counters drift; `flask reconcile-favourites` recomputes them.
+"""
+from collections import Counter
+from sqlalchemy import select, update, func, bindparam
+from models import db, Car, Favourite
+
+TOP_DEFAULT = 10
+TOP_MAX = 100
+
+cars = Car.__table__
+
+
+def adjust_favourite_counts(deltas):
+    """Apply {car_id: delta} with one executemany UPDATE, not committed."""
+    deltas = {car_id: delta for car_id, delta in Counter(deltas).items() if delta}
+    if not deltas:
+        return
+    stmt = update(cars).where(cars.c.id == bindparam('car')) \
+        .values(favourite_count=cars.c.favourite_count + bindparam('delta'))
+    db.session.execute(stmt, [{'car': car_id, 'delta': delta} for car_id, delta in deltas.items()])
+
+
+def top_cars(n):
+    stmt = select(Car.id, Car.model, Car.year, Car.name, Car.favourite_count) \
+        .order_by(Car.favourite_count.desc(), Car.id).limit(n)
+    return [
+        {'id': car_id, 'model': model, 'year': year, 'name': name, 'favourite_count': count}
+        for car_id, model, year, name, count in db.session.execute(stmt)
+    ]
+
+
+def reconcile_favourite_counts():
+    """Recompute every counter that drifted, return how many were fixed."""
+    actual = select(func.count()).where(Favourite.car_id == cars.c.id).scalar_subquery()
+    result = db.session.execute(
+        update(cars).where(cars.c.favourite_count != actual).values(favourite_count=actual)
+    )
+    db.session.commit()
+    return result.rowcount
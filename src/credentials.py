@@ -0,0 +1,248 @@
+"""
+Password hashing.
+
+Passwords are stored as self-describing strings, so the parameters can be
+raised later without invalidating anything:
+
+    $scrypt$ln=14,r=8,p=1$<salt>$<hash>     hashlib.scrypt, always available
+    $argon2id$v=19$m=...,t=...,p=...$...    argon2-cffi, when installed
+
+PASSWORD_KDF picks the algorithm for new hashes (`argon2` when argon2-cffi
+is installed, `scrypt` otherwise). The cost is set with PASSWORD_SCRYPT_LN /
+_R / _P or PASSWORD_ARGON2_TIME / _MEMORY (KiB) / _PARALLELISM. Pick them
+with benchmarks/bench_passwords.py, which calibrates them to a target time
+per hash on the production machine. Every worker must use the same values,
+or users would be rehashed back and forth.
+
+verify_and_update() is what a login calls: when the stored hash was made
+with other parameters (or is a plaintext password from before hashing) and
+the password is right, it also returns the new hash to store. A stored
+hash it can't check (corrupt, or argon2 without argon2-cffi installed)
+never matches: the login fails like a wrong password, and the
+`api.credentials` logger says why.
+
+The KDF runs in a bounded thread pool (both scrypt and argon2 release the
+GIL), PASSWORD_HASH_WORKERS threads and at most PASSWORD_HASH_QUEUE pending
+jobs per worker process. A request that finds the queue full gets a 503
+straight away instead of piling up behind the CPU.
+
+settings() reads the variables into app.config and init_app() builds the
+app's KDF and pool (app.extensions['credentials']) from there.
+"""
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from utils import APIException
+
+try:
+    import argon2
+except ImportError:  # optional dependency
+    argon2 = None
+
+log = logging.getLogger('api.credentials')
+
+
+def settings():
+    """app.config entries read from the environment, see the module docstring."""
+    workers = int(os.getenv('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+    return {
+        'PASSWORD_KDF': os.getenv('PASSWORD_KDF', 'argon2' if argon2 is not None else 'scrypt'),
+        'PASSWORD_SCRYPT_LN': int(os.getenv('PASSWORD_SCRYPT_LN', 14)),
+        'PASSWORD_SCRYPT_R': int(os.getenv('PASSWORD_SCRYPT_R', 8)),
+        'PASSWORD_SCRYPT_P': int(os.getenv('PASSWORD_SCRYPT_P', 1)),
+        'PASSWORD_ARGON2_TIME': int(os.getenv('PASSWORD_ARGON2_TIME', 2)),
+        'PASSWORD_ARGON2_MEMORY': int(os.getenv('PASSWORD_ARGON2_MEMORY', 19456)),
+        'PASSWORD_ARGON2_PARALLELISM': int(os.getenv('PASSWORD_ARGON2_PARALLELISM', 1)),
+        'PASSWORD_HASH_WORKERS': workers,
+        'PASSWORD_HASH_QUEUE': int(os.getenv('PASSWORD_HASH_QUEUE', 4 * workers)),
+        'PASSWORD_HASH_TIMEOUT': float(os.getenv('PASSWORD_HASH_TIMEOUT', 10)),
+    }
+
+
+def _b64(data):
+    return base64.b64encode(data).decode().rstrip('=')
+
+
+def _unb64(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+class Scrypt:
+    prefix = '$scrypt$'
+
+    def __init__(self, ln=14, r=8, p=1):
+        self.ln, self.r, self.p = ln, r, p
+
+    def _derive(self, password, salt, ln, r, p):
+        return hashlib.scrypt(password.encode(), salt=salt, n=2 ** ln, r=r, p=p,
+                              maxmem=2 ** ln * r * 128 * 2, dklen=32)
+
+    def hash(self, password):
+        salt = secrets.token_bytes(16)
+        key = self._derive(password, salt, self.ln, self.r, self.p)
+        return f'$scrypt$ln={self.ln},r={self.r},p={self.p}${_b64(salt)}${_b64(key)}'
+
+    def _parse(self, stored):
+        _, _, params, salt, key = stored.split('$')
+        params = dict(item.split('=') for item in params.split(','))
+        ln, r, p = int(params['ln']), int(params['r']), int(params['p'])
+        # a corrupt row mustn't make scrypt allocate gigabytes
+        if not (1 <= ln <= 24 and 1 <= r <= 64 and 1 <= p <= 16):
+            raise ValueError(f'scrypt parameters out of range: ln={ln},r={r},p={p}')
+        return ln, r, p, _unb64(salt), _unb64(key)
+
+    def verify(self, stored, password):
+        try:
+            ln, r, p, salt, key = self._parse(stored)
+            derived = self._derive(password, salt, ln, r, p)
+        except (ValueError, KeyError, OverflowError, MemoryError):
+            # malformed fields, bad base64 or parameters scrypt refuses
+            log.warning('unreadable scrypt hash')
+            return False
+        return hmac.compare_digest(derived, key)
+
+    def needs_rehash(self, stored):
+        return self._parse(stored)[:3] != (self.ln, self.r, self.p)
+
+
+class Argon2:
+    prefix = '$argon2'
+
+    def __init__(self, time_cost=2, memory_cost=19456, parallelism=1):
+        if argon2 is None:
+            raise RuntimeError('PASSWORD_KDF=argon2 but argon2-cffi is not installed')
+        self.hasher = argon2.PasswordHasher(time_cost=time_cost, memory_cost=memory_cost,
+                                            parallelism=parallelism)
+
+    def hash(self, password):
+        return self.hasher.hash(password)
+
+    def verify(self, stored, password):
+        try:
+            return self.hasher.verify(stored, password)
+        except argon2.exceptions.InvalidHashError:
+            log.warning('unreadable argon2 hash')
+            return False
+        except argon2.exceptions.VerificationError:
+            # VerifyMismatchError included
+            return False
+
+    def needs_rehash(self, stored):
+        return self.hasher.check_needs_rehash(stored)
+
+
+def kdf_from_config(config):
+    name = config['PASSWORD_KDF']
+    if name == 'scrypt':
+        return Scrypt(config['PASSWORD_SCRYPT_LN'], config['PASSWORD_SCRYPT_R'], config['PASSWORD_SCRYPT_P'])
+    if name == 'argon2':
+        return Argon2(config['PASSWORD_ARGON2_TIME'], config['PASSWORD_ARGON2_MEMORY'],
+                      config['PASSWORD_ARGON2_PARALLELISM'])
+    raise RuntimeError(f'Unsupported PASSWORD_KDF: {name}')
+
+
+class HashPool:
+    """Thread pool with a bounded number of pending jobs."""
+
+    def __init__(self, workers, queue, timeout):
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        self.slots = threading.BoundedSemaphore(queue)
+
+    def run(self, fn, *args):
+        return self.map(fn, [args])[0]
+
+    def map(self, fn, args_list):
+        """Run fn(*args) for each args in the pool, results in order."""
+        futures = []
+        try:
+            for args in args_list:
+                if not self.slots.acquire(blocking=False):
+                    raise APIException('Too many password operations in progress, retry later',
+                                       status_code=503)
+                future = self.executor.submit(fn, *args)
+                future.add_done_callback(lambda _: self.slots.release())
+                futures.append(future)
+            return [future.result(timeout=self.timeout) for future in futures]
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+
+
+class Credentials:
+    def __init__(self, kdf, pool):
+        self.kdf = kdf
+        self.pool = pool
+
+    def hash(self, password):
+        return self.pool.run(self.kdf.hash, password)
+
+    def hash_many(self, passwords):
+        """Hash a batch (bulk imports), one job per pool thread at a time."""
+        hashes = []
+        workers = self.pool.workers
+        for start in range(0, len(passwords), workers):
+            chunk = passwords[start:start + workers]
+            hashes.extend(self.pool.map(self.kdf.hash, [(password,) for password in chunk]))
+        return hashes
+
+    def _scheme(self, stored):
+        for kdf in (Scrypt, Argon2):
+            if stored.startswith(kdf.prefix):
+                return kdf
+        return None
+
+    def _verify(self, stored, password):
+        scheme = self._scheme(stored)
+        if scheme is None:
+            # stored before passwords were hashed
+            ok = hmac.compare_digest(stored.encode(), password.encode())
+            return ok, ok
+        if isinstance(self.kdf, scheme):
+            ok = self.kdf.verify(stored, password)
+            return ok, ok and self.kdf.needs_rehash(stored)
+        if scheme is Argon2 and argon2 is None:
+            log.warning('argon2 hash stored but argon2-cffi is not installed')
+            return False, False
+        return scheme().verify(stored, password), True
+
+    def verify_and_update(self, stored, password):
+        """Return (valid, new_hash). new_hash is None unless it must be stored."""
+        valid, rehash = self.pool.run(self._verify, stored, password)
+        if not valid or not rehash:
+            return valid, None
+        return True, self.hash(password)
+
+
+def from_config(config):
+    return Credentials(kdf_from_config(config), HashPool(
+        config['PASSWORD_HASH_WORKERS'], config['PASSWORD_HASH_QUEUE'], config['PASSWORD_HASH_TIMEOUT']))
+
+
+def init_app(app):
+    app.extensions['credentials'] = from_config(app.config)
+
+
+def _credentials():
+    return current_app.extensions['credentials']
+
+
+def hash_password(password):
+    return _credentials().hash(password)
+
+
+def hash_passwords(passwords):
+    return _credentials().hash_many(passwords)
+
+
+def verify_password(stored, password):
+    """Return (valid, new_hash), see Credentials.verify_and_update()."""
+    return _credentials().verify_and_update(stored, password)
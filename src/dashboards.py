@@ -0,0 +1,166 @@
+"""
+Materialised GET /users/<id>: every user's document, stored already encoded.
+
+`user_dashboards` holds one row per user with the body GET /users/<id>
+answers, in full and in ?compact=1 form. The writes that change what the
+document embeds re-render the rows of the users they touch, in their own
+transaction:
+
+    user create/update, profile create/update/delete   that user
+    favourite add/move/delete, bulk included            the users involved
+    car rename or delete                                the users who favourite it
+
+so the GET is one primary-key fetch of ready bytes, and its ETag is the
+row's updated_at. The validator (conditional.user) reads both in that
+one query and leaves the body in g for the view, see stored(). Without a row, e.g. on a database that
+predates the table until `flask rebuild-dashboards` has run, the view
+serializes the user as before.
+
+refresh() first locks the users' rows (FOR UPDATE, PostgreSQL), so two
+writes on one user render one after the other and the last document has
+both. Writes that bypass the API (the admin, manual SQL) are not seen:
+`flask check-dashboards` compares every stored document with a fresh
+rendering and reports the users that differ, --repair rewrites them.
+"""
+from flask import current_app, g
+from sqlalchemy import select, insert, delete
+from models import db, User, Favourite, UserDashboard, utcnow
+from listing import wants_compact
+import serializers
+
+DASHBOARD_BATCH = 500
+
+
+def _batches(ids):
+    for start in range(0, len(ids), DASHBOARD_BATCH):
+        yield ids[start:start + DASHBOARD_BATCH]
+
+
+def render(user_ids, session=None):
+    """{user_id: (body, compact body)} built from the tables."""
+    session = session or db.session
+    dumps = current_app.json.dumps
+    rows = session.execute(serializers.USER.base.where(User.id.in_(user_ids))).all()
+    return {
+        user_id: (dumps(item, separators=(',', ':')), dumps(serializers.compact(item), separators=(',', ':')))
+        for user_id, item in serializers.USER.items(rows, session)
+    }
+
+
+def refresh(user_ids):
+    """Re-render the documents of `user_ids`, not committed.
+
+    Users that don't exist (any more) lose their row.
+    """
+    user_ids = sorted(set(user_ids))
+    for batch in _batches(user_ids):
+        # same order in every transaction, no deadlocks between them
+        db.session.execute(select(User.id).where(User.id.in_(batch)).order_by(User.id).with_for_update())
+        documents = render(batch)
+        db.session.execute(delete(UserDashboard).where(UserDashboard.user_id.in_(batch)))
+        if documents:
+            now = utcnow()
+            db.session.execute(insert(UserDashboard), [
+                {'user_id': user_id, 'body': body, 'compact': compact, 'updated_at': now}
+                for user_id, (body, compact) in documents.items()
+            ])
+
+
+def refresh_car(car_id):
+    """Re-render the users who favourite `car_id`, return their ids."""
+    user_ids = db.session.execute(
+        select(Favourite.user_id).where(Favourite.car_id == car_id).distinct()
+    ).scalars().all()
+    refresh(user_ids)
+    return user_ids
+
+
+def forget(user_id):
+    """Drop the document of a user about to be deleted, not committed."""
+    db.session.execute(delete(UserDashboard).where(UserDashboard.user_id == user_id))
+
+
+def document(user_id, compact=False, session=None):
+    column = UserDashboard.compact if compact else UserDashboard.body
+    return (session or db.session).execute(
+        select(column).where(UserDashboard.user_id == user_id)
+    ).scalar_one_or_none()
+
+
+def stored(user_id, session=None):
+    """(updated_at, body) of the document the request asks for, or None.
+
+    The body is kept in g for current(), the view doesn't read it again.
+    """
+    column = UserDashboard.compact if wants_compact() else UserDashboard.body
+    row = (session or db.session).execute(
+        select(UserDashboard.updated_at, column).where(UserDashboard.user_id == user_id)
+    ).one_or_none()
+    g.dashboard = row[1] if row is not None else None
+    return row
+
+
+def current(user_id, session=None):
+    """The body of GET /users/<id>: the one stored() read, else from the table."""
+    if 'dashboard' in g:
+        return g.pop('dashboard')
+    return document(user_id, wants_compact(), session)
+
+
+def response(user_id):
+    """GET /users/<id> from the stored document, None when there is none."""
+    body = current(user_id)
+    if body is None:
+        return None
+    return current_app.response_class(body + '\n', mimetype=current_app.json.mimetype)
+
+
+def _user_ids():
+    """Every user id, DASHBOARD_BATCH at a time, walking the primary key."""
+    last = 0
+    while True:
+        batch = db.session.execute(
+            select(User.id).where(User.id > last).order_by(User.id).limit(DASHBOARD_BATCH)
+        ).scalars().all()
+        if not batch:
+            return
+        yield batch
+        last = batch[-1]
+
+
+def rebuild():
+    """Render every document again, one transaction per batch; return how many."""
+    total = 0
+    for batch in _user_ids():
+        refresh(batch)
+        db.session.commit()
+        total += len(batch)
+    db.session.execute(delete(UserDashboard).where(UserDashboard.user_id.not_in(select(User.id))))
+    db.session.commit()
+    return total
+
+
+def check(repair=False):
+    """Ids of the users whose stored document is missing, stale or orphaned.
+
+    Writes running meanwhile can show up as false positives, run it again
+    on the ids it reports before worrying.
+    """
+    stale = []
+    for batch in _user_ids():
+        stored = {
+            user_id: (body, compact) for user_id, body, compact in db.session.execute(
+                select(UserDashboard.user_id, UserDashboard.body, UserDashboard.compact)
+                .where(UserDashboard.user_id.in_(batch))
+            )
+        }
+        fresh = render(batch)
+        stale.extend(user_id for user_id in batch if stored.get(user_id) != fresh.get(user_id))
+    stale.extend(db.session.execute(
+        select(UserDashboard.user_id).where(UserDashboard.user_id.not_in(select(User.id)))
+    ).scalars())
+    db.session.rollback()
+    if repair and stale:
+        refresh(stale)
+        db.session.commit()
+    return stale
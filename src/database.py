@@ -0,0 +1,208 @@
+"""
+Engine and connection pool configuration, all from the environment.
+
+Every gunicorn worker has its own pool, so the budget is split between them:
+
+    DB_MAX_CONNECTIONS   connections this service may open in total (20)
+    WEB_CONCURRENCY      gunicorn workers (1), the pool of each worker gets
+                         DB_MAX_CONNECTIONS / WEB_CONCURRENCY, overflow included
+    DB_POOL_SIZE         overrides the computed pool size
+    DB_MAX_OVERFLOW      extra connections above the pool size (0)
+    DB_POOL_TIMEOUT      seconds to wait for a free connection (10)
+    DB_POOL_RECYCLE      reopen connections older than this, in seconds (1800)
+    DB_POOL_PRE_PING     check connections before use, 0 to disable (1)
+    DB_STATEMENT_TIMEOUT PostgreSQL statement_timeout in ms, 0 is none (0)
+    DB_PGBOUNCER         1 when DATABASE_URL points at PgBouncer in
+                         transaction mode: PgBouncer does the pooling
+                         (NullPool here) and statement_timeout is set per
+                         transaction instead of as a startup option, which
+                         PgBouncer rejects.
+
+asgi.py builds its engine from the same variables with async_engine_options().
+
+after_fork() is for gunicorn --preload, see gunicorn.conf.py.
+
+pool_status() returns live numbers of the pool of the current worker
+(checked out, overflow, how long requests waited for a connection).
+"""
+import os
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import QueuePool, NullPool
+
+
+def _int(name, default):
+    return int(os.getenv(name, default))
+
+
+def _flag(name, default):
+    return os.getenv(name, default) not in ('0', 'false', '')
+
+
+class PoolMetrics:
+    """Counters updated by the pool of this process."""
+
+    # how fast recent_wait() forgets, in seconds
+    HALF_LIFE = 5.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.recent = 0.0
+        self.recent_at = time.monotonic()
+
+    def _decayed(self, now):
+        return self.recent * 0.5 ** ((now - self.recent_at) / self.HALF_LIFE)
+
+    def record(self, seconds, timed_out=False):
+        now = time.monotonic()
+        with self.lock:
+            self.waits += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+            self.recent = 0.8 * self._decayed(now) + 0.2 * seconds
+            self.recent_at = now
+
+    def recent_wait(self):
+        """Moving average of the checkout waits, fading when nothing checks out."""
+        return self._decayed(time.monotonic())
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'checkouts': self.waits,
+                'wait_avg_ms': round(1000 * self.wait_total / self.waits, 3) if self.waits else 0.0,
+                'wait_max_ms': round(1000 * self.wait_max, 3),
+                'timeouts': self.timeouts,
+                'recent_wait_ms': round(1000 * self._decayed(time.monotonic()), 3),
+            }
+
+
+metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        metrics.record(time.perf_counter() - start)
+        return connection
+
+
+def pgbouncer():
+    return _flag('DB_PGBOUNCER', '0')
+
+
+def engine_options(url):
+    """SQLALCHEMY_ENGINE_OPTIONS for `url`."""
+    if url.startswith('sqlite'):
+        return {}
+
+    options = {'pool_pre_ping': _flag('DB_POOL_PRE_PING', '1')}
+    timeout = _int('DB_STATEMENT_TIMEOUT', 0)
+
+    if pgbouncer():
+        options['poolclass'] = NullPool
+        return options
+
+    workers = max(1, _int('WEB_CONCURRENCY', 1))
+    overflow = _int('DB_MAX_OVERFLOW', 0)
+    size = os.getenv('DB_POOL_SIZE')
+    size = int(size) if size else _int('DB_MAX_CONNECTIONS', 20) // workers - overflow
+    options.update(
+        poolclass=TimedQueuePool,
+        pool_size=max(1, size),
+        max_overflow=overflow,
+        pool_timeout=_int('DB_POOL_TIMEOUT', 10),
+        pool_recycle=_int('DB_POOL_RECYCLE', 1800),
+    )
+    if timeout and url.startswith('postgresql'):
+        options['connect_args'] = {'options': f'-c statement_timeout={timeout}'}
+    return options
+
+
+def async_url(url):
+    """DATABASE_URL with the async driver: asyncpg or aiosqlite."""
+    scheme, rest = url.split('://', 1)
+    if scheme.split('+')[0] in ('postgres', 'postgresql'):
+        return 'postgresql+asyncpg://' + rest
+    if scheme.split('+')[0] == 'sqlite':
+        return 'sqlite+aiosqlite://' + rest
+    raise ValueError(f'No async driver configured for {scheme}://')
+
+
+def async_engine_options(url):
+    """engine_options() for create_async_engine().
+
+    The async engine brings its own pool class (AsyncAdaptedQueuePool), and
+    asyncpg takes server settings instead of libpq startup options.
+    """
+    options = engine_options(url)
+    if options.get('poolclass') is TimedQueuePool:
+        del options['poolclass']
+    options.pop('connect_args', None)
+    if url.startswith('sqlite'):
+        return options
+    connect_args = {}
+    timeout = _int('DB_STATEMENT_TIMEOUT', 0)
+    if timeout and not pgbouncer():
+        connect_args['server_settings'] = {'statement_timeout': str(timeout)}
+    if pgbouncer():
+        # prepared statements don't survive PgBouncer's transaction pooling
+        connect_args['statement_cache_size'] = 0
+        connect_args['prepared_statement_cache_size'] = 0
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+def instrument(engine):
+    """Per-engine setup that can't go through engine_options()."""
+    timeout = _int('DB_STATEMENT_TIMEOUT', 0)
+    if timeout and pgbouncer() and engine.dialect.name == 'postgresql':
+        # SET LOCAL only lasts until the end of the transaction, so the
+        # server connection goes back to PgBouncer unchanged
+        @event.listens_for(Session, 'after_begin')
+        def statement_timeout(session, transaction, connection):
+            if connection.engine is engine:
+                connection.exec_driver_sql(f'SET LOCAL statement_timeout = {timeout}')
+
+
+def after_fork(engine):
+    """Start the pool of a forked worker empty.
+
+    Connections opened by the parent (a --preload master that touched the
+    database) must not be shared: close=False leaves them to the parent
+    instead of closing its sockets from here.
+    """
+    engine.dispose(close=False)
+    global metrics
+    metrics = PoolMetrics()
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {'pool': type(pool).__name__, 'pid': os.getpid()}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(0, pool.overflow()),
+            max_overflow=pool._max_overflow,
+        )
+    status.update(metrics.to_dict())
+    return status
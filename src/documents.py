@@ -0,0 +1,107 @@
+"""
+Responses that only depend on the URL map: the sitemap (GET /) and the
+OpenAPI document of every route (GET /openapi.json).
+
+Flask refuses new routes once the app has handled a request, so both are
+built once, by init_app() at the end of create_app(), and kept encoded and
+gzipped along with their ETags. Serving one is a dict lookup: a 304 when
+the client already has it, the gzipped bytes when it accepts gzip.
+"""
+import gzip
+import hashlib
+import json
+import re
+from flask import Response, current_app, request
+from utils import generate_sitemap
+
+# <int:user_id> -> name, OpenAPI type
+PARAMETER = re.compile(r'<(?:(\w+)(?:\([^)]*\))?:)?(\w+)>')
+TYPES = {'int': 'integer', 'float': 'number'}
+BODY_METHODS = {'POST', 'PUT', 'PATCH'}
+
+
+class Document:
+    """A response body built once, with its ETag and gzipped variant."""
+
+    def __init__(self, body, mimetype):
+        self.body = body
+        self.gzipped = gzip.compress(body, compresslevel=9, mtime=0)
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(body).hexdigest()
+        # a strong ETag belongs to one representation
+        self.gzip_etag = self.etag + '-gz'
+
+    def response(self):
+        use_gzip = request.accept_encodings['gzip'] > 0
+        etag = self.gzip_etag if use_gzip else self.etag
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        elif use_gzip:
+            response = Response(self.gzipped, mimetype=self.mimetype)
+            response.content_encoding = 'gzip'
+        else:
+            response = Response(self.body, mimetype=self.mimetype)
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.no_cache = True  # revalidate, it changes with each deploy
+        return response
+
+
+def _operation(rule, method, view):
+    doc = (view.__doc__ or '').strip()
+    methods = rule.methods - {'HEAD', 'OPTIONS'}
+    operation = {
+        'operationId': rule.endpoint if len(methods) == 1 else f'{rule.endpoint}.{method.lower()}',
+        'summary': doc.splitlines()[0] if doc else rule.endpoint.rpartition('.')[2].replace('_', ' '),
+        'tags': [rule.rule.strip('/').split('/')[0] or 'root'],
+        'responses': {'200': {'description': 'OK'}},
+    }
+    parameters = [
+        {'name': name, 'in': 'path', 'required': True, 'schema': {'type': TYPES.get(converter, 'string')}}
+        for converter, name in PARAMETER.findall(rule.rule)
+    ]
+    if parameters:
+        operation['parameters'] = parameters
+    schema = getattr(view, 'schema', None)
+    if schema is not None:
+        operation['requestBody'] = {'required': True,
+                                    'content': {'application/json': {'schema': schema.json_schema()}}}
+        operation['responses']['400'] = {'description': 'Invalid body, `field` names the first bad field'}
+    elif method in BODY_METHODS:
+        operation['requestBody'] = {'content': {'application/json': {'schema': {'type': 'object'}}}}
+    if getattr(view, 'requires_token', False):
+        operation['security'] = [{'bearer': []}]
+        operation['responses']['401'] = {'description': 'Missing, invalid or revoked token'}
+    return operation
+
+
+def openapi(app):
+    paths = {}
+    for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+        if rule.endpoint == 'static' or rule.rule.startswith('/admin'):
+            continue
+        view = app.view_functions[rule.endpoint]
+        path = paths.setdefault(PARAMETER.sub(r'{\2}', rule.rule), {})
+        for method in sorted(rule.methods - {'HEAD', 'OPTIONS'}):
+            path[method.lower()] = _operation(rule, method, view)
+    return {
+        'openapi': '3.0.3',
+        'info': {'title': '4Geeks API', 'version': '1.0'},
+        'paths': paths,
+        'components': {'securitySchemes': {'bearer': {'type': 'http', 'scheme': 'bearer', 'bearerFormat': 'JWT'}}},
+    }
+
+
+def init_app(app):
+    """Build the documents, once every route is registered."""
+    with app.test_request_context():
+        sitemap = generate_sitemap(app).encode()
+    spec = json.dumps(openapi(app), sort_keys=True, separators=(',', ':')).encode()
+    app.extensions['documents'] = {
+        'sitemap': Document(sitemap, 'text/html'),
+        'openapi': Document(spec, 'application/json'),
+    }
+
+
+def serve(name):
+    return current_app.extensions['documents'][name].response()
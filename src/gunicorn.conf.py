@@ -0,0 +1,36 @@
+"""
+gunicorn settings. `gunicorn wsgi --chdir src` (the Procfile) reads this
+file on its own, it is looked up in the --chdir directory.
+
+The app is built once in the master and the workers are forked from it
+(preload_app), so they start serving right away and share the pages of the
+imported modules. GUNICORN_PRELOAD=0 goes back to one import per worker,
+which `kill -HUP` needs to pick up new code.
+
+Each worker serves GUNICORN_THREADS (8) requests at a time (gthread), so a
+long-polling GET /changes or a /changes/stream client (outbox.py) holds one
+thread, not the whole worker. A worker that stops answering for
+GUNICORN_TIMEOUT (120) seconds is restarted; with threads that is the
+worker's main loop, a slow request doesn't count, but the change feed
+still ends its waits well before it (outbox.WORKER_TIMEOUT).
+"""
+import os
+import sys
+
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') not in ('0', 'false')
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+
+
+def post_fork(server, worker):
+    wsgi = sys.modules.get('wsgi')
+    if wsgi is None:
+        # not preloaded, the worker imports wsgi itself
+        return
+    import database
+    from models import db
+    with wsgi.application.app_context():
+        for engine in db.engines.values():
+            database.after_fork(engine)
@@ -0,0 +1,236 @@
+"""
+Per-request SQL and latency instrumentation.
+
+For every request it records the number of SQL statements, the time spent
+in the database, the time spent encoding JSON and the total latency:
+
+- as a `Server-Timing` header (db, json, app and total, in ms), visible in
+  the browser devtools,
+- as Prometheus counters at `GET /metrics`, labelled by route and method
+  (an admin's token or OPS_TOKEN, see auth.py),
+- in the `api.sql` logger: any statement slower than SLOW_QUERY_MS (200)
+  and any statement repeated N_PLUS_ONE_THRESHOLD (10) times or more in a
+  single request, which is how an N+1 looks from the database, are logged
+  as warnings with the route that ran them.
+
+Set METRICS_ENABLED=0 to turn all of it off. Like the cache and the pool,
+numbers are per worker process, and per app: settings() reads the
+variables into app.config, init_app() keeps the app's counters in
+app.extensions['metrics'].
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import current_app, g, request, has_request_context, Response
+from sqlalchemy import event
+from auth import operator
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+log = logging.getLogger('api.sql')
+
+
+def settings():
+    """app.config entries read from the environment, see the module docstring."""
+    return {
+        'METRICS_ENABLED': os.getenv('METRICS_ENABLED', '1') not in ('0', 'false'),
+        'SLOW_QUERY_MS': float(os.getenv('SLOW_QUERY_MS', 200)),
+        'N_PLUS_ONE_THRESHOLD': int(os.getenv('N_PLUS_ONE_THRESHOLD', 10)),
+    }
+
+
+class RequestStats:
+    """What one request has cost so far."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.json = 0.0
+        self.in_json = False
+        self.statements = Counter()
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+
+class Metrics:
+    """Prometheus counters and histograms, by (route, method)."""
+
+    def __init__(self, slow_query_ms):
+        self.slow_query_ms = slow_query_ms
+        self.lock = threading.Lock()
+        self.requests = Counter()           # (route, method, status)
+        self.queries = Counter()            # (route, method)
+        self.sums = defaultdict(float)      # (name, route, method)
+        self.buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self.counts = Counter()             # (route, method), for the histogram
+        self.slow = Counter()
+        self.n_plus_one = Counter()
+
+    def observe(self, route, method, status, stats, total):
+        key = (route, method)
+        with self.lock:
+            self.requests[(route, method, status)] += 1
+            self.queries[key] += stats.queries
+            self.sums[('db', route, method)] += stats.db
+            self.sums[('json', route, method)] += stats.json
+            self.sums[('total', route, method)] += total
+            self.counts[key] += 1
+            buckets = self.buckets[key]
+            for i, bound in enumerate(BUCKETS):
+                if total <= bound:
+                    buckets[i] += 1
+
+    def render(self):
+        lines = []
+
+        def family(name, kind, help):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        with self.lock:
+            family('api_requests_total', 'counter', 'Requests by route, method and status.')
+            for (route, method, status), value in sorted(self.requests.items()):
+                lines.append(f'api_requests_total{{route="{route}",method="{method}",status="{status}"}} {value}')
+
+            family('api_request_duration_seconds', 'histogram', 'Request latency.')
+            for (route, method), buckets in sorted(self.buckets.items()):
+                labels = f'route="{route}",method="{method}"'
+                for bound, value in zip(BUCKETS, buckets):
+                    lines.append(f'api_request_duration_seconds_bucket{{{labels},le="{bound}"}} {value}')
+                count = self.counts[(route, method)]
+                lines.append(f'api_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+                lines.append(f'api_request_duration_seconds_sum{{{labels}}} {self.sums[("total", route, method)]:.6f}')
+                lines.append(f'api_request_duration_seconds_count{{{labels}}} {count}')
+
+            family('api_db_queries_total', 'counter', 'SQL statements run by each route.')
+            for (route, method), value in sorted(self.queries.items()):
+                lines.append(f'api_db_queries_total{{route="{route}",method="{method}"}} {value}')
+
+            for name, help in (('db', 'Time spent in the database.'), ('json', 'Time spent encoding JSON.')):
+                family(f'api_{name}_seconds_total', 'counter', help)
+                for (kind, route, method), value in sorted(self.sums.items()):
+                    if kind == name:
+                        lines.append(f'api_{name}_seconds_total{{route="{route}",method="{method}"}} {value:.6f}')
+
+            family('api_slow_queries_total', 'counter', f'Statements slower than {self.slow_query_ms:g} ms.')
+            for route, value in sorted(self.slow.items()):
+                lines.append(f'api_slow_queries_total{{route="{route}"}} {value}')
+
+            family('api_n_plus_one_total', 'counter', 'Requests repeating a statement, see N_PLUS_ONE_THRESHOLD.')
+            for route, value in sorted(self.n_plus_one.items()):
+                lines.append(f'api_n_plus_one_total{{route="{route}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+
+
+def _stats():
+    if has_request_context():
+        return g.get('request_stats')
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    stats = _stats()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.db += elapsed
+    stats.statements[statement] += 1
+    metrics = current_app.extensions['metrics']
+    if elapsed * 1000 >= metrics.slow_query_ms:
+        route = _route()
+        with metrics.lock:
+            metrics.slow[route] += 1
+        log.warning('slow query %.1f ms in %s %s: %s', elapsed * 1000, request.method, route, statement)
+
+
+def _timed_json(provider):
+    """Add the time spent in app.json.response()/dumps() to the request."""
+    for name in ('response', 'dumps'):
+        original = getattr(provider, name)
+
+        def timed(*args, _original=original, **kwargs):
+            stats = _stats()
+            # response() may call dumps(), only the outer call is timed
+            if stats is None or stats.in_json:
+                return _original(*args, **kwargs)
+            stats.in_json = True
+            start = time.perf_counter()
+            try:
+                return _original(*args, **kwargs)
+            finally:
+                stats.json += time.perf_counter() - start
+                stats.in_json = False
+        setattr(provider, name, timed)
+
+
+def watch(engine):
+    """Count the statements of `engine` in the request that runs them."""
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_app(app, *engines):
+    """Install the hooks on `app` and `engines` and add GET /metrics."""
+    if not app.config['METRICS_ENABLED']:
+        return
+    metrics = app.extensions['metrics'] = Metrics(app.config['SLOW_QUERY_MS'])
+    threshold = app.config['N_PLUS_ONE_THRESHOLD']
+
+    for engine in engines:
+        watch(engine)
+    _timed_json(app.json)
+
+    @app.before_request
+    def start_request():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def server_timing(response):
+        stats = _stats()
+        if stats is not None:
+            total = stats.total()
+            other = max(0.0, total - stats.db - stats.json)
+            response.headers['Server-Timing'] = ', '.join([
+                f'db;dur={stats.db * 1000:.1f};desc="{stats.queries} queries"',
+                f'json;dur={stats.json * 1000:.1f}',
+                f'app;dur={other * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ])
+            g.response_status = response.status_code
+        return response
+
+    # teardown runs after streamed bodies are fully sent, so their queries count
+    @app.teardown_request
+    def record(error=None):
+        stats = _stats()
+        if stats is None or request.endpoint == 'get_metrics':
+            return
+        route = _route()
+        status = g.get('response_status', 500)
+        metrics.observe(route, request.method, status, stats, stats.total())
+        repeated = [(s, n) for s, n in stats.statements.items() if n >= threshold]
+        # long polls repeat their query on purpose, see outbox.py
+        if repeated and not g.get('polling'):
+            with metrics.lock:
+                metrics.n_plus_one[route] += 1
+            for statement, count in repeated:
+                log.warning('possible N+1 in %s %s, statement ran %d times: %s',
+                            request.method, route, count, statement)
+
+    @app.route('/metrics', methods=['GET'])
+    @operator
+    def get_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,262 @@
+"""
+Keyset pagination, sparse fields and filters for the collection endpoints.
+
+    GET /cars?limit=50&after=1200&year=2020&fields=id,name
+
+- `limit` rows per page (default 100, max 1000).
+- `after` is the cursor: the last `id` of the previous page. Pages are read
+  with WHERE id > :after ORDER BY id LIMIT :limit, so page 10.000 costs the
+  same as page 1 (no OFFSET scan).
+- `fields` keeps only some keys of serialize(). When every requested field is
+  a plain column only those columns are SELECTed.
+- Rows are turned into dicts by the column serializers in serializers.py, no
+  ORM objects are built for reads.
+- The body is still a JSON list, the next page goes in the `Link` header
+  (rel="next") and in `X-Next-Cursor`.
+- `?stream=1` or `Accept: application/x-ndjson` returns every matching row
+  (no limit) as newline delimited JSON, read in batches from a server-side
+  cursor and written out as it is produced so memory stays flat.
+- `?compact=1` sends the embedded `favourites` / `favourite_of` arrays as
+  lists of ids and never indents, also in debug mode.
+"""
+import operator
+from urllib.parse import urlencode
+from flask import request, jsonify, current_app, Response, stream_with_context
+from sqlalchemy import select
+from utils import APIException
+from models import db, User, Profile, Car, Favourite
+import serializers
+from cache import tag, user_tags, profile_tags, car_tags, favourite_tags
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+STREAM_BATCH = 500
+NDJSON = 'application/x-ndjson'
+
+
+def _arg(name, cast, args=None):
+    value = (request.args if args is None else args).get(name)
+    if value is None or value == '':
+        return None
+    try:
+        return cast(value)
+    except ValueError:
+        raise APIException(f"Invalid value for '{name}'", status_code=400)
+
+
+class Listing:
+    """Paginated, filterable and projectable view over one model."""
+
+    def __init__(self, serializer, key, columns, fields, filters, collection, tags):
+        # serializers.RowSerializer building the full serialize() dicts
+        self.serializer = serializer
+        # keyset column, unique and indexed
+        self.key = key
+        # serialize() key -> column, these can be projected on their own
+        self.columns = columns
+        # every key serialize() returns
+        self.fields_allowed = fields
+        # query arg -> (column, comparison, type)
+        self.filters = filters
+        # cache tags of the whole collection and of each item, see cache.py
+        self.collection = collection
+        self.tags = tags
+
+    def criteria(self, args=None):
+        where = []
+        for name, (column, compare, cast) in self.filters.items():
+            value = _arg(name, cast, args)
+            if value is not None:
+                where.append(compare(column, value))
+        return where
+
+    def fields(self, args=None):
+        raw = (request.args if args is None else args).get('fields')
+        if not raw:
+            return None
+        fields = [field.strip() for field in raw.split(',') if field.strip()]
+        unknown = [f for f in fields if f not in self.fields_allowed]
+        if unknown:
+            raise APIException(f"Unknown fields: {', '.join(unknown)}", status_code=400)
+        return fields
+
+    def statement(self, base, after, limit=None, args=None):
+        stmt = base.where(*self.criteria(args))
+        if after is not None:
+            stmt = stmt.where(self.key > after)
+        stmt = stmt.order_by(self.key)
+        if limit is not None:
+            stmt = stmt.limit(limit + 1)
+        return stmt
+
+    def items(self, fields, after, limit=None, yield_per=None, args=None, session=None):
+        """Yield (key, item) pairs in key order.
+
+        With `yield_per` rows are fetched in batches through a server-side
+        cursor (stream_results) instead of being buffered all at once, and
+        the nested collections are fetched once per batch.
+        """
+        session = session or db.session
+        if fields is not None and all(f in self.columns for f in fields):
+            base = select(self.key, *[self.columns[f] for f in fields])
+
+            def build(rows):
+                return [(row[0], dict(zip(fields, row[1:]))) for row in rows]
+        else:
+            base = self.serializer.base
+
+            def build(rows):
+                return self.serializer.items(rows, session)
+
+        stmt = self.statement(base, after, limit, args)
+        if yield_per:
+            batches = session.execute(stmt.execution_options(yield_per=yield_per)).partitions()
+        else:
+            batches = [session.execute(stmt).all()]
+
+        for rows in batches:
+            for key, item in build(rows):
+                if fields is not None:
+                    item = {f: item[f] for f in fields}
+                yield key, item
+
+    def page(self, args=None, session=None):
+        """Return (items, next_cursor) for the current request, or for
+        `args` (a MultiDict of query arguments) outside of Flask."""
+        limit = _arg('limit', int, args)
+        if limit is None:
+            limit = DEFAULT_LIMIT
+        if limit < 1 or limit > MAX_LIMIT:
+            raise APIException(f"'limit' must be between 1 and {MAX_LIMIT}", status_code=400)
+        pairs = list(self.items(self.fields(args), _arg('after', int, args), limit=limit,
+                                args=args, session=session))
+        next_cursor = pairs[limit - 1][0] if len(pairs) > limit else None
+        return [item for _, item in pairs[:limit]], next_cursor
+
+    def stream(self):
+        """Return a generator of NDJSON lines, `STREAM_BATCH` rows per fetch.
+
+        Arguments are parsed here, before the response starts, so a bad
+        request still gets a proper 400.
+        """
+        fields = self.fields()
+        after = _arg('after', int)
+        self.criteria()  # raises on bad filter values
+        dumps = current_app.json.dumps
+        compact = wants_compact()
+
+        def lines():
+            for _, item in self.items(fields, after, yield_per=STREAM_BATCH):
+                if compact:
+                    item = serializers.compact(item)
+                yield dumps(item, separators=(',', ':')) + '\n'
+        return lines()
+
+
+def wants_stream():
+    if request.args.get('stream') in ('1', 'true'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def wants_compact(args=None):
+    return (request.args if args is None else args).get('compact') in ('1', 'true')
+
+
+def shape(item, args=None):
+    """`item` as the request asked for it, see ?compact=1."""
+    return serializers.compact(item) if wants_compact(args) else item
+
+
+def json_response(obj):
+    """jsonify(obj), without whitespace in compact mode."""
+    if not wants_compact():
+        return jsonify(obj)
+    data = current_app.json.dumps(obj, separators=(',', ':'))
+    return current_app.response_class(data + '\n', mimetype=current_app.json.mimetype)
+
+
+def respond(listing):
+    """Response for a collection endpoint, streamed or paginated."""
+    if wants_stream():
+        return Response(stream_with_context(listing.stream()), mimetype=NDJSON)
+    return page_response(listing, *listing.page())
+
+
+def page_response(listing, items, next_cursor):
+    """The paginated response of one page, tagged for the cache."""
+    tag(listing.collection, *(t for item in items for t in listing.tags(item)))
+    if wants_compact():
+        items = [serializers.compact(item) for item in items]
+    return paginated(items, next_cursor)
+
+
+def paginated(items, next_cursor):
+    response = json_response(items)
+    response.headers.update(next_page_headers(request.path, request.args, next_cursor))
+    return response
+
+
+def next_page_headers(path, args, next_cursor):
+    if next_cursor is None:
+        return {}
+    args = args.to_dict()
+    args['after'] = next_cursor
+    return {
+        'Link': f'<{path}?{urlencode(args)}>; rel="next"',
+        'X-Next-Cursor': str(next_cursor),
+    }
+
+
+USERS = Listing(
+    serializers.USER,
+    key=User.id,
+    columns={'id': User.id, 'email': User.email, 'age': User.age},
+    fields=('id', 'email', 'age', 'profile', 'favourites'),
+    filters={
+        'email': (User.email, operator.eq, str),
+        'min_age': (User.age, operator.ge, int),
+        'max_age': (User.age, operator.le, int),
+    },
+    collection='users',
+    tags=user_tags,
+)
+
+PROFILES = Listing(
+    serializers.PROFILE,
+    key=Profile.id,
+    columns={'user_id': Profile.user_id, 'title': Profile.title, 'bio': Profile.bio},
+    fields=('user_id', 'title', 'bio'),
+    filters={'user_id': (Profile.user_id, operator.eq, int)},
+    collection='profiles',
+    tags=profile_tags,
+)
+
+CARS = Listing(
+    serializers.CAR,
+    key=Car.id,
+    columns={'id': Car.id, 'model': Car.model, 'year': Car.year, 'name': Car.name},
+    fields=('id', 'model', 'year', 'name', 'favourite_of'),
+    filters={
+        'year': (Car.year, operator.eq, int),
+        'min_year': (Car.year, operator.ge, int),
+        'max_year': (Car.year, operator.le, int),
+        'model': (Car.model, operator.eq, str),
+        'name': (Car.name, operator.eq, str),
+    },
+    collection='cars',
+    tags=car_tags,
+)
+
+FAVOURITES = Listing(
+    serializers.FAVOURITE,
+    key=Favourite.id,
+    columns={'id': Favourite.id},
+    fields=('id', 'user', 'car'),
+    filters={
+        'user_id': (Favourite.user_id, operator.eq, int),
+        'car_id': (Favourite.car_id, operator.eq, int),
+    },
+    collection='favourites',
+    tags=favourite_tags,
+)
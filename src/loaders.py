@@ -0,0 +1,44 @@
+"""
+Loader strategies for the endpoints that work with ORM instances.
+
+Each serialize() walks relationships (User -> profile, favourites -> car,
+Car -> favourites -> user, Favourite -> user/car). Without eager loading every
+row triggers extra lazy SELECTs (1 + N + N*M queries). The write endpoints
+reload what they return with one of the profiles below so they always run a
+constant number of SQL statements. Reads don't build ORM objects at all, see
+serializers.py.
+"""
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
+from models import db, User, Car, Favourite
+
+
+# User.serialize() -> profile + favourites + fav.car
+# profile is one-to-one so it can ride on the main query, the collection goes
+# on a second SELECT ... WHERE user_id IN (...) joined with cars.
+USER_DETAIL = (
+    joinedload(User.profile),
+    selectinload(User.favourites).joinedload(Favourite.car),
+)
+
+# Car.serialize() -> favourites + fav.user
+CAR = (
+    selectinload(Car.favourites).joinedload(Favourite.user),
+)
+
+# Favourite.serialize() -> user + car, both many-to-one
+FAVOURITE = (
+    joinedload(Favourite.user),
+    joinedload(Favourite.car),
+)
+
+
+def load_one(model, options, *criteria):
+    """Return a single row (or None) with the given loaders.
+
+    populate_existing refreshes instances that are already in the session,
+    e.g. right after a commit, so the eager loaders apply to them as well.
+    """
+    stmt = select(model).options(*options).where(*criteria) \
+        .execution_options(populate_existing=True)
+    return db.session.execute(stmt).scalar_one_or_none()
@@ -1,22 +1,55 @@
 from __future__ import annotations  # permite referencias a clases futuras en tipos
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, Boolean, ForeignKey, Integer
+from datetime import datetime, timezone
+from sqlalchemy import String, Boolean, ForeignKey, Integer, BigInteger, Index, JSON, Text, func, insert, event
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 from typing import List, Optional
+from replicas import RoutingSession
+
+# db.session sends the reads of @read_replica views to a replica
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+
+def utcnow():
+    # naive UTC with microseconds, so two writes in the same second still differ
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def updated_at_column():
+    # Bumped on every INSERT/UPDATE (ORM and Core), indexed so that
+    # max(updated_at) is a single index lookup. Used by conditional.py.
+    return mapped_column(default=utcnow, onupdate=utcnow, server_default=func.now(), index=True)
+
+
+def insert_ignore(model, *index_elements):
+    # INSERT ... ON CONFLICT (index_elements) DO NOTHING on PostgreSQL and
+    # SQLite. Other backends get a plain INSERT, callers treat the
+    # IntegrityError the same way as a skipped row.
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(model).on_conflict_do_nothing(index_elements=index_elements)
+    if dialect == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing(index_elements=index_elements)
+    return insert(model)
 
-db = SQLAlchemy()
 
 class User(db.Model):
     __tablename__ = 'users'
     id: Mapped[int] = mapped_column(primary_key=True)
     email: Mapped[str] = mapped_column(String(120), unique=True, nullable=False)
     password: Mapped[str] = mapped_column(String(128), nullable=False)
-    age: Mapped[int] = mapped_column(nullable=False)
+    age: Mapped[int] = mapped_column(nullable=False, index=True)
+    updated_at: Mapped[datetime] = updated_at_column()
 
     # Relaciones
     profile: Mapped[Optional[Profile]] = relationship('Profile', back_populates='user', uselist=False)
     favourites: Mapped[List[Favourite]] = relationship('Favourite', back_populates='user')
 
+    def __str__(self):
+        # shown by the admin lists and lookups
+        return self.email
+
     def serialize(self):
         return {
             "id": self.id,
@@ -38,6 +71,7 @@ class Profile(db.Model):
     title: Mapped[str] = mapped_column(String(20))
     bio: Mapped[str] = mapped_column(String(120))
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), unique=True)
+    updated_at: Mapped[datetime] = updated_at_column()
 
     user: Mapped[User] = relationship('User', back_populates='profile')
 
@@ -52,11 +86,17 @@ class Car(db.Model):
     __tablename__ = 'cars'
     id: Mapped[int] = mapped_column(primary_key=True)
     model: Mapped[str] = mapped_column(String(20), nullable=False)
-    year: Mapped[int] = mapped_column(nullable=False)
+    year: Mapped[int] = mapped_column(nullable=False, index=True)
     name: Mapped[str] = mapped_column(String(20), nullable=False)
+    # maintained by the favourite writes, see counters.py
+    favourite_count: Mapped[int] = mapped_column(default=0, server_default='0')
+    updated_at: Mapped[datetime] = updated_at_column()
 
     favourites: Mapped[List[Favourite]] = relationship('Favourite', back_populates='car')
 
+    def __str__(self):
+        return f'{self.name} {self.model} ({self.year})'
+
     def serialize(self):
         return {
             'id': self.id,
@@ -72,11 +112,19 @@ class Car(db.Model):
     }
 
 
+# GET /cars/top reads this index from the start, in its own order:
+# favourite_count DESC, id ASC
+Index('ix_cars_favourite_count_id', Car.favourite_count.desc(), Car.id)
+
+
 class Favourite(db.Model):
     __tablename__ = 'favourites'
+    # one favourite per (user, car); also serves lookups by user_id
+    __table_args__ = (Index('ix_favourites_user_id_car_id', 'user_id', 'car_id', unique=True),)
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'),nullable=False)
-    car_id: Mapped[int] = mapped_column(ForeignKey('cars.id'),nullable=False)
+    car_id: Mapped[int] = mapped_column(ForeignKey('cars.id'),nullable=False, index=True)
+    updated_at: Mapped[datetime] = updated_at_column()
 
     user: Mapped[User] = relationship('User', back_populates='favourites')
     car: Mapped[Car] = relationship('Car', back_populates='favourites')
@@ -95,4 +143,46 @@ class Favourite(db.Model):
     }
 
 
-
+class Change(db.Model):
+    # outbox of the writes to cars and favourites, see outbox.py
+    __tablename__ = 'changes'
+    __table_args__ = (Index('ix_changes_entity_id', 'entity', 'id'),)
+    # the sequence consumers page on, BIGINT but a rowid alias on SQLite
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    entity: Mapped[str] = mapped_column(String(20), nullable=False)
+    entity_id: Mapped[int] = mapped_column(nullable=False)
+    action: Mapped[str] = mapped_column(String(10), nullable=False)
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(default=utcnow, index=True)
+
+
+class UserDashboard(db.Model):
+    # GET /users/<id> already encoded, kept up to date by the writes, see dashboards.py
+    __tablename__ = 'user_dashboards'
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    body: Mapped[str] = mapped_column(Text, nullable=False)
+    compact: Mapped[str] = mapped_column(Text, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(default=utcnow)
+
+
+# the tables whose writes are counted in table_versions, see versions.py
+VERSIONED_TABLES = ('users', 'profiles', 'cars', 'favourites')
+# rows per table, a transaction bumps one of them picked at random
+VERSION_SLOTS = 16
+
+
+class TableVersion(db.Model):
+    # the version of a table is the sum of its slots
+    __tablename__ = 'table_versions'
+    name: Mapped[str] = mapped_column(String(40), primary_key=True)
+    slot: Mapped[int] = mapped_column(Integer, primary_key=True, default=0)
+    version: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+
+@event.listens_for(TableVersion.__table__, 'after_create')
+def _create_versions(table, connection, **_):
+    # create_all() (tests, benchmarks); the migration inserts the same rows
+    connection.execute(insert(table), [
+        {'name': name, 'slot': slot, 'version': 0}
+        for name in VERSIONED_TABLES for slot in range(VERSION_SLOTS)
+    ])
@@ -0,0 +1,171 @@
+"""
+Transactional outbox of the writes to cars and favourites.
+
+Every write that creates, updates or deletes a car or a favourite (bulk
+imports included) appends to the `changes` table in its own transaction,
+so an event exists exactly when the write was committed. Consumers read
+the deltas instead of scanning the tables:
+
+    GET /changes?since=<seq>&limit=500&entity=favourite&wait=20
+    GET /changes/stream?since=<seq>&entity=car      (Server-Sent Events)
+
+`seq` is the primary key of `changes`, pages are WHERE id > :since ORDER
+BY id LIMIT :limit on it (or on (entity, id)). The answer carries `next`,
+the `since` of the following call. With `wait` (seconds, up to
+CHANGES_MAX_WAIT) an empty page is held open and the table polled every
+CHANGES_POLL_INTERVAL until something arrives (long polling). The SSE feed
+polls the same way, resumes from Last-Event-ID and ends after
+CHANGES_STREAM_SECONDS, EventSource reconnects on its own. Both keep a
+thread busy while they wait: gunicorn runs threaded workers for that
+(gunicorn.conf.py), and both limits are capped at half the worker timeout,
+GUNICORN_TIMEOUT, so no wait outlives it:
+
+    CHANGES_MAX_WAIT        longest `wait`, in seconds (20)
+    CHANGES_STREAM_SECONDS  how long one SSE connection lasts (55)
+    CHANGES_POLL_INTERVAL   seconds between two polls (1)
+
+Consumers may never skip an event, so sequence numbers have to become
+visible in order: on PostgreSQL an id taken by a transaction that commits
+after a later one would be missed by a consumer already past it. record()
+takes a transaction-level advisory lock right before appending, which is
+the last statement of each write, so writers commit one after the other
+from that point on. SQLite already serialises writers.
+
+`flask prune-changes` deletes events older than CHANGES_RETENTION_DAYS (7).
+"""
+import os
+import time
+from datetime import timedelta
+from flask import current_app, g, Response, stream_with_context
+from sqlalchemy import select, insert, delete, text
+from utils import APIException
+from models import db, Change, utcnow
+
+CHANGES_DEFAULT_LIMIT = 500
+CHANGES_MAX_LIMIT = 1000
+# the same variable as gunicorn.conf.py
+WORKER_TIMEOUT = float(os.getenv('GUNICORN_TIMEOUT', 120))
+CHANGES_MAX_WAIT = min(float(os.getenv('CHANGES_MAX_WAIT', 20)), WORKER_TIMEOUT / 2)
+CHANGES_POLL_INTERVAL = float(os.getenv('CHANGES_POLL_INTERVAL', 1))
+CHANGES_STREAM_SECONDS = min(float(os.getenv('CHANGES_STREAM_SECONDS', 55)), WORKER_TIMEOUT / 2)
+CHANGES_HEARTBEAT = 15
+CHANGES_RETENTION_DAYS = float(os.getenv('CHANGES_RETENTION_DAYS', 7))
+ENTITIES = ('car', 'favourite')
+# any constant, shared by every writer of the outbox
+OUTBOX_LOCK = 7301
+
+
+def record(entity, action, rows):
+    """Append one event per row (a dict with the row's `id`), not committed."""
+    if not rows:
+        return
+    if db.session.get_bind().dialect.name == 'postgresql':
+        db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': OUTBOX_LOCK})
+    db.session.execute(insert(Change), [
+        {'entity': entity, 'entity_id': row['id'], 'action': action, 'payload': row, 'created_at': utcnow()}
+        for row in rows
+    ])
+
+
+def car_payload(car):
+    return {'id': car.id, 'model': car.model, 'year': car.year, 'name': car.name}
+
+
+def favourite_payload(favourite):
+    return {'id': favourite.id, 'user_id': favourite.user_id, 'car_id': favourite.car_id}
+
+
+def changes(since, limit, entity=None):
+    stmt = select(Change.id, Change.entity, Change.entity_id, Change.action, Change.payload, Change.created_at) \
+        .where(Change.id > since).order_by(Change.id).limit(limit)
+    if entity is not None:
+        stmt = stmt.where(Change.entity == entity)
+    return [
+        {'seq': seq, 'entity': kind, 'id': entity_id, 'action': action, 'data': payload,
+         'at': created_at.isoformat() + 'Z'}
+        for seq, kind, entity_id, action, payload, created_at in db.session.execute(stmt)
+    ]
+
+
+def _poll(since, limit, entity):
+    items = changes(since, limit, entity)
+    # end the transaction, the connection goes back to the pool while waiting
+    db.session.rollback()
+    return items
+
+
+def _args(args):
+    try:
+        since = int(args.get('since', 0))
+        limit = int(args.get('limit', CHANGES_DEFAULT_LIMIT))
+        wait = float(args.get('wait', 0))
+    except ValueError:
+        raise APIException("'since', 'limit' and 'wait' must be numbers", status_code=400)
+    if since < 0:
+        raise APIException("'since' must be 0 or more", status_code=400)
+    if limit < 1 or limit > CHANGES_MAX_LIMIT:
+        raise APIException(f"'limit' must be between 1 and {CHANGES_MAX_LIMIT}", status_code=400)
+    entity = args.get('entity')
+    if entity is not None and entity not in ENTITIES:
+        raise APIException(f"'entity' must be one of {', '.join(ENTITIES)}", status_code=400)
+    return since, limit, entity, min(max(wait, 0), CHANGES_MAX_WAIT)
+
+
+def changes_request(args):
+    """GET /changes, long polling when `wait` is given."""
+    since, limit, entity, wait = _args(args)
+    # the same statement runs once per poll, that's not an N+1
+    g.polling = True
+    deadline = time.monotonic() + wait
+    items = _poll(since, limit, entity)
+    while not items and time.monotonic() + CHANGES_POLL_INTERVAL <= deadline:
+        time.sleep(CHANGES_POLL_INTERVAL)
+        items = _poll(since, limit, entity)
+    return {'changes': items, 'next': items[-1]['seq'] if items else since}
+
+
+def stream_response(args, last_event_id=None):
+    """GET /changes/stream, Server-Sent Events until CHANGES_STREAM_SECONDS."""
+    if last_event_id:
+        args = {**args.to_dict(), 'since': last_event_id}
+    since, limit, entity, _ = _args(args)
+    g.polling = True
+    dumps = current_app.json.dumps
+
+    def events():
+        cursor = since
+        deadline = time.monotonic() + CHANGES_STREAM_SECONDS
+        quiet_since = time.monotonic()
+        yield f'retry: {int(CHANGES_POLL_INTERVAL * 1000)}\n\n'
+        while True:
+            items = _poll(cursor, limit, entity)
+            for item in items:
+                yield (f"id: {item['seq']}\nevent: {item['entity']}.{item['action']}\n"
+                       f"data: {dumps(item, separators=(',', ':'))}\n\n")
+            now = time.monotonic()
+            if items:
+                cursor = items[-1]['seq']
+                quiet_since = now
+                if len(items) == limit:
+                    continue  # more are waiting
+            elif now - quiet_since >= CHANGES_HEARTBEAT:
+                # keeps proxies from closing an idle connection
+                yield ': keepalive\n\n'
+                quiet_since = now
+            if now >= deadline:
+                return
+            time.sleep(CHANGES_POLL_INTERVAL)
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={
+        # no-transform: compression would hold events back until its buffer fills
+        'Cache-Control': 'no-cache, no-transform',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def prune(days=CHANGES_RETENTION_DAYS):
+    """Delete the events older than `days`, return how many."""
+    cutoff = utcnow() - timedelta(days=days)
+    result = db.session.execute(delete(Change).where(Change.created_at < cutoff))
+    db.session.commit()
+    return result.rowcount
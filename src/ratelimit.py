@@ -0,0 +1,285 @@
+"""
+Rate limiting and load shedding, decided before a view runs any query.
+
+Rate limits are token buckets, `rate/unit:burst`, e.g. `5/s:10` refills 5
+tokens a second and holds at most 10:
+
+    RATE_LIMIT_CLIENT   every client, all routes together (50/s:100)
+    RATE_LIMITS         per client and route, `METHOD rule=limit,...`
+                        (POST /favourites/<int:user_id>/<int:car_id>=5/s:10,
+                         GET /cars=20/s:40)
+    RATE_LIMIT_URL      optional shared backend so the limits hold across
+                        workers: redis://... (needs the redis package) or
+                        memory:// (a process-local stand-in for tests)
+
+A client is the `sub` of a valid bearer token, or its address. Behind
+proxies the address would be the last proxy's, one bucket for every
+anonymous client, so the app takes it from X-Forwarded-For instead
+(werkzeug's ProxyFix, see proxy_fix()), trusting as many hops as:
+
+    TRUSTED_PROXY_HOPS  proxies in front of the app that set
+                        X-Forwarded-For and X-Forwarded-Proto (1 on Render
+                        and Heroku, where RENDER or DYNO is set, else 0)
+
+Never set it higher than the real number of proxies, a client could then
+pick its own address, and its own bucket, with a forged header.
+Buckets live in an ordered dict, least recently used first, guarded by
+striped locks, so requests of different clients rarely wait on each other.
+Past RATE_LIMIT_MAX_KEYS (100000) buckets the least recently used ones are
+dropped, a constant amount of work per request however many distinct
+clients show up. A dropped bucket starts full again, which is only
+lenient towards a client that hasn't been seen for that many others. If
+the shared backend fails the request is let through.
+
+Load shedding answers 503 straight away while the worker is overloaded:
+
+    SHED_MAX_IN_FLIGHT  requests being served by this worker (64)
+    SHED_POOL_WAIT_MS   recent average wait for a database connection,
+                        see database.PoolMetrics.recent_wait() (250)
+
+Either at 0 turns that check off, RATE_LIMIT_ENABLED=0 turns everything
+off. /metrics and /db/pool are never limited.
+
+settings() reads the variables into app.config, init_app() builds the
+app's Limiter (app.extensions['ratelimit']) from there.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import request, jsonify, g
+from werkzeug.middleware.proxy_fix import ProxyFix
+import auth
+import database
+from utils import APIException
+
+EXEMPT = {'GET /metrics', 'GET /db/pool'}
+UNITS = {'s': 1, 'm': 60, 'h': 3600}
+
+
+def settings():
+    """app.config entries read from the environment, see the module docstring."""
+    on_platform = os.getenv('RENDER') or os.getenv('DYNO')
+    return {
+        'RATE_LIMIT_ENABLED': os.getenv('RATE_LIMIT_ENABLED', '1') not in ('0', 'false'),
+        'RATE_LIMIT_CLIENT': os.getenv('RATE_LIMIT_CLIENT', '50/s:100'),
+        'RATE_LIMITS': os.getenv('RATE_LIMITS',
+                                 'POST /favourites/<int:user_id>/<int:car_id>=5/s:10,GET /cars=20/s:40'),
+        'RATE_LIMIT_URL': os.getenv('RATE_LIMIT_URL'),
+        'RATE_LIMIT_MAX_KEYS': int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000)),
+        'SHED_MAX_IN_FLIGHT': int(os.getenv('SHED_MAX_IN_FLIGHT', 64)),
+        'SHED_POOL_WAIT_MS': float(os.getenv('SHED_POOL_WAIT_MS', 250)),
+        'TRUSTED_PROXY_HOPS': int(os.getenv('TRUSTED_PROXY_HOPS', 1 if on_platform else 0)),
+    }
+
+
+def parse_limit(value):
+    """'5/s:10' -> (rate per second, burst)."""
+    try:
+        rate, _, burst = value.strip().partition(':')
+        count, _, unit = rate.partition('/')
+        per_second = float(count) / UNITS[unit or 's']
+        burst = float(burst) if burst else max(1.0, float(count))
+    except (ValueError, KeyError):
+        raise RuntimeError(f'Invalid rate limit {value!r}, expected e.g. 5/s:10')
+    if per_second <= 0 or burst < 1:
+        raise RuntimeError(f'Invalid rate limit {value!r}')
+    return per_second, burst
+
+
+def parse_limits(value):
+    limits = {}
+    for entry in filter(None, (entry.strip() for entry in value.split(','))):
+        route, _, limit = entry.rpartition('=')
+        limits[route.strip()] = parse_limit(limit)
+    return limits
+
+
+class Buckets:
+    """Token buckets in an LRU, one lock per stripe of keys."""
+
+    def __init__(self, max_keys, stripes=64):
+        self.max_keys = max_keys
+        self.state = OrderedDict()  # key -> (tokens, updated), least recently used first
+        self.locks = [threading.Lock() for _ in range(stripes)]
+        self.evicting = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token, return 0 or the seconds until one is available."""
+        now = time.monotonic()
+        with self.locks[hash(key) % len(self.locks)]:
+            # pop and insert again: the key moves to the most recent end
+            tokens, updated = self.state.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+            self.state[key] = (tokens - 1 if tokens >= 1 else tokens, now)
+        if len(self.state) > self.max_keys:
+            self.evict()
+        return wait
+
+    def evict(self):
+        """Drop the least recently used buckets past max_keys, O(1) each."""
+        # one thread evicts, the others don't wait for it
+        if not self.evicting.acquire(blocking=False):
+            return
+        try:
+            while len(self.state) > self.max_keys:
+                self.state.popitem(last=False)
+        except KeyError:
+            pass
+        finally:
+            self.evicting.release()
+
+
+class LocalBackend(Buckets):
+    """Stand-in for a shared backend (RATE_LIMIT_URL=memory://)."""
+
+
+class RedisBackend:
+    """Buckets as redis hashes, refilled and taken in one script call."""
+
+    SCRIPT = """
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 't', 'u')
+        local tokens = tonumber(state[1]) or burst
+        local updated = tonumber(state[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+        local wait = 0
+        if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+        redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, url):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst):
+        return float(self.script(keys=['ratelimit:' + key], args=[rate, burst, time.time()]))
+
+
+def shared_backend(url, max_keys):
+    if not url:
+        return None
+    if url.startswith('memory://'):
+        return LocalBackend(max_keys)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisBackend(url)
+    raise ValueError(f'Unsupported RATE_LIMIT_URL: {url}')
+
+
+class InFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def enter(self):
+        with self.lock:
+            self.count += 1
+            return self.count
+
+    def leave(self):
+        with self.lock:
+            self.count -= 1
+
+
+class Limiter:
+    def __init__(self, config):
+        self.client_limit = parse_limit(config['RATE_LIMIT_CLIENT'])
+        self.route_limits = parse_limits(config['RATE_LIMITS'])
+        self.local = Buckets(config['RATE_LIMIT_MAX_KEYS'])
+        self.shared = shared_backend(config['RATE_LIMIT_URL'], config['RATE_LIMIT_MAX_KEYS'])
+        self.max_in_flight = config['SHED_MAX_IN_FLIGHT']
+        self.max_pool_wait_ms = config['SHED_POOL_WAIT_MS']
+        self.in_flight = InFlight()
+
+    def _take(self, key, limit):
+        if self.shared is not None:
+            try:
+                return self.shared.take(key, *limit)
+            except Exception:
+                # fail open, an outage of the backend must not take the API down
+                return 0.0
+        return self.local.take(key, *limit)
+
+    def shed(self, in_flight):
+        """503 message when this worker is overloaded, else None."""
+        if self.max_in_flight and in_flight > self.max_in_flight:
+            return 'Server busy, too many requests in progress'
+        if self.max_pool_wait_ms and database.metrics.recent_wait() * 1000 > self.max_pool_wait_ms:
+            return 'Server busy, the database is saturated'
+        return None
+
+    def limit(self, client, route):
+        """Seconds the client has to wait before `route`, 0 when allowed."""
+        wait = self._take(f'client:{client}', self.client_limit)
+        limit = self.route_limits.get(route)
+        if not wait and limit is not None:
+            wait = self._take(f'route:{client}:{route}', limit)
+        return wait
+
+    def admit(self, route, authorization, address):
+        """(status, message, retry_after) to answer instead of the view, or None.
+
+        The caller must call in_flight.leave() once the request is done when
+        this returns None.
+        """
+        if route in EXEMPT:
+            self.in_flight.enter()
+            return None
+        message = self.shed(self.in_flight.enter())
+        if message is None:
+            wait = self.limit(client_id(authorization, address), route)
+            if not wait:
+                return None
+            message, status, retry_after = 'Too many requests', 429, math.ceil(wait)
+        else:
+            status, retry_after = 503, 1
+        self.in_flight.leave()
+        return status, message, retry_after
+
+
+def proxy_fix(wsgi_app, hops):
+    """wsgi_app seeing the client's address and scheme, see the module docstring."""
+    if not hops:
+        return wsgi_app
+    return ProxyFix(wsgi_app, x_for=hops, x_proto=hops)
+
+
+def client_id(authorization, address):
+    """`user:<sub>` for a valid bearer token, otherwise `ip:<address>`."""
+    if authorization:
+        try:
+            return f"user:{auth.verify_token(auth.bearer_token(authorization))['sub']}"
+        except (APIException, KeyError, TypeError):
+            pass
+    return f'ip:{address}'
+
+
+def init_app(app):
+    if not app.config['RATE_LIMIT_ENABLED']:
+        return
+    limiter = app.extensions['ratelimit'] = Limiter(app.config)
+
+    @app.before_request
+    def admission():
+        if request.url_rule is None:
+            return None
+        verdict = limiter.admit(f'{request.method} {request.url_rule.rule}',
+                                request.headers.get('Authorization'), request.remote_addr)
+        if verdict is None:
+            g.admitted = True
+            return None
+        status, message, retry_after = verdict
+        response = jsonify({'message': message})
+        response.status_code = status
+        response.headers['Retry-After'] = str(retry_after)
+        return response
+
+    @app.teardown_request
+    def release(error=None):
+        if g.pop('admitted', False):
+            limiter.in_flight.leave()
@@ -0,0 +1,134 @@
+"""
+Read replicas for the GET routes.
+
+    DATABASE_REPLICA_URLS  comma separated URLs of read replicas (none)
+    REPLICA_MAX_LAG        how far behind the primary a replica may be, in
+                           seconds (5)
+
+Each replica is a Flask-SQLAlchemy bind (`replica0`, `replica1`, ...) whose
+pool is configured like the primary's, see database.engine_options(). The
+views decorated with @read_replica (listings, single-item lookups, search)
+run their queries on one replica per request, taken in turn. Everything
+else, and anything a session writes, goes to the primary through
+RoutingSession.get_bind().
+
+Replication lags, so a client that just wrote must not read an older copy:
+after a successful POST/PUT/PATCH/DELETE the client (token `sub` or
+address, as in ratelimit.py) reads from the primary for REPLICA_MAX_LAG.
+The pin is kept in this worker and in a `db_primary_until` cookie, which
+the other workers honour for clients that keep cookies. cache.py doesn't
+store what a replica answered while an invalidation is more recent than
+that, it could be the old data.
+
+asgi.py sends its native reads to the same replicas. To try it locally,
+point DATABASE_REPLICA_URLS at a copy of the SQLite file or at a second
+PostgreSQL database: benchmarks/bench_replicas.py does that with SQLite.
+"""
+import itertools
+import math
+import os
+import threading
+import time
+from functools import wraps
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.dml import UpdateBase
+import database
+import ratelimit
+
+DATABASE_REPLICA_URLS = [url.strip().replace('postgres://', 'postgresql://')
+                         for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 5))
+COOKIE = 'db_primary_until'
+READ_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+MAX_PINNED = 100000
+
+
+def binds(urls=DATABASE_REPLICA_URLS):
+    """SQLALCHEMY_BINDS entries of the replicas."""
+    return {f'replica{i}': {'url': url, **database.engine_options(url)} for i, url in enumerate(urls)}
+
+
+def replica_keys(app):
+    return [key for key in app.config.get('SQLALCHEMY_BINDS', {}) if key.startswith('replica')]
+
+
+class RoutingSession(Session):
+    """db.session: the replica picked for the request, the primary otherwise."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        key = g.get('read_replica') if bind is None and has_app_context() else None
+        if key is None or self._flushing or isinstance(clause, UpdateBase):
+            return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        return self._db.engines[key]
+
+
+class Pins:
+    """Clients that wrote recently, until when they read from the primary."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.until = {}
+
+    def pin(self, client, until):
+        with self.lock:
+            if len(self.until) >= MAX_PINNED:
+                now = time.time()
+                self.until = {key: value for key, value in self.until.items() if value > now}
+            self.until[client] = until
+
+    def pinned(self, client, now):
+        return self.until.get(client, 0) > now
+
+
+pins = Pins()
+_turn = itertools.count()
+
+
+def pick(choices):
+    return choices[next(_turn) % len(choices)]
+
+
+def pinned(authorization, address, cookie=None):
+    """True while the client has to read its own writes from the primary."""
+    now = time.time()
+    try:
+        if cookie and float(cookie) > now:
+            return True
+    except ValueError:
+        pass
+    return pins.pinned(ratelimit.client_id(authorization, address), now)
+
+
+def read_replica(view):
+    """Run the queries of a read-only view on a replica.
+
+    Must come before @conditional and @cached, whose queries belong to the
+    same request.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        keys = current_app.extensions.get('replicas')
+        if keys and not pinned(request.headers.get('Authorization'), request.remote_addr,
+                               request.cookies.get(COOKIE)):
+            g.read_replica = pick(keys)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def pin_writer(response):
+    if request.method not in READ_METHODS and response.status_code < 400:
+        until = time.time() + REPLICA_MAX_LAG
+        pins.pin(ratelimit.client_id(request.headers.get('Authorization'), request.remote_addr), until)
+        response.set_cookie(COOKIE, f'{until:.3f}', max_age=math.ceil(REPLICA_MAX_LAG), httponly=True,
+                            samesite='Lax')
+    return response
+
+
+def init_app(app):
+    keys = replica_keys(app)
+    if keys:
+        app.extensions['replicas'] = keys
+        app.after_request(pin_writer)
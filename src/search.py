@@ -0,0 +1,202 @@
+"""
+Prefix search over users (email) and cars (name, model).
+
+    GET /search?q=ana&type=users&limit=20
+
+Every word of `q` must match the start of a word (autocomplete), results
+are ranked best first. `type` is users, cars or both (default). On
+PostgreSQL queries of 3+ characters also find users by any part of the email.
+
+PostgreSQL answers from the indexes created by migration a9b1c3d5e7f2:
+- users: prefixes shorter than 3 characters go through a text_pattern_ops
+  index on lower(email), longer ones match anywhere in the email through a
+  pg_trgm GIN index. Emails starting with `q` rank first, then by
+  similarity(email, q),
+- cars: a prefix tsquery (`word:*`) on to_tsvector('simple', name || ' ' ||
+  model) through a GIN expression index, ranked by ts_rank.
+Each search runs with statement_timeout = SEARCH_BUDGET_MS (150). A search
+that can't finish in time gets a 503 instead of holding a worker. The
+budget is meant for tables of up to a million rows, see
+`benchmarks/bench_endpoints.py --users 1000000 --database-url ...`.
+
+Other databases (SQLite) get an in-process inverted index: the sorted
+vocabulary is bisected for the prefix range and the posting lists are
+intersected. It is rebuilt only when max(updated_at) or the row count of
+the table changes, which is one aggregate query per search.
+"""
+import bisect
+import os
+import re
+import threading
+from collections import defaultdict
+from sqlalchemy import select, func, text, literal_column
+from sqlalchemy.exc import OperationalError
+from utils import APIException
+from models import db, User, Car
+
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+SEARCH_BUDGET_MS = float(os.getenv('SEARCH_BUDGET_MS', 150))
+KINDS = ('users', 'cars')
+
+# must stay identical to the expression of ix_cars_search in the migration
+CARS_TSVECTOR = "to_tsvector('simple', name || ' ' || model)"
+
+WORD = re.compile(r'\w+')
+
+
+def words(value):
+    return WORD.findall(value.lower())
+
+
+def _like_prefix(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+# PostgreSQL
+
+def _pg_users(q, limit):
+    q = q.lower()
+    pattern = _like_prefix(q)
+    starts = func.lower(User.email).like(pattern, escape='\\')
+    # short prefixes use the text_pattern_ops index, longer ones match
+    # anywhere in the email through the trigram index
+    where = starts if len(q) < 3 else User.email.ilike('%' + pattern, escape='\\')
+    score = func.similarity(User.email, q)
+    stmt = select(User.id, User.email, score).where(where) \
+        .order_by(starts.desc(), score.desc(), User.id).limit(limit)
+    return [{'id': i, 'email': email, 'score': round(s, 4)} for i, email, s in db.session.execute(stmt)]
+
+
+def _pg_cars(q, limit):
+    terms = words(q)
+    if not terms:
+        return []
+    vector = literal_column(CARS_TSVECTOR)
+    query = func.to_tsquery('simple', ' & '.join(f'{term}:*' for term in terms))
+    score = func.ts_rank(vector, query)
+    stmt = select(Car.id, Car.name, Car.model, Car.year, score) \
+        .where(vector.bool_op('@@')(query)) \
+        .order_by(score.desc(), Car.id).limit(limit)
+    return [{'id': i, 'name': name, 'model': model, 'year': year, 'score': round(s, 4)}
+            for i, name, model, year, s in db.session.execute(stmt)]
+
+
+def _pg_search(q, kinds, limit):
+    db.session.execute(text(f'SET LOCAL statement_timeout = {int(SEARCH_BUDGET_MS)}'))
+    try:
+        result = {}
+        if 'users' in kinds:
+            result['users'] = _pg_users(q, limit)
+        if 'cars' in kinds:
+            result['cars'] = _pg_cars(q, limit)
+    except OperationalError:
+        db.session.rollback()
+        raise APIException('Search took too long, try a longer query', status_code=503)
+    db.session.commit()  # ends the transaction, and the SET LOCAL with it
+    return result
+
+
+# In-process fallback
+
+class InvertedIndex:
+    """Word -> ids, with prefix lookups on the sorted vocabulary."""
+
+    def __init__(self, docs):
+        # docs: iterable of (id, text, item)
+        postings = defaultdict(set)
+        self.items = {}
+        for doc_id, value, item in docs:
+            self.items[doc_id] = item
+            for word in words(value):
+                postings[word].add(doc_id)
+        self.vocabulary = sorted(postings)
+        self.postings = postings
+
+    def _prefix(self, prefix):
+        """{id: best score} of the docs with a word starting with `prefix`."""
+        matches = {}
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        for word in self.vocabulary[start:]:
+            if not word.startswith(prefix):
+                break
+            # an exact word beats a longer completion
+            score = len(prefix) / len(word)
+            for doc_id in self.postings[word]:
+                if score > matches.get(doc_id, 0):
+                    matches[doc_id] = score
+        return matches
+
+    def search(self, q, limit):
+        terms = words(q)
+        if not terms:
+            return []
+        scores = None
+        for term in terms:
+            matches = self._prefix(term)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {i: scores[i] + s for i, s in matches.items() if i in scores}
+            if not scores:
+                return []
+        best = sorted(scores.items(), key=lambda pair: (-pair[1], pair[0]))[:limit]
+        return [{**self.items[i], 'score': round(s / len(terms), 4)} for i, s in best]
+
+
+class LocalSearch:
+    """One InvertedIndex per kind, rebuilt when its table changes."""
+
+    sources = {
+        'users': (User, lambda: db.session.execute(select(User.id, User.email)),
+                  lambda row: (row[0], row[1], {'id': row[0], 'email': row[1]})),
+        'cars': (Car, lambda: db.session.execute(select(Car.id, Car.name, Car.model, Car.year)),
+                 lambda row: (row[0], f'{row[1]} {row[2]}',
+                              {'id': row[0], 'name': row[1], 'model': row[2], 'year': row[3]})),
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = {}  # kind -> (state, InvertedIndex)
+
+    def index(self, kind):
+        model, rows, doc = self.sources[kind]
+        state = tuple(db.session.execute(select(func.max(model.updated_at), func.count()).select_from(model)).one())
+        current = self.indexes.get(kind)
+        if current is not None and current[0] == state:
+            return current[1]
+        with self.lock:
+            current = self.indexes.get(kind)
+            if current is None or current[0] != state:
+                current = (state, InvertedIndex(doc(row) for row in rows()))
+                self.indexes[kind] = current
+        return current[1]
+
+    def __call__(self, q, kinds, limit):
+        return {kind: self.index(kind).search(q, limit) for kind in kinds}
+
+
+local_search = LocalSearch()
+
+
+def search(q, kinds, limit):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        return _pg_search(q, kinds, limit)
+    return local_search(q, kinds, limit)
+
+
+def search_request(args):
+    """Parse /search arguments and run it."""
+    q = (args.get('q') or '').strip()
+    if not q:
+        raise APIException("'q' is required", status_code=400)
+    kind = args.get('type')
+    if kind is not None and kind not in KINDS:
+        raise APIException(f"'type' must be one of {', '.join(KINDS)}", status_code=400)
+    try:
+        limit = int(args.get('limit', SEARCH_DEFAULT_LIMIT))
+    except ValueError:
+        raise APIException("Invalid value for 'limit'", status_code=400)
+    if limit < 1 or limit > SEARCH_MAX_LIMIT:
+        raise APIException(f"'limit' must be between 1 and {SEARCH_MAX_LIMIT}", status_code=400)
+    return search(q, (kind,) if kind else KINDS, limit)
@@ -0,0 +1,239 @@
+"""
+Column based serializers and the JSON provider.
+
+The read endpoints don't need ORM instances: building them (identity map,
+relationship collections, one dict per serialize() call) costs more than the
+query itself on big pages. The serializers below SELECT plain columns with
+Core, fetch the nested collections with one extra IN query per batch and
+build the same dicts serialize() returns, key for key.
+
+JSON encoding goes through FastJSONProvider: orjson when it is installed
+(JSON_ENGINE=auto, the default, or JSON_ENGINE=orjson) and the standard
+library otherwise (JSON_ENGINE=stdlib). Output is byte-identical to Flask's
+DefaultJSONProvider, anything orjson would write differently falls back to
+the standard encoder: non-ASCII text and DEL (escaped as \\uXXXX by the
+standard library), floats the standard library writes with an exponent
+(1e-05, orjson may write 0.00001 or drop the +), NaN and Infinity (orjson
+writes null), indented debug output and non-compact separators.
+"""
+import math
+import os
+import re
+from collections import defaultdict
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import select
+from models import db, User, Profile, Car, Favourite
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+# json.dumps() arguments orjson can reproduce, anything else uses the stdlib
+ORJSON_KWARGS = {'separators', 'sort_keys', 'default', 'ensure_ascii'}
+# numbers in orjson output the standard library could write another way: an
+# exponent, or below 1e-4, where repr() switches to one. A match inside a
+# string only costs a fallback.
+ORJSON_FLOATS = re.compile(rb'[0-9][eE]|(?<![0-9.])0\.0000')
+
+
+def _non_finite(obj):
+    """True when `obj` holds a NaN or an infinity anywhere."""
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, float):
+            if not math.isfinite(item):
+                return True
+        elif isinstance(item, dict):
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return False
+
+
+class RowSerializer:
+    """Builds serialize()-shaped dicts from Core rows."""
+
+    def __init__(self, base, build, children=None):
+        # select() of the columns `build` needs, the primary key first
+        self.base = base
+        # (row, children) -> dict
+        self.build = build
+        # (list of ids, session) -> {id: [nested dicts]}, one query per batch
+        self.children = children
+
+    def items(self, rows, session=None):
+        """Return (key, item) pairs for a batch of rows.
+
+        `session` defaults to db.session, asgi.py passes the sync facade of
+        an AsyncSession.
+        """
+        session = session or db.session
+        children = self.children([row[0] for row in rows], session) if self.children and rows else {}
+        return [(row[0], self.build(row, children)) for row in rows]
+
+    def one(self, *criteria, session=None):
+        session = session or db.session
+        rows = session.execute(self.base.where(*criteria)).all()
+        if not rows:
+            return None
+        return self.items(rows, session)[0][1]
+
+
+# User.serialize()
+def _user_favourites(ids, session):
+    stmt = select(Favourite.user_id, Car.id, Car.name) \
+        .join(Car, Car.id == Favourite.car_id) \
+        .where(Favourite.user_id.in_(ids)).order_by(Favourite.id)
+    grouped = defaultdict(list)
+    for user_id, car_id, car_name in session.execute(stmt):
+        grouped[user_id].append({"id": car_id, "car": car_name})
+    return grouped
+
+
+def _user(row, favourites):
+    user_id, email, age, profile_id, title, bio = row
+    return {
+        "id": user_id,
+        "email": email,
+        "age": age,
+        "profile": {
+            "user_id": user_id,
+            "title": title,
+            "bio": bio
+        } if profile_id is not None else None,
+        "favourites": favourites.get(user_id, []),
+    }
+
+
+USER = RowSerializer(
+    select(User.id, User.email, User.age, Profile.id, Profile.title, Profile.bio)
+    .outerjoin(Profile, Profile.user_id == User.id),
+    _user,
+    _user_favourites,
+)
+
+
+# Profile.serialize()
+def _profile(row, children):
+    _, user_id, title, bio = row
+    return {"user_id": user_id, "title": title, "bio": bio}
+
+
+PROFILE = RowSerializer(
+    select(Profile.id, Profile.user_id, Profile.title, Profile.bio),
+    _profile,
+)
+
+
+# Car.serialize()
+def _car_favourite_of(ids, session):
+    stmt = select(Favourite.car_id, User.id, User.email) \
+        .join(User, User.id == Favourite.user_id) \
+        .where(Favourite.car_id.in_(ids)).order_by(Favourite.id)
+    grouped = defaultdict(list)
+    for car_id, user_id, email in session.execute(stmt):
+        grouped[car_id].append({'id': user_id, 'email': email})
+    return grouped
+
+
+def _car(row, favourite_of):
+    car_id, model, year, name = row
+    return {
+        'id': car_id,
+        'model': model,
+        'year': year,
+        'name': name,
+        'favourite_of': favourite_of.get(car_id, []),
+    }
+
+
+CAR = RowSerializer(
+    select(Car.id, Car.model, Car.year, Car.name),
+    _car,
+    _car_favourite_of,
+)
+
+
+# Favourite.serialize()
+def _favourite(row, children):
+    favourite_id, user_id, email, car_id, car_name = row
+    return {
+        'id': favourite_id,
+        'user': {
+            'email': email,
+            'id': user_id
+        } if user_id is not None else None,
+        'car': {
+            'name': car_name,
+            'id': car_id
+        } if car_id is not None else None,
+    }
+
+
+FAVOURITE = RowSerializer(
+    select(Favourite.id, User.id, User.email, Car.id, Car.name)
+    .outerjoin(User, User.id == Favourite.user_id)
+    .outerjoin(Car, Car.id == Favourite.car_id),
+    _favourite,
+)
+
+
+# ?compact=1 replaces these embedded arrays with the ids of their elements
+EMBEDDED = ('favourites', 'favourite_of')
+
+
+def compact(item):
+    """`item` with its embedded arrays reduced to lists of ids."""
+    if not any(key in item for key in EMBEDDED):
+        return item
+    return {key: [child['id'] for child in value] if key in EMBEDDED else value
+            for key, value in item.items()}
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """DefaultJSONProvider that encodes with orjson when the output matches."""
+
+    def __init__(self, app):
+        super().__init__(app)
+        engine = os.getenv('JSON_ENGINE', 'auto')
+        if engine == 'orjson' and orjson is None:
+            raise RuntimeError('JSON_ENGINE=orjson but orjson is not installed')
+        self.fast = orjson is not None and engine in ('auto', 'orjson')
+
+    def _orjson(self, obj, kwargs):
+        """Encode with orjson, or return None when the result could differ."""
+        if not self.fast or kwargs.get('separators') != (',', ':') or set(kwargs) - ORJSON_KWARGS:
+            return None
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            data = orjson.dumps(obj, default=kwargs.get('default', self.default), option=option)
+        except TypeError:
+            # e.g. non-string dict keys or ints outside 64 bits
+            return None
+        # The standard encoder escapes non-ASCII and DEL as \uXXXX, orjson writes them as is
+        if kwargs.get('ensure_ascii', self.ensure_ascii) and (not data.isascii() or b'\x7f' in data):
+            return None
+        if ORJSON_FLOATS.search(data):
+            return None
+        # orjson writes NaN and Infinity as null, only look for them when there is one
+        if b'null' in data and _non_finite(obj):
+            return None
+        return data
+
+    def dumps(self, obj, **kwargs):
+        data = self._orjson(obj, kwargs)
+        if data is None:
+            return super().dumps(obj, **kwargs)
+        return data.decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        compact = self.compact is True or (self.compact is None and not self._app.debug)
+        data = self._orjson(obj, {'separators': (',', ':')}) if compact else None
+        if data is None:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(data + b"\n", mimetype=self.mimetype)
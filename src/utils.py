@@ -1,4 +1,6 @@
+from contextlib import contextmanager
 from flask import jsonify, url_for
+from sqlalchemy import event
 
 class APIException(Exception):
     status_code = 400
@@ -15,6 +17,32 @@ class APIException(Exception):
         rv['message'] = self.message
         return rv
 
+class QueryCounter:
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+@contextmanager
+def count_queries(engine):
+    """Count every SQL statement sent through `engine` inside the block.
+
+        with count_queries(db.engine) as counter:
+            client.get('/users')
+        assert counter.count == 3
+    """
+    counter = QueryCounter()
+    event.listen(engine, 'before_cursor_execute', counter._record)
+    try:
+        yield counter
+    finally:
+        event.remove(engine, 'before_cursor_execute', counter._record)
+
 def has_no_empty_params(rule):
     defaults = rule.defaults if rule.defaults is not None else ()
     arguments = rule.arguments if rule.arguments is not None else ()
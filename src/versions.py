@@ -0,0 +1,88 @@
+"""
+Change counters of the tables behind the collection endpoints.
+
+`table_versions` holds models.VERSION_SLOTS rows per table of
+models.VERSIONED_TABLES. Every transaction that writes one of them, through
+the ORM or through a Core INSERT/UPDATE/DELETE run by a session, adds one to
+one of its rows right before it commits, in the same transaction, and the
+version of a table is the sum of its rows. The validators of GET /users,
+/cars, /favourites and /users/profile (conditional.py) read these few rows
+by primary key instead of a max(updated_at) and a count(*) over whole
+tables: the sums move on every insert, update and delete, so they are as
+sound a validator and cost the same at any table size.
+
+A writer holds the row it bumped from that UPDATE to its commit, which is
+the last statement of the transaction. With a single row per table every
+writer of the table queued there, the throughput of its writes was one
+commit round trip at a time; the slot is picked at random per transaction,
+so two writers only queue when they pick the same one. A transaction takes
+the same slot of each table it wrote, in name order, so two writers never
+wait on each other in a cycle. The writes of cars and favourites still go
+one at a time through the lock of the outbox (outbox.py), which orders
+the change feed; `benchmarks/bench_concurrency.py --writes` measures both.
+
+A sequence would not block, but nextval() is visible before the commit is,
+a reader could store the old body under the new version. A counter read
+inside the transaction that made the change can't get ahead of it.
+
+Writes that bypass the sessions (manual SQL, a restored dump) don't move
+the counters, conditional GETs may answer 304 until the next write through
+the app, or until `UPDATE table_versions SET version = version + 1`.
+"""
+import random
+from sqlalchemy import event, func, select, update
+from models import db, TableVersion, VERSIONED_TABLES, VERSION_SLOTS
+from replicas import RoutingSession
+
+CHANGED = 'changed_tables'
+
+
+def _changed(session):
+    return session.info.setdefault(CHANGED, set())
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _flushed(session, flush_context, instances):
+    changed = _changed(session)
+    for obj in session.new | session.deleted:
+        changed.add(obj.__table__.name)
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            changed.add(obj.__table__.name)
+
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def _executed(state):
+    if state.is_insert or state.is_update or state.is_delete:
+        table = getattr(state.statement, 'table', None)
+        if table is not None and table.name != TableVersion.__tablename__:
+            _changed(state.session).add(table.name)
+
+
+@event.listens_for(RoutingSession, 'before_commit')
+def _bump(session):
+    # commit() flushes after this hook, flush first so the pending objects count
+    session.flush()
+    names = sorted(session.info.pop(CHANGED, set()) & set(VERSIONED_TABLES))
+    if names:
+        session.execute(
+            update(TableVersion)
+            .where(TableVersion.name.in_(names), TableVersion.slot == random.randrange(VERSION_SLOTS))
+            .values(version=TableVersion.version + 1)
+        )
+
+
+@event.listens_for(RoutingSession, 'after_soft_rollback')
+def _forget(session, previous_transaction):
+    session.info.pop(CHANGED, None)
+
+
+def state(names, session=None):
+    """The versions of `names`, in that order, None if one has no row."""
+    rows = dict((session or db.session).execute(
+        select(TableVersion.name, func.sum(TableVersion.version))
+        .where(TableVersion.name.in_(names)).group_by(TableVersion.name)
+    ).all())
+    if len(rows) != len(names):
+        return None
+    return tuple(int(rows[name]) for name in names)
@@ -0,0 +1,59 @@
+"""
+Test setup: the app from src/ on a throwaway SQLite database, seeded like
+the benchmarks (benchmarks/common.py). create_app() gets its settings as
+config: no auth, no rate limits and no response cache, so every request
+reaches the database, and a cheap password KDF. configured() builds
+another app on the same database with some of them turned back on.
+
+    $ pipenv run test
+"""
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from common import use_database, seed  # noqa: E402, puts src/ on sys.path too
+
+import pytest  # noqa: E402
+from app import create_app  # noqa: E402
+from models import db  # noqa: E402
+
+CONFIG = {
+    'ADMIN_ENABLED': False,
+    'MIGRATIONS_ENABLED': False,
+    'AUTH_REQUIRED': False,
+    'RATE_LIMIT_ENABLED': False,
+    'CACHE_ENABLED': False,
+    'PASSWORD_KDF': 'scrypt',
+    'PASSWORD_SCRYPT_LN': 4,
+}
+
+
+@pytest.fixture(scope='session')
+def app():
+    return create_app({**CONFIG, 'SQLALCHEMY_DATABASE_URI': use_database()})
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def configured(app):
+    """Another app on the same database, `overrides` on top of CONFIG."""
+    def made(**overrides):
+        return create_app({**CONFIG, 'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI'], **overrides})
+    return made
+
+
+@pytest.fixture
+def database(app):
+    """Seed `users` users and cars with 3 favourites each, return the engine."""
+    def seeded(users):
+        with app.app_context():
+            seed(db, users, users, 3)
+            db.session.remove()
+            return db.engine
+    return seeded
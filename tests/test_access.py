@@ -0,0 +1,47 @@
+"""
+Who gets an answer: bearer tokens and ownership (auth.py), and the rate
+limits (ratelimit.py). The other tests run with both turned off.
+"""
+
+
+def token(client, email):
+    """Sign up `email` and sign in, return (user id, Authorization header)."""
+    client.post('/users', json={'email': email, 'password': 'secret', 'age': 30})
+    body = client.post('/login', json={'email': email, 'password': 'secret'}).get_json()
+    return body['id'], {'Authorization': f"Bearer {body['token']}"}
+
+
+def test_token_required(configured, database):
+    database(5)
+    client = configured(AUTH_REQUIRED=True).test_client()
+    assert client.get('/cars').status_code == 401
+    assert client.get('/cars', headers={'Authorization': 'Bearer nonsense'}).status_code == 401
+    _, headers = token(client, 'reader@example.com')
+    assert client.get('/cars', headers=headers).status_code == 200
+
+
+def test_only_the_owner_writes(configured, database):
+    database(5)
+    client = configured(AUTH_REQUIRED=True).test_client()
+    owner, headers = token(client, 'owner@example.com')
+    other, _ = token(client, 'other@example.com')
+    assert client.put(f'/users/{other}', json={'age': 40}, headers=headers).status_code == 403
+    assert client.put(f'/users/{owner}', json={'age': 40}, headers=headers).status_code == 200
+    assert client.post('/users/bulk', json=[], headers=headers).status_code == 403
+
+
+def test_logout_revokes_the_token(configured, database):
+    database(5)
+    client = configured(AUTH_REQUIRED=True).test_client()
+    _, headers = token(client, 'leaving@example.com')
+    assert client.post('/logout', headers=headers).status_code == 200
+    assert client.get('/cars', headers=headers).status_code == 401
+
+
+def test_rate_limited(configured, database):
+    database(5)
+    client = configured(RATE_LIMIT_ENABLED=True, RATE_LIMIT_CLIENT='1/m:2', RATE_LIMITS='').test_client()
+    assert [client.get('/cars/1').status_code for _ in range(2)] == [200, 200]
+    response = client.get('/cars/1')
+    assert response.status_code == 429
+    assert 0 < int(response.headers['Retry-After']) <= 60
@@ -0,0 +1,140 @@
+"""
+What the writes keep in step with the rows they change: the response cache
+(cache.py), the validators (conditional.py), favourite_count (counters.py),
+the change feed (outbox.py) and the stored user documents (dashboards.py).
+"""
+from sqlalchemy import select, func
+from models import db, Car, Favourite
+import dashboards
+
+CAR = {'name': 'new', 'model': 'model', 'year': 2000}
+
+
+def fan_of(app, car_id):
+    """A user with `car_id` among their favourites."""
+    with app.app_context():
+        user_id = db.session.execute(select(Favourite.user_id).where(Favourite.car_id == car_id).limit(1)).scalar()
+        db.session.remove()
+    return user_id
+
+
+def favourite_counts(app):
+    """car id -> (favourite_count, favourites actually stored)."""
+    actual = select(func.count()).where(Favourite.car_id == Car.id).scalar_subquery()
+    with app.app_context():
+        rows = db.session.execute(select(Car.id, Car.favourite_count, actual)).all()
+        db.session.remove()
+    return {car_id: (stored, counted) for car_id, stored, counted in rows}
+
+
+def test_cache_dropped_by_write(configured, database):
+    database(5)
+    app = configured(CACHE_ENABLED=True)
+    client = app.test_client()
+    cached = app.extensions['cache'].local
+    # no fans, nothing but the car itself in their representations
+    car, other = (client.post('/cars', json=CAR).get_json()['id'] for _ in range(2))
+    for path in (f'/cars/{car}', f'/cars/{other}'):
+        assert client.get(path).headers['X-Cache'] == 'MISS'
+        assert client.get(path).headers['X-Cache'] == 'HIT'
+    assert client.put(f'/cars/{car}', json={'name': 'renamed'}).status_code == 200
+    # the write evicts what was built from that car, and nothing else
+    assert f'car:{car}' not in cached.tags
+    assert client.get(f'/cars/{other}').headers['X-Cache'] == 'HIT'
+    response = client.get(f'/cars/{car}')
+    assert response.headers['X-Cache'] == 'MISS'
+    assert response.get_json()['name'] == 'renamed'
+
+
+def test_etag_changes_with_the_collection(client, database):
+    database(5)
+    etag = client.get('/cars').headers['ETag']
+    assert client.get('/cars', headers={'If-None-Match': etag}).status_code == 304
+    assert client.post('/cars', json=CAR).status_code == 201
+    response = client.get('/cars', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_etag_changes_with_the_item(client, database):
+    database(5)
+    etag = client.get('/cars/1').headers['ETag']
+    assert client.put('/cars/1', json={'year': 2001}).status_code == 200
+    response = client.get('/cars/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_bulk_reports_each_item(client, database):
+    database(5)
+    response = client.post('/cars/bulk', json=[CAR, {'name': 'no model'}, {**CAR, 'year': 1500}])
+    assert response.status_code == 207
+    body = response.get_json()
+    assert (body['created'], body['failed']) == (1, 2)
+    assert [result['status'] for result in body['results']] == ['created', 'error', 'error']
+    assert client.get(f"/cars/{body['results'][0]['id']}").status_code == 200
+
+
+def test_bulk_all_created(client, database):
+    database(5)
+    response = client.post('/cars/bulk', json=[CAR, CAR])
+    assert response.status_code == 201
+    assert response.get_json()['created'] == 2
+
+
+def test_favourite_counts_follow_the_writes(app, client, database):
+    database(5)
+    car = client.post('/cars', json=CAR).get_json()['id']
+    other = client.post('/cars', json=CAR).get_json()['id']
+    favourite = client.post(f'/favourites/1/{car}').get_json()['id']
+    assert favourite_counts(app)[car] == (1, 1)
+    assert client.put(f'/favourites/{favourite}', json={'car_id': other}).status_code == 200
+    counts = favourite_counts(app)
+    assert (counts[car], counts[other]) == ((0, 0), (1, 1))
+    assert client.delete(f'/favourites/{favourite}').status_code == 200
+    assert favourite_counts(app)[other] == (0, 0)
+    assert all(stored == counted for stored, counted in favourite_counts(app).values())
+
+
+def test_deleting_a_car_takes_its_favourites(app, client, database):
+    database(5)
+    fan = fan_of(app, 1)
+    assert client.delete('/cars/1').status_code == 200
+    assert client.get('/cars/1').status_code == 404
+    assert 1 not in favourite_counts(app)
+    assert all(stored == counted for stored, counted in favourite_counts(app).values())
+    assert all(item['car'] != 'car0' for item in client.get(f'/users/{fan}').get_json()['favourites'])
+
+
+def test_changes_in_commit_order(client, database):
+    database(5)
+    since = client.get('/changes').get_json()['next']
+    car = client.post('/cars', json=CAR).get_json()['id']
+    client.put(f'/cars/{car}', json={'year': 2001})
+    favourite = client.post(f'/favourites/1/{car}').get_json()['id']
+    client.delete(f'/favourites/{favourite}')
+    body = client.get(f'/changes?since={since}').get_json()
+    changes = body['changes']
+    assert [(change['entity'], change['action'], change['id']) for change in changes] == [
+        ('car', 'created', car), ('car', 'updated', car),
+        ('favourite', 'created', favourite), ('favourite', 'deleted', favourite),
+    ]
+    seqs = [change['seq'] for change in changes]
+    assert seqs == sorted(seqs) and len(set(seqs)) == len(seqs)
+    assert body['next'] == seqs[-1]
+    assert client.get(f"/changes?since={body['next']}").get_json()['changes'] == []
+
+
+def test_dashboards_follow_the_writes(app, client, database):
+    database(5)
+    fan = fan_of(app, 1)
+    assert client.put('/cars/1', json={'name': 'renamed'}).status_code == 200
+    assert 'renamed' in [item['car'] for item in client.get(f'/users/{fan}').get_json()['favourites']]
+    car = client.post('/cars', json=CAR).get_json()['id']
+    client.post(f'/favourites/{fan}/{car}')
+    assert len(client.get(f'/users/{fan}').get_json()['favourites']) == 4
+    assert client.put(f'/users/{fan}', json={'age': 77}).status_code == 200
+    assert client.get(f'/users/{fan}').get_json()['age'] == 77
+    with app.app_context():
+        assert dashboards.check() == []
+        db.session.remove()
@@ -0,0 +1,87 @@
+"""
+SQL statements per request, see utils.count_queries().
+
+Every route runs a fixed number of statements, whatever the size of the
+tables: the loaders (loaders.py, serializers.py) read each relation in one
+query instead of one per row. The counts below are the current ones, a
+change that moves one should say why.
+"""
+import pytest
+from utils import count_queries
+
+SIZES = (5, 60)
+
+# path -> (status, statements)
+READS = {
+    '/users': (200, 3),
+    '/users?limit=100': (200, 3),
+    '/users/profile': (200, 2),
+    # validator and body in one fetch of the stored document, see dashboards.py
+    '/users/1': (200, 1),
+    '/users/1?compact=1': (200, 1),
+    '/users/999': (404, 3),
+    '/users/1/profile': (200, 2),
+    '/cars': (200, 3),
+    '/cars?stream=1': (200, 3),
+    '/cars/1': (200, 3),
+    '/cars/top': (200, 2),
+    '/favourites': (200, 2),
+    '/favourites/1': (200, 2),
+}
+
+
+def statements(client, engine, method, path):
+    with count_queries(engine) as counter:
+        response = client.open(path, method=method)
+        response.get_data()
+    return response.status_code, counter.count
+
+
+@pytest.mark.parametrize('users', SIZES)
+@pytest.mark.parametrize('path', READS)
+def test_reads(client, database, path, users):
+    engine = database(users)
+    assert statements(client, engine, 'GET', path) == READS[path]
+
+
+@pytest.mark.parametrize('users', SIZES)
+def test_not_modified(client, database, users):
+    engine = database(users)
+    for path in READS:
+        etag = client.get(path).headers.get('ETag')
+        if etag is None:
+            continue
+        with count_queries(engine) as counter:
+            response = client.get(path, headers={'If-None-Match': etag})
+        # the validator only, the view doesn't run
+        assert (response.status_code, counter.count) == (304, 1), path
+
+
+def free_cars(app, user_id):
+    """Two cars `user_id` doesn't favourite yet, and one of their favourites."""
+    from sqlalchemy import select
+    from models import db, Car, Favourite
+    with app.app_context():
+        taken = select(Favourite.car_id).where(Favourite.user_id == user_id)
+        cars = db.session.execute(select(Car.id).where(Car.id.not_in(taken)).order_by(Car.id).limit(2)).scalars().all()
+        favourite = db.session.execute(select(Favourite.id).where(Favourite.user_id == user_id).limit(1)).scalar()
+        db.session.remove()
+    return cars, favourite
+
+
+@pytest.mark.parametrize('users', SIZES)
+def test_writes(app, client, database, users):
+    engine = database(users)
+    (first, second), favourite = free_cars(app, 1)
+    writes = [
+        ('POST', '/users', {'email': 'new@example.com', 'password': 'secret', 'age': 30}, (200, 10)),
+        ('PUT', '/users/1', {'age': 31}, (200, 10)),
+        ('POST', '/cars', {'name': 'new', 'model': 'model', 'year': 2000}, (201, 6)),
+        ('POST', f'/favourites/1/{first}', None, (201, 10)),
+        ('PUT', f'/favourites/{favourite}', {'car_id': second}, (200, 14)),
+        ('DELETE', f'/favourites/{favourite}', None, (200, 10)),
+    ]
+    for method, path, body, expected in writes:
+        with count_queries(engine) as counter:
+            response = client.open(path, method=method, json=body)
+        assert (response.status_code, counter.count) == expected, (method, path)